@@ -0,0 +1,61 @@
+import time
+from typing import Type, List, Tuple
+
+import click
+import colorama
+from sqlalchemy.orm import Session, lazyload
+
+from . import model as abe_model
+from .cli import read_uri, check_connections
+from .logging import setup_logger, NO_AGGREGATION
+from .session import create_session
+
+BENCHMARKED_MODELS: List[Type[abe_model.Base]] = [
+    abe_model.Account,
+    abe_model.AccountStatementLog,
+    abe_model.AccountFeeRelation,
+]
+
+
+def fetch_throughput(session: Session, model: Type[abe_model.Base], trim_in_sql: bool,
+                     repeat: int = 3) -> Tuple[int, float]:
+    """Return the number of rows of `model` and the best time it took to load them
+
+    Relationships are not loaded, so that only the rows of the table itself
+    are measured.
+    """
+    previous, abe_model.String.trim_in_sql = abe_model.String.trim_in_sql, trim_in_sql
+    try:
+        best = float('inf')
+        rows = 0
+        for _ in range(repeat):
+            session.expunge_all()
+            start = time.perf_counter()
+            rows = len(session.query(model).options(lazyload('*')).all())
+            best = min(best, time.perf_counter() - start)
+        return rows, best
+    finally:
+        abe_model.String.trim_in_sql = previous
+
+
+@click.command()
+@click.option('--abe-uri-file', default=".abe_uri")
+@click.option('--repeat', default=3, help="Number of runs per model and mode; the best one counts.")
+def main(abe_uri_file: str, repeat: int):
+    """Compare the row-fetch throughput of trimming strings in SQL vs. in python"""
+    colorama.init()
+    abe_session = create_session(read_uri(uri_file=abe_uri_file))
+    logger = setup_logger('abe-bench', verbose=False)
+    check_connections(abe_session, logger=logger)
+
+    for model in BENCHMARKED_MODELS:
+        for trim_in_sql in (False, True):
+            rows, seconds = fetch_throughput(abe_session, model, trim_in_sql, repeat)
+            logger.info("%-20s trimmed in %-6s: %7d rows in %.3fs (%.0f rows/s)",
+                        model.__name__, "sql" if trim_in_sql else "python",
+                        rows, seconds, rows / seconds if seconds else 0,
+                        extra=NO_AGGREGATION)
+
+
+if __name__ == '__main__':
+    main()
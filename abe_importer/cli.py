@@ -1,35 +1,92 @@
+import time
+from typing import Tuple
+
 import click
 import colorama
 from sqlalchemy.orm import Session
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import DBAPIError, OperationalError
 
 from abe_importer.importer import do_import
+from abe_importer.importer.artifact import write_artifact
+from abe_importer.importer.constraints import check_constraints
+from abe_importer.importer.context import reg
+from abe_importer.importer.scope import Scope, WITHOUT_ACCESS
+from abe_importer.importer.staging import SQL_ENGINE
+from abe_importer.importer.sync import Synchronizer
 from abe_importer.importer.operational import ldap_view_too_old, refresh_ldap_view
 from abe_importer.importer.translations import ImportException
+from abe_importer.importer.verify import expected_checksums, verify_import
+from abe_importer.importer.writer import BackgroundWriter, WriterError
 from abe_importer.logging import setup_logger
 from abe_importer.session import create_session, create_scoped_session
 
 from pycroft.model import session as pyc_session
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('--abe-uri-file', default=".abe_uri")
 @click.option('--pycroft-uri-file', default=".pycroft_uri")
 @click.option('--refresh/--no-refresh', default=True,
               help="Don't force a refresh of the LDAP view")
 @click.option('-n', '--dry-run', is_flag=True,
-              help="Don't write to the pycroft database")
+              help="Don't write to the pycroft database, but check the new rows against its"
+                   " constraints")
 @click.option('-v', '--verbose', is_flag=True,
               help="Will raise the loglevel to DEBUG.")
-def main(abe_uri_file: str, pycroft_uri_file: str, dry_run: bool, refresh: bool, verbose: bool):
+@click.option('--pipeline', is_flag=True,
+              help="Flush the objects of each translation in a background thread"
+                   " while the next ones are running.  Ignored with --dry-run.")
+@click.option('--log-file', default="abe_importer.log.jsonl",
+              help="File receiving every log record as a JSON line."
+                   "  Repeated messages are only summarized on the console.")
+@click.option('--upsert', is_flag=True,
+              help="Import into a pycroft database which already contains a previous import:"
+                   " existing rows are updated instead of duplicated.")
+@click.option('--emit-sql', metavar='DIR', type=click.Path(file_okay=False),
+              help="Don't write to the pycroft database, but write COPY files and a psql"
+                   " load script to DIR instead.")
+@click.option('--building', 'buildings', metavar='SHORTNAME', multiple=True,
+              help="Only import the accounts of this building (repeatable), or those without"
+                   f" an access with {WITHOUT_ACCESS}.  Implies --upsert, so that the objects"
+                   " shared by all buildings are reused.")
+@click.option('--sample', metavar='FRACTION', type=click.FloatRange(0, 1, min_open=True),
+              help="Only import a random fraction of the accounts, with everything they reference.")
+@click.option('--seed', default=0, show_default=True, help="Seed choosing the --sample.")
+@click.option('--traffic-days', default=30, show_default=True,
+              help="Days of traffic history to import (0 for none).")
+@click.option('--profile-memory', is_flag=True,
+              help="Log the memory used by every translation, its top allocation sites and the"
+                   " objects held by the sessions.  Slows the import down considerably.")
+@click.option('--verify/--no-verify', default=True, show_default=True,
+              help="Compare row counts and checksums of the imported tables after the commit.")
+@click.option('--sql-translation', 'sql_translations', multiple=True,
+              type=click.Choice(sorted(name for name, engines in reg.engines().items()
+                                       if SQL_ENGINE in engines)),
+              help="Run this translation as INSERT … SELECT on a copy of abe in a staging schema"
+                   " of pycroft instead of through the ORM (repeatable).")
+def main(abe_uri_file: str, pycroft_uri_file: str, dry_run: bool, refresh: bool, verbose: bool,
+         pipeline: bool, log_file: str, upsert: bool, emit_sql: str, buildings: Tuple[str],
+         sample: float, seed: int, traffic_days: int, profile_memory: bool,
+         verify: bool, sql_translations: Tuple[str]):
+    """Import abe into pycroft, or run one of the COMMANDs"""
+    if click.get_current_context().invoked_subcommand:
+        return
     colorama.init()
+    upsert = upsert or bool(buildings)
+    if emit_sql and upsert:
+        raise click.UsageError("--emit-sql only produces inserts and can't be used with"
+                               " --upsert or --building")
+    if emit_sql and sql_translations:
+        raise click.UsageError("--sql-translation writes into pycroft and can't be used with"
+                               " --emit-sql")
+    scope = Scope(frozenset(buildings)) if buildings else Scope()
     abe_session = create_session(read_uri(uri_file=abe_uri_file))
     _pyc_scoped_session = create_scoped_session(read_uri(pycroft_uri_file))
     pyc_session.set_scoped_session(_pyc_scoped_session)
     pycroft_session = pyc_session.session
 
     logger_name = 'abe-importer'
-    logger = setup_logger(logger_name, verbose)
+    logger = setup_logger(logger_name, verbose, log_file=log_file)
 
     check_connections(abe_session, pycroft_session, logger=logger)
 
@@ -45,24 +102,118 @@ def main(abe_uri_file: str, pycroft_uri_file: str, dry_run: bool, refresh: bool,
     else:
         logger.info("Skipping LDAP refresh.  Use --refresh to force it.")
 
+    if sample:
+        scope = scope.sample(abe_session, sample, seed)
+        logger.info("Sampled %d accounts and %d deleted accounts (seed %d)",
+                    len(scope.sampled_accounts), len(scope.sampled_deleted_accounts), seed)
+
+    # the writer needs the actual session of this thread, not the thread-local proxy
+    pipeline = pipeline and not dry_run and not emit_sql
+    writer = BackgroundWriter(_pyc_scoped_session(), logger) if pipeline else None
     try:
-        objs = do_import(abe_session, pycroft_session, logger)
-    except ImportException:
+        if emit_sql:
+            # the new objects must not get ids from the database
+            with pycroft_session.no_autoflush:
+                # the traffic is a deferred write, which the artifact reports as skipped
+                objs = do_import(abe_session, pycroft_session, logger, scope=scope,
+                                 traffic_days=traffic_days, profile_memory=profile_memory)
+        else:
+            objs = do_import(abe_session, pycroft_session, logger, writer=writer, upsert=upsert,
+                             scope=scope, traffic_days=traffic_days,
+                             profile_memory=profile_memory,
+                             engines={name: SQL_ENGINE for name in sql_translations})
+    except (ImportException, WriterError):
         exit(1)
         return  # Don't judge me, this keeps pycharm silent
 
-    if dry_run:
+    if emit_sql:
+        with pycroft_session.no_autoflush:
+            write_artifact(emit_sql, objs, pycroft_session, logger)
+        if objs.deferred or objs.checks:
+            logger.warning("The traffic and ip_log history, the fee settlements and the legacy id"
+                           " mappings can't be part of the artifact and are skipped, as is the"
+                           " balance reconciliation.")
+        pycroft_session.rollback()
         exit(0)
         return
 
+    if dry_run:
+        # before flushing, as the checker takes flushed rows for existing ones
+        valid = check_constraints(objs, pycroft_session, logger)
+        if valid:
+            # flushed to get the balances to reconcile, the rollback undoes it
+            pycroft_session.add_all(objs)
+            objs.run_checks(pycroft_session)
+        else:
+            logger.warning("Skipping the balance reconciliation, the new rows can't be flushed.")
+        pycroft_session.rollback()
+        exit(0 if valid else 1)
+        return
+
     if click.confirm(f'Do you want to add {len(objs)} new entries to the pycroft repository?',
                      abort=True):
         pycroft_session.add_all(objs)
+        objs.run_deferred(pycroft_session)
+        # the commit expires the values the checksums are computed from
+        expected = expected_checksums(objs) if verify else None
         pycroft_session.commit()
+        if expected is not None and not verify_import(pycroft_session, expected, logger):
+            exit(1)
     else:
         pycroft_session.rollback()
 
 
+@main.command()
+@click.option('--abe-uri-file', default=".abe_uri")
+@click.option('--pycroft-uri-file', default=".pycroft_uri")
+@click.option('-v', '--verbose', is_flag=True,
+              help="Will raise the loglevel to DEBUG.")
+@click.option('--log-file', default="abe_importer_sync.log.jsonl",
+              help="File receiving every log record as a JSON line.")
+@click.option('--interval', default=60., show_default=True, metavar='SECONDS',
+              help="Time between the beginnings of two cycles.")
+@click.option('--cycles', default=0, show_default=True,
+              help="Stop after this many cycles (0 runs until interrupted).")
+@click.option('--readers', default=4, show_default=True,
+              help="Connections reading the changes from one consistent snapshot of abe"
+                   " (0 reads them in sequence).")
+def sync(abe_uri_file: str, pycroft_uri_file: str, verbose: bool, log_file: str,
+         interval: float, cycles: int, readers: int):
+    """Keep importing what changes in abe into an imported pycroft database
+
+    The first cycle upserts everything, every later one only the accounts
+    whose rows changed meanwhile.
+    """
+    colorama.init()
+    abe_session = create_session(read_uri(uri_file=abe_uri_file))
+    _pyc_scoped_session = create_scoped_session(read_uri(pycroft_uri_file))
+    pyc_session.set_scoped_session(_pyc_scoped_session)
+    pycroft_session = pyc_session.session
+    logger = setup_logger('abe-importer', verbose, log_file=log_file)
+    check_connections(abe_session, pycroft_session, logger=logger)
+
+    synchronizer = Synchronizer(abe_session, pycroft_session, logger, readers=readers)
+    cycle = 0
+    try:
+        while not cycles or cycle < cycles:
+            cycle += 1
+            if ldap_view_too_old(abe_session):
+                logger.info("Refreshing LDAP view…")
+                refresh_ldap_view(abe_session)
+            try:
+                stats = synchronizer.cycle()
+            # not only lost connections, e.g. a snapshot can vanish before it is adopted
+            except (ImportException, WriterError, DBAPIError):
+                logger.exception("Cycle %d failed, retrying in the next one.", cycle)
+                stats = None
+            else:
+                stats.log(logger, cycle)
+            if not cycles or cycle < cycles:
+                time.sleep(max(0., interval - (stats.seconds if stats else 0.)))
+    except KeyboardInterrupt:
+        logger.info("Stopped after %d cycles.", cycle)
+
+
 def check_connections(*sessions: Session, logger):
     try:
         for s in sessions:
@@ -1,33 +1,120 @@
 from collections import Counter
+from contextlib import nullcontext
 from logging import Logger
+from typing import Dict, Optional
 
 from sqlalchemy.orm import Session
 
 from pycroft.model import _all as pycroft_model
 from abe_importer.importer.object_registry import ObjectRegistry
+from abe_importer.logging import NO_AGGREGATION
 from . import translations  # executes the registration decorators
 from .context import Context, IntermediateData, reg
-from .tools import TranslationRegistry
+from .memory import MemoryProfiler
+from .progress import format_duration
+from .scope import Scope, WITHOUT_ACCESS
+from .tools import TranslationRegistry, DEFAULT_ENGINE
+from .upsert import ExistingRows
+from .writer import BackgroundWriter
 
+MEMBERSHIPS_BY_LOGIN = 'memberships_by_login'
 
-def do_import(abe_session: Session, pycroft_session: Session, logger: Logger):
+
+def do_import(abe_session: Session, pycroft_session: Session, logger: Logger,
+              writer: Optional[BackgroundWriter] = None, upsert: bool = False,
+              scope: Optional[Scope] = None, traffic_days: int = 0,
+              profile_memory: bool = False, engines: Optional[Dict[str, str]] = None):
+    """Run all translations and return the new objects
+
+    If a `writer` is given, the objects of every translation are flushed into
+    the pycroft session by it while the later translations are still running.
+
+    With `upsert`, rows which have already been imported are matched by their
+    natural keys (see :mod:`.upsert`) and only updated where they differ.
+    Nothing is deleted.
+
+    A `scope` restricts the import to a partition of abe, see :class:`Scope`.
+
+    The traffic of the last `traffic_days` days is not part of the returned
+    objects, but written by :meth:`ObjectRegistry.run_deferred`.
+
+    With `profile_memory`, the memory used by every translation and the
+    objects held by both sessions are logged, see :class:`MemoryProfiler`.
+
+    `engines` maps the names of translations to the engine they run on
+    instead of the ORM, e.g. ``{'translate_fees': SQL_ENGINE}`` (see
+    :mod:`.staging`).
+    """
+    unknown = set(engines or ()) - reg.engines().keys()
+    if unknown:
+        raise ValueError(f"There are no translations {', '.join(sorted(unknown))}")
     logger.info("Starting (dummy) import")
-    ctx = Context(abe_session, pycroft_session, logger)
+    ctx = Context(abe_session, pycroft_session, logger, traffic_days=traffic_days)
+    if upsert:
+        logger.info("Upsert mode: matching existing pycroft rows by natural keys")
+        ctx.existing = ExistingRows(pycroft_session, logger)
+    if scope:
+        ctx.scope = scope
+        if scope.partitioned:
+            logger.info("Importing the buildings %s", ", ".join(sorted(scope.buildings)))
+            left_out = scope.accounts_left_out(abe_session)
+            if left_out:
+                logger.warning("%d accounts without an access are only imported with the"
+                               " partition %s", left_out, WITHOUT_ACCESS)
+        if scope.sampled:
+            logger.info("Importing a sample of %d accounts", len(scope.sampled_accounts))
+    if writer:
+        ctx.pycroft_lock = writer.lock
+        ctx.writer = writer
     data = IntermediateData()
     objs = ObjectRegistry(f"{logger.name}.object_reg")
     objs.add_filter(lambda o: isinstance(o, pycroft_model.Building) and o.number == '50')
     objs.add_filter(lambda o: isinstance(o, pycroft_model.Address) and o.addition.endswith('-13'))
     objs.add_filter(lambda o: isinstance(o, pycroft_model.Address) and o.addition.endswith('-13'))
+    objs.declare_key(pycroft_model.User, pycroft_model.User, lambda u: u.login)
+    objs.declare_key(MEMBERSHIPS_BY_LOGIN, pycroft_model.Membership, lambda m: m.user.login)
+
+    if writer:
+        objs.add_sink(writer.submit)
+
+    profiler = None
+    if profile_memory:
+        profiler = MemoryProfiler(logger, {'abe': abe_session, 'pycroft': pycroft_session})
+        profiler.start()
+
+    try:
+        for func in reg.sorted_functions():
+            engine = (engines or {}).get(func.__name__, DEFAULT_ENGINE)
+            implementation = reg.implementation(func, engine)
+            if engine == DEFAULT_ENGINE:
+                logger.info("  %s...", func.__name__, extra=NO_AGGREGATION)
+            else:
+                logger.info("  %s (%s)...", func.__name__, engine, extra=NO_AGGREGATION)
 
-    for func in reg.sorted_functions():
-        logger.info(f"  {func.__name__}...")
+            # the profiler looks into the pycroft session, so it has to finish under the lock
+            with ctx.progress.stage(func.__name__) as stage, ctx.holding_pycroft(), \
+                    (profiler.stage(func.__name__) if profiler else nullcontext()):
+                new_objects = implementation(ctx, data)
 
-        new_objects = func(ctx, data)
+            obj_counter = Counter((type(ob).__name__ for ob in new_objects))
+            details = ", ".join([f"{obj}: {num}" for obj, num in obj_counter.items()])
+            logger.info("  ...%s (%s) took %s.", func.__name__, details,
+                        format_duration(stage.seconds), extra=NO_AGGREGATION)
+            objs.extend(new_objects)
+            objs.flush()
+    finally:
+        if writer:
+            writer.close()
+        if profiler:
+            profiler.stop()
 
-        obj_counter = Counter((type(ob).__name__ for ob in new_objects))
-        details = ", ".join([f"{obj}: {num}" for obj, num in obj_counter.items()])
-        logger.info(f"  ...{func.__name__} ({details}).")
-        objs.extend(new_objects)
-        objs.flush()
+    for write in data.deferred_writes:
+        objs.defer(write)
+    for check in data.deferred_checks:
+        objs.defer_check(check)
 
+    ctx.progress.log_summary()
+    ctx.retry_stats.log_summary(logger)
+    if profiler:
+        profiler.log_summary()
     return objs
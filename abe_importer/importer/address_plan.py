@@ -0,0 +1,152 @@
+"""Bulk validation of the IP and MAC addresses before translating devices
+
+Instead of finding problems device by device, all addresses are loaded at
+once as integers and checked with a few passes over sorted lists.
+"""
+import ipaddress
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from logging import Logger
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MULTICAST_BIT = 1 << 40
+
+
+def mac_to_int(mac: str) -> int:
+    return int(str(mac).replace(':', '').replace('-', ''), 16)
+
+
+def ip_to_int(ip: str) -> int:
+    return int(ipaddress.IPv4Address(str(ip).split('/')[0]))
+
+
+@dataclass(frozen=True)
+class SubnetRange:
+    """The addresses of a subnet, and the usable part of them as closed intervals"""
+    network: int
+    broadcast: int
+    first_usable: int
+    last_usable: int
+    subnet: object = field(compare=False)
+
+    @classmethod
+    def of(cls, network: ipaddress.IPv4Network, reserved_bottom: int, reserved_top: int,
+           subnet: object = None) -> 'SubnetRange':
+        first, last = int(network.network_address), int(network.broadcast_address)
+        return cls(first, last, first + 1 + reserved_bottom, last - 1 - reserved_top, subnet)
+
+
+class SubnetIndex:
+    """Finds the subnet of an address by bisecting the sorted network addresses
+
+    If subnets overlap, an address after the end of the subnet found that
+    way may still lie in an earlier, larger one, which is then looked for
+    linearly.  Of nested subnets, the innermost one is found.
+    """
+    def __init__(self, ranges: Iterable[SubnetRange]):
+        self.ranges = sorted(ranges, key=lambda r: r.network)
+        self.starts = [r.network for r in self.ranges]
+        self.overlapping = [(a, b) for a, b in zip(self.ranges, self.ranges[1:])
+                            if b.network <= a.broadcast]
+
+    def find(self, ip: int) -> Optional[SubnetRange]:
+        i = bisect_right(self.starts, ip) - 1
+        if i >= 0 and ip <= self.ranges[i].broadcast:
+            return self.ranges[i]
+        if self.overlapping and i > 0:
+            for candidate in reversed(self.ranges[:i]):
+                if ip <= candidate.broadcast:
+                    return candidate
+        return None
+
+
+@dataclass
+class AddressPlanReport:
+    duplicate_ips: Dict[int, List[str]] = field(default_factory=dict)
+    duplicate_macs: Dict[int, List[str]] = field(default_factory=dict)
+    multicast_macs: List[Tuple[str, int]] = field(default_factory=list)
+    unrouted_ips: List[Tuple[str, int]] = field(default_factory=list)
+    reserved_ips: List[Tuple[str, int]] = field(default_factory=list)
+    multiple_macs: Dict[str, List[int]] = field(default_factory=dict)
+    multiple_ips: Dict[str, List[int]] = field(default_factory=dict)
+    overlapping_subnets: List[Tuple[SubnetRange, SubnetRange]] = field(default_factory=list)
+
+    @property
+    def num_problems(self) -> int:
+        return sum(len(problems) for problems in self.__dict__.values())
+
+    def log(self, logger: Logger, examples: int = 5):
+        """Log everything found as one record"""
+        if not self.num_problems:
+            logger.info("Address plan: no problems found.")
+            return
+
+        def fmt(items, render) -> str:
+            items = list(items)
+            shown = ", ".join(render(i) for i in items[:examples])
+            return f"{len(items)} ({shown}{', …' if len(items) > examples else ''})"
+
+        def mac(m: int) -> str:
+            return ":".join(f"{m:012x}"[i:i + 2] for i in range(0, 12, 2))
+
+        def ip(i: int) -> str:
+            return str(ipaddress.IPv4Address(i))
+
+        lines = [
+            ("duplicate IPs", self.duplicate_ips.items(), lambda i: f"{ip(i[0])}: {'/'.join(i[1])}"),
+            ("duplicate MACs", self.duplicate_macs.items(),
+             lambda i: f"{mac(i[0])}: {'/'.join(i[1])}"),
+            ("multicast MACs", self.multicast_macs, lambda i: f"{i[0]}: {mac(i[1])}"),
+            ("IPs in no subnet", self.unrouted_ips, lambda i: f"{i[0]}: {ip(i[1])}"),
+            ("IPs in reserved ranges", self.reserved_ips, lambda i: f"{i[0]}: {ip(i[1])}"),
+            ("accounts with several MACs", self.multiple_macs.items(),
+             lambda i: f"{i[0]}: {'/'.join(map(mac, i[1]))}"),
+            ("accounts with several IPs", self.multiple_ips.items(),
+             lambda i: f"{i[0]}: {'/'.join(map(ip, i[1]))}"),
+            ("overlapping subnets", self.overlapping_subnets,
+             lambda i: f"{ip(i[0].network)}/{ip(i[1].network)}"),
+        ]
+        logger.warning("Address plan: %d problems found:\n%s", self.num_problems, "\n".join(
+            f"  {what}: {fmt(items, render)}" for what, items, render in lines if items
+        ))
+
+
+def _duplicates(rows: List[Tuple[str, int]]) -> Dict[int, List[str]]:
+    counts = Counter(value for _, value in rows)
+    duplicates = defaultdict(list)
+    for account, value in rows:
+        if counts[value] > 1:
+            duplicates[value].append(account)
+    return dict(duplicates)
+
+
+def _several_per_account(rows: List[Tuple[str, int]]) -> Dict[str, List[int]]:
+    by_account = defaultdict(list)
+    for account, value in rows:
+        by_account[account].append(value)
+    return {account: values for account, values in by_account.items() if len(values) > 1}
+
+
+def validate_address_plan(macs: Iterable[Tuple[str, str]], ips: Iterable[Tuple[str, str]],
+                          subnets: SubnetIndex) -> AddressPlanReport:
+    """Check the `(account, address)` pairs of all MACs and IPs at once"""
+    mac_rows = [(account, mac_to_int(mac)) for account, mac in macs if mac]
+    ip_rows = sorted(((account, ip_to_int(ip)) for account, ip in ips if ip),
+                     key=lambda row: row[1])
+
+    report = AddressPlanReport(
+        duplicate_ips=_duplicates(ip_rows),
+        duplicate_macs=_duplicates(mac_rows),
+        multicast_macs=[(a, m) for a, m in mac_rows if m & MULTICAST_BIT],
+        multiple_macs=_several_per_account(mac_rows),
+        multiple_ips=_several_per_account(ip_rows),
+        overlapping_subnets=subnets.overlapping,
+    )
+    for account, ip in ip_rows:
+        subnet = subnets.find(ip)
+        if subnet is None:
+            report.unrouted_ips.append((account, ip))
+        elif not subnet.first_usable <= ip <= subnet.last_usable:
+            report.reserved_ips.append((account, ip))
+    return report
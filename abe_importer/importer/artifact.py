@@ -0,0 +1,144 @@
+"""Writing the result of an import as PostgreSQL ``COPY`` files and a load script"""
+import os
+from datetime import date, datetime, time, timedelta
+from logging import Logger
+from typing import Any, Dict, Iterable, List, Tuple
+
+from sqlalchemy import Column, Table, func
+from sqlalchemy.dialects.postgresql import psycopg2
+from sqlalchemy.orm import Session
+
+from .rows import IdAllocator, Row, RowExtractor, allocated_key, filled_by_database, sql_default
+
+LOAD_SCRIPT = "load.sql"
+
+_dialect = psycopg2.dialect()
+_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_text(value: Any) -> str:
+    """Format a bound value as a field of the ``COPY`` text format"""
+    if value is None:
+        return r'\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return f"{value.total_seconds()} seconds"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        return ('{' + ','.join('NULL' if v is None else '"' + str(v).replace('"', r'\"') + '"'
+                               for v in value) + '}').translate(_ESCAPES)
+    return str(value).translate(_ESCAPES)
+
+
+def bind(column, value: Any) -> Any:
+    processor = column.type.dialect_impl(_dialect).bind_processor(_dialect)
+    return processor(value) if processor and value is not None else value
+
+
+def column_groups(table: Table, rows: List[Row]) -> List[Tuple[List[Column], List[Row]]]:
+    """Group `rows` by the columns they need to be copied with
+
+    A column filled in by the database (see :func:`filled_by_database`) is
+    only copied for the rows having a value for it, since an explicit null
+    would override the default.
+    """
+    defaulted = [c for c in table.columns if filled_by_database(c)]
+    groups: Dict[Tuple[Column, ...], List[Row]] = {}
+    for row in rows:
+        filled = tuple(c for c in defaulted if row.get(c) is not None)
+        groups.setdefault(filled, []).append(row)
+    return [([c for c in table.columns if not filled_by_database(c) or c in filled], group)
+            for filled, group in groups.items()]
+
+
+def copy_lines(columns: List[Column], rows: List[Row]) -> Iterable[str]:
+    """Return the lines of the data file copying `columns` of `rows`"""
+    return ('\t'.join(copy_text(bind(c, row.get(c))) for c in columns) + '\n'
+            for row in rows)
+
+
+def sql_default_text(column: Column) -> str:
+    return str(sql_default(column).compile(dialect=_dialect,
+                                           compile_kwargs={'literal_binds': True}))
+
+
+def first_free_ids(session: Session):
+    """Return a function giving the id following the highest one in use for a table"""
+    def first_id(table: Table) -> int:
+        # a flush would give the new objects ids of their own
+        with session.no_autoflush:
+            return (session.query(func.max(allocated_key(table))).scalar() or 0) + 1
+    return first_id
+
+
+def write_artifact(directory: str, objs: Iterable[object], session: Session, logger: Logger) \
+        -> List[Tuple[Table, int]]:
+    """Write the rows of `objs` to `directory`
+
+    Every table gets a ``NN_<table>.copy`` file (or several, see
+    :func:`column_groups`), numbered in dependency order, and
+    :data:`LOAD_SCRIPT` loads them in one transaction using ``psql``.  Ids
+    are allocated after the highest one in use in `session`; the load
+    script refuses to run if that range has been taken meanwhile, and
+    advances the sequences afterwards.
+
+    :returns: the tables and their number of rows
+    """
+    allocate_id = IdAllocator(first_free_ids(session))
+    extractor = RowExtractor(allocate_id)
+    extractor.add(objs)
+    if extractor.unsynced:
+        logger.warning("%d foreign keys of existing rows would change, which an insert-only"
+                       " artifact can't express.  First one: %s",
+                       len(extractor.unsynced), extractor.unsynced[0])
+
+    os.makedirs(directory, exist_ok=True)
+    script = ["\\set ON_ERROR_STOP on", "BEGIN;", ""]
+    summary = []
+    tables = extractor.tables()
+    for num, (table, rows) in enumerate(tables):
+        groups = column_groups(table, rows)
+        # `COPY` doesn't evaluate the SQL defaults of the client, so they are declared for the load
+        sql_defaulted = [c for c in table.columns
+                         if c.server_default is None and sql_default(c) is not None
+                         and any(c not in columns for columns, _ in groups)]
+
+        key = allocated_key(table)
+        first_id = allocate_id.first_ids.get(table)
+        if first_id is not None:
+            script.append(
+                f"DO $$ BEGIN IF (SELECT max({key.name}) FROM {table.fullname}) >= {first_id}"
+                f" THEN RAISE EXCEPTION 'ids of {table.fullname} from {first_id} are taken';"
+                f" END IF; END $$;"
+            )
+        for c in sql_defaulted:
+            script.append(f"ALTER TABLE {table.fullname} ALTER COLUMN {c.name}"
+                          f" SET DEFAULT {sql_default_text(c)};")
+        for part, (columns, group) in enumerate(groups):
+            suffix = f"_{part}" if len(groups) > 1 else ""
+            filename = f"{num:02d}_{table.name}{suffix}.copy"
+            with open(os.path.join(directory, filename), 'w', encoding='utf-8') as f:
+                f.writelines(copy_lines(columns, group))
+            script.append(f"\\copy {table.fullname} ({', '.join(c.name for c in columns)})"
+                          f" FROM '{filename}'")
+            logger.debug("Wrote %d rows of %s to %s", len(group), table.fullname, filename)
+        for c in sql_defaulted:
+            script.append(f"ALTER TABLE {table.fullname} ALTER COLUMN {c.name} DROP DEFAULT;")
+        if first_id is not None:
+            script.append(
+                f"SELECT setval(pg_get_serial_sequence('{table.fullname}', '{key.name}'),"
+                f" (SELECT max({key.name}) FROM {table.fullname}));"
+            )
+        script.append("")
+        summary.append((table, len(rows)))
+
+    script.append("COMMIT;")
+    with open(os.path.join(directory, LOAD_SCRIPT), 'w', encoding='utf-8') as f:
+        f.write("\n".join(script) + "\n")
+    logger.info("Wrote %d rows into %d tables to %s.  Load them with `cd %s && psql -f %s`.",
+                sum(n for _, n in summary), len(summary), directory, directory, LOAD_SCRIPT)
+    return summary
@@ -0,0 +1,160 @@
+"""Checking the rows of an import against the constraints of the pycroft schema
+
+A dry run never flushes, so violations would only show up when the real
+import commits.  This computes the rows of the new objects like the
+artifact export does, with placeholder ids which can't collide with real
+ones, and checks them with hash sets against the unique, not-null and
+foreign key constraints declared in the metadata, taking the rows already
+present in pycroft into account.
+"""
+from dataclasses import dataclass, field
+from logging import Logger
+from typing import Dict, Iterable, List, Set, Tuple
+
+from sqlalchemy import Column, ForeignKeyConstraint, Index, Table, UniqueConstraint, \
+    PrimaryKeyConstraint, select, tuple_
+from sqlalchemy.orm import Session
+
+from .rows import IdAllocator, Row, RowExtractor, allocated_key, filled_by_database
+
+# placeholder ids count up from here, so that they never meet those of existing rows
+FIRST_PLACEHOLDER_ID = -2 ** 62
+# number of values per query looking for referenced rows
+LOOKUP_CHUNK_SIZE = 1000
+
+
+@dataclass
+class Violation:
+    table: str
+    constraint: str
+    kind: str
+    examples: List[Tuple] = field(default_factory=list)
+    count: int = 0
+
+    def add(self, key: Tuple, max_examples: int = 5):
+        self.count += 1
+        if len(self.examples) < max_examples:
+            self.examples.append(key)
+
+
+def unique_keys(table: Table) -> List[Tuple[str, List[Column]]]:
+    """Return the name and columns of every unique constraint and unconditional unique index
+
+    Primary keys consisting of an allocated id are left out, the new rows
+    have placeholders there.
+    """
+    keys = []
+    for constraint in table.constraints:
+        if isinstance(constraint, PrimaryKeyConstraint) and allocated_key(table) is not None:
+            continue
+        if isinstance(constraint, (UniqueConstraint, PrimaryKeyConstraint)) and constraint.columns:
+            keys.append((constraint.name or f"{table.name} ({', '.join(constraint.columns.keys())})",
+                         list(constraint.columns)))
+    for index in table.indexes:
+        # functional and partial indexes can't be checked by the column values
+        if isinstance(index, Index) and index.unique \
+                and len(index.expressions) == len(index.columns) \
+                and not index.dialect_options['postgresql'].get('where'):
+            keys.append((index.name, list(index.columns)))
+    return keys
+
+
+def required_columns(table: Table) -> List[Column]:
+    """Return the columns which must not be null and don't get a value from the database"""
+    return [c for c in table.columns
+            if not c.nullable and not filled_by_database(c) and c is not allocated_key(table)]
+
+
+class ConstraintChecker:
+    """Collects the violations of the rows of new objects, see :meth:`check`"""
+    def __init__(self, session: Session):
+        self.session = session
+        self.violations: Dict[Tuple[str, str], Violation] = {}
+
+    def _violation(self, table: Table, constraint: str, kind: str) -> Violation:
+        return self.violations.setdefault((table.name, constraint),
+                                          Violation(table.name, constraint, kind))
+
+    def check(self, objs: Iterable[object]) -> List[Violation]:
+        extractor = RowExtractor(IdAllocator(lambda table: FIRST_PLACEHOLDER_ID))
+        # the extractor only looks at the objects, the session would flush them
+        with self.session.no_autoflush:
+            extractor.add(objs)
+            tables = dict(extractor.tables())
+            for table, rows in tables.items():
+                self.check_not_null(table, rows)
+                self.check_unique(table, rows)
+                self.check_foreign_keys(table, rows, tables)
+        return sorted(self.violations.values(), key=lambda v: (v.table, v.constraint))
+
+    def check_not_null(self, table: Table, rows: List[Row]):
+        for column in required_columns(table):
+            for row in rows:
+                if row.get(column) is None:
+                    self._violation(table, column.name, "not null").add(_describe(row))
+
+    def check_unique(self, table: Table, rows: List[Row]):
+        for name, columns in unique_keys(table):
+            keys = [tuple(row.get(c) for c in columns) for row in rows]
+            # like in SQL, keys containing a null never collide
+            keys = [key for key in keys if None not in key]
+            if not keys:
+                continue
+            seen: Set[Tuple] = self._present_keys(columns, set(keys))
+            for key in keys:
+                if key in seen:
+                    self._violation(table, name, "unique").add(key)
+                seen.add(key)
+
+    def check_foreign_keys(self, table: Table, rows: List[Row], tables: Dict[Table, List[Row]]):
+        for fk in (c for c in table.constraints if isinstance(c, ForeignKeyConstraint)):
+            columns = list(fk.columns)
+            referred = [element.column for element in fk.elements]
+            keys = {tuple(row.get(c) for c in columns) for row in rows}
+            keys = {key for key in keys if None not in key}
+            new = {tuple(row.get(c) for c in referred)
+                   for row in tables.get(referred[0].table, [])}
+            missing = keys - new
+            if missing:
+                missing -= self._present_keys(referred, missing)
+            name = fk.name or f"{table.name} ({', '.join(c.name for c in columns)})"
+            for key in sorted(missing, key=repr):
+                self._violation(table, name, "foreign key").add(key)
+
+    def _present_keys(self, columns: List[Column], keys: Set[Tuple]) -> Set[Tuple]:
+        """Return those of `keys` which exist in the database"""
+        present = set()
+        keys = list(keys)
+        for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+            chunk = keys[start:start + LOOKUP_CHUNK_SIZE]
+            if len(columns) == 1:
+                criterion = columns[0].in_([key[0] for key in chunk])
+            else:
+                criterion = tuple_(*columns).in_(chunk)
+            present.update(tuple(row) for row in
+                           self.session.execute(select(columns).where(criterion)))
+        return present
+
+
+def _describe(row: Row, num_values: int = 3) -> Tuple:
+    """Return the first few values of `row` which aren't ids, to recognize it by"""
+    return tuple(v for c, v in row.items()
+                 if v is not None and not c.primary_key and not c.foreign_keys)[:num_values]
+
+
+def log_violations(violations: List[Violation], logger: Logger):
+    if not violations:
+        logger.info("The new rows satisfy all constraints.")
+        return
+    logger.error("%d constraints would be violated:\n%s", len(violations), "\n".join(
+        f"  {v.table}.{v.constraint} ({v.kind}): {v.count} rows, e.g. "
+        + ", ".join(map(repr, v.examples))
+        for v in violations
+    ))
+
+
+def check_constraints(objs: Iterable[object], session: Session, logger: Logger) -> bool:
+    """Check `objs` against the constraints of the schema, returning whether all hold"""
+    violations = ConstraintChecker(session).check(objs)
+    log_violations(violations, logger)
+    return not violations
@@ -1,31 +1,136 @@
 import ipaddress
+import threading
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from datetime import datetime
 from functools import cached_property
 from logging import Logger
-from typing import Dict, Callable, List, Any
+from typing import Dict, Callable, List, Any, Optional, Hashable, Tuple, Type, TypeVar
 
 from pycroft.model import _all as pycroft_model
 from sqlalchemy import func
 from sqlalchemy.orm import Session, Query
 
+from .paging import PagedQuery, RetryStats
+from .progress import Progress
+from .scope import Scope
 from .tools import TranslationRegistry
+from .upsert import ExistingRows, IndexId, update_changed
+from .writer import BackgroundWriter
 from .. import model as abe_model
 
 
+M = TypeVar('M')
+
+
 @dataclass
 class Context:
     abe_session: Session
     pycroft_session: Session
     logger: Logger
     now: datetime = field(init=False)
+    progress: Optional[Progress] = None
+    # held while using `pycroft_session`; shared with a `BackgroundWriter`
+    pycroft_lock: threading.RLock = field(default_factory=threading.RLock)
+    # set if a `BackgroundWriter` flushes into `pycroft_session`
+    writer: Optional[BackgroundWriter] = None
+    # set in upsert mode
+    existing: Optional[ExistingRows] = None
+    scope: Scope = field(default_factory=Scope)
+    page_size: int = 1000
+    # days of traffic history to import (0 for none)
+    traffic_days: int = 0
+    retry_stats: RetryStats = field(default_factory=RetryStats)
+    # the thread holding `pycroft_lock` through `holding_pycroft`
+    _lock_owner: Optional[int] = field(default=None, init=False, repr=False)
 
     def __post_init__(self):
         self.now = self.pycroft_session.query(func.current_timestamp()).scalar()
+        if self.progress is None:
+            self.progress = Progress(self.logger)
 
     def query(self, *entities: Any, **kwargs: Any) -> Query:
         return self.abe_session.query(*entities, **kwargs)
 
+    def paged(self, query: Query, *keys: Any) -> PagedQuery:
+        """Read `query` in pages ordered by `keys`, surviving connection drops
+
+        The pycroft session is released to the background writer while a
+        page is read, see :meth:`reading_abe`.
+        """
+        return PagedQuery(query, keys, self.page_size, self.retry_stats, self.logger,
+                          release=self.reading_abe)
+
+    @contextmanager
+    def holding_pycroft(self):
+        """Hold :attr:`pycroft_lock` while using the pycroft session
+
+        :raises WriterError: if the background writer failed, since the
+            session can't be used anymore then
+        """
+        with self.pycroft_lock:
+            owner, self._lock_owner = self._lock_owner, threading.get_ident()
+            try:
+                self.check_writer()
+                yield
+            finally:
+                self._lock_owner = owner
+
+    def check_writer(self):
+        if self.writer:
+            self.writer.check()
+
+    @contextmanager
+    def reading_abe(self):
+        """Release the pycroft session to the background writer during an abe read
+
+        `do_import` runs every translation in :meth:`holding_pycroft`; nothing
+        in this block may touch the pycroft session or pycroft objects.
+        Without the lock held by this thread (e.g. outside `do_import`),
+        there is nothing to release.
+
+        Meanwhile, the writer flushes the session, i.e. not only the batches
+        of earlier translations but also those objects of the running one
+        which already are in it, e.g. through a relationship to a flushed
+        object.  They have to be complete before a read.
+
+        :raises WriterError: if the writer failed meanwhile
+        """
+        if self._lock_owner != threading.get_ident():
+            yield
+            return
+        self._lock_owner = None
+        self.pycroft_lock.release()
+        try:
+            yield
+        finally:
+            self.pycroft_lock.acquire()
+            self._lock_owner = threading.get_ident()
+        self.check_writer()
+
+    def lookup(self, index_id: IndexId, key: Hashable) -> Optional[Any]:
+        """Return the existing pycroft row with the natural `key` (only in upsert mode)"""
+        if self.existing is None:
+            return None
+        return self.existing.get(index_id, key)
+
+    def upsert(self, model: Type[M], key: Hashable, **values: Any) -> Tuple[M, bool]:
+        """Return the row with the natural `key`, and whether it has been created
+
+        Outside of upsert mode, this is just ``model(**values)``.  Otherwise,
+        an existing row gets the differing `values` assigned, so that only
+        changed attributes are written.
+        """
+        obj = self.lookup(model, key)
+        if obj is None:
+            obj = model(**values)
+            if self.existing is not None:
+                self.existing.remember(model, key, obj)
+            return obj, True
+
+        update_changed(obj, **values)
+        return obj, False
+
     @cached_property
     def config(self) -> pycroft_model.Config:
         return self.pycroft_session.query(pycroft_model.Config).one()
@@ -63,6 +168,17 @@ class IntermediateData:
     # IPv4Network → Subnet
     subnets: Dict[ipaddress.IPv4Network, pycroft_model.Subnet] = dict_field()
 
+    # account_statement_log.id → BankAccountActivity
+    statement_activities: Dict[int, pycroft_model.BankAccountActivity] = dict_field()
+
+    # account-name → IP of the imported device
+    account_ips: Dict[str, pycroft_model.IP] = dict_field()
+
+    # bulk writes to be run after the objects have been flushed, see `ObjectRegistry.defer`
+    deferred_writes: List[Callable[[Session], int]] = field(default_factory=list)
+    # reads of the flushed objects, also run by a dry run, see `ObjectRegistry.defer_check`
+    deferred_checks: List[Callable[[Session], Any]] = field(default_factory=list)
+
 
 reg: TranslationRegistry[
     Callable[[Context, IntermediateData], List[pycroft_model.ModelBase]],
@@ -0,0 +1,47 @@
+"""Compressing the abe `ip_log` into validity intervals"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from .upsert import utc
+
+
+@dataclass
+class IpInterval:
+    ip: str
+    account: str
+    begins_at: datetime
+    ends_at: datetime
+    observations: int = 1
+
+
+def collapse_observations(rows: Iterable[Tuple[str, str, datetime]]) -> Iterator[IpInterval]:
+    """Collapse `(ip, account, timestamp)` observations sorted by ip and timestamp
+
+    Consecutive observations of the same account on the same IP become one
+    interval from the first to the last of them.
+    """
+    current: Optional[IpInterval] = None
+    for ip, account, timestamp in rows:
+        if current and current.ip == ip and current.account == account:
+            current.ends_at = timestamp
+            current.observations += 1
+            continue
+        if current:
+            yield current
+        current = IpInterval(ip, account, timestamp, timestamp)
+    if current:
+        yield current
+
+
+def observations_after(rows: Iterable[Tuple[str, str, datetime]],
+                       imported_until: Dict[str, datetime]) -> Iterator[Tuple[str, str, datetime]]:
+    """Leave out the observations of an account up to the end of its imported intervals
+
+    An IP still used at that end gets a new interval for the later
+    observations, instead of extending the imported one.
+    """
+    for ip, account, timestamp in rows:
+        until = imported_until.get(account)
+        if until is None or utc(timestamp) > utc(until):
+            yield ip, account, timestamp
@@ -1,14 +1,17 @@
 from __future__ import annotations
 
 from collections import Iterable
-from dataclasses import dataclass
-from datetime import datetime, timezone
+from dataclasses import dataclass, replace
+from datetime import date, datetime, time, timezone
 from functools import total_ordering, reduce
-from typing import List, Optional
+from itertools import groupby
+from typing import List, Optional, Tuple
 
 from dateutil.relativedelta import relativedelta
 from pycroft.helpers import interval
 
+from .upsert import utc
+
 MEMBERSHIP_FEE_PATTERN = "Mitgliedsbeitrag %-%"
 MEMBERSHIP_FEE_PREFIX = MEMBERSHIP_FEE_PATTERN.split(' ')[0]
 
@@ -65,6 +68,76 @@ def descriptions_to_interval_set(descriptions: List[str], latest_month: FeeMonth
                                 for d in descriptions)
 
 
+def _instant(value: Optional[date]) -> Optional[datetime]:
+    """Normalize a bound for comparisons, dates being taken as their UTC midnight"""
+    if value is not None and not isinstance(value, datetime):
+        value = datetime.combine(value, time.min)
+    return utc(value)
+
+
+@dataclass
+class MembershipSpan:
+    """A candidate membership, `None` meaning unbounded"""
+    group_id: int
+    begins_at: Optional[date] = None
+    ends_at: Optional[date] = None
+    # where the span comes from, for reporting
+    origin: str = ""
+
+    @property
+    def inverted(self) -> bool:
+        return None not in (self.begins_at, self.ends_at) \
+            and _instant(self.ends_at) < _instant(self.begins_at)
+
+    @property
+    def empty(self) -> bool:
+        return None not in (self.begins_at, self.ends_at) \
+            and _instant(self.ends_at) == _instant(self.begins_at)
+
+
+def _begin_key(span: MembershipSpan):
+    return (span.begins_at is not None, _instant(span.begins_at))
+
+
+def merge_spans(spans: Iterable[MembershipSpan]) \
+        -> Tuple[List[MembershipSpan], List[MembershipSpan]]:
+    """Merge overlapping and adjacent spans of the same group
+
+    The spans of every group are swept in the order of their beginning, and
+    each one is merged into the previous one if it begins before that one
+    ends.  Empty spans are dropped.
+
+    :returns: the merged spans ordered by group and beginning, and the
+        inverted spans (ending before they begin), which are left out
+    """
+    valid = []
+    inverted = []
+    for span in spans:
+        if span.inverted:
+            inverted.append(span)
+        elif not span.empty:
+            valid.append(span)
+
+    merged: List[MembershipSpan] = []
+    valid.sort(key=lambda s: (s.group_id, _begin_key(s)))
+    for _, group_spans in groupby(valid, key=lambda s: s.group_id):
+        current: Optional[MembershipSpan] = None
+        for span in group_spans:
+            if current is None:
+                current = replace(span)
+                continue
+            if current.ends_at is not None and span.begins_at is not None \
+                    and _instant(span.begins_at) > _instant(current.ends_at):
+                merged.append(current)
+                current = replace(span)
+                continue
+            if current.ends_at is not None and \
+                    (span.ends_at is None or _instant(span.ends_at) > _instant(current.ends_at)):
+                current.ends_at = span.ends_at
+        merged.append(current)
+    return merged, inverted
+
+
 def test_latest_month():
     descriptions = [
         "Mitgliedsbeitrag 2019-11",
@@ -92,3 +165,28 @@ def assert_membership_intervals(descriptions: List[str],
     assert interval.IntervalSet(FeeMonth.from_desc(d).to_interval(latest_month)
                                 for d in descriptions) \
            == expected_intervals
+
+
+def test_merge_spans():
+    def at(day: int) -> datetime:
+        return datetime(2020, 1, day, tzinfo=timezone.utc)
+
+    merged, inverted = merge_spans([
+        MembershipSpan(1, at(10), at(12)),
+        MembershipSpan(1, at(1), at(5)),
+        MembershipSpan(1, at(5), at(7)),  # adjacent
+        MembershipSpan(1, at(3), at(4)),  # contained
+        MembershipSpan(1, at(11), None),  # open
+        MembershipSpan(1, at(20), at(20)),  # empty
+        MembershipSpan(2, at(8), at(2), origin="record 7"),
+        MembershipSpan(2, None, at(3)),
+        MembershipSpan(2, datetime(2020, 1, 3), at(6)),  # naive timestamps are UTC
+        MembershipSpan(3, date(2020, 1, 1)),
+    ])
+    assert [(s.group_id, s.begins_at, s.ends_at) for s in merged] == [
+        (1, at(1), at(7)),
+        (1, at(10), None),
+        (2, None, at(6)),
+        (3, date(2020, 1, 1), None),
+    ]
+    assert [s.origin for s in inverted] == ["record 7"]
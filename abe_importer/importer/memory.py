@@ -0,0 +1,134 @@
+"""Memory profiling of the translation stages"""
+import os
+import resource
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from logging import Logger
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy.orm import Session
+
+from ..logging import NO_AGGREGATION
+
+
+def rss_bytes() -> int:
+    """Return the resident set size, or the peak of it where the current one is unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def census(session: Session) -> Counter:
+    """Count the objects per class in the identity map and the pending objects of `session`"""
+    counts = Counter(type(obj).__name__ for obj in session.identity_map.values())
+    counts.update(type(obj).__name__ for obj in session.new)
+    return counts
+
+
+def format_bytes(num: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(num) < 1024:
+            return f"{num:.0f} {unit}"
+        num /= 1024
+    return f"{num:.1f} GiB"
+
+
+@dataclass
+class MemoryStats:
+    name: str
+    rss_before: int = 0
+    rss_after: int = 0
+    traced_peak: int = 0
+    top_sites: List[str] = field(default_factory=list)
+    census: Dict[str, Counter] = field(default_factory=dict)
+
+    @property
+    def rss_delta(self) -> int:
+        return self.rss_after - self.rss_before
+
+
+class MemoryProfiler:
+    """Snapshots the memory before and after every stage
+
+    For each stage, the change of the RSS, the peak of the memory traced by
+    :mod:`tracemalloc`, the `top` allocation sites which grew the most, and
+    the number of objects per class in each of the `sessions` are logged.
+    Tracing slows the import down considerably, so this is opt-in.
+    """
+    def __init__(self, logger: Logger, sessions: Dict[str, Session], top: int = 10,
+                 frames: int = 1):
+        self.logger = logger
+        self.sessions = sessions
+        self.top = top
+        self.frames = frames
+        self.stages: List[MemoryStats] = []
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self._snapshot = tracemalloc.take_snapshot()
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def reset_peak(self):
+        """Start the traced peak over for the next stage
+
+        Before python 3.9, there is no ``tracemalloc.reset_peak``, and only
+        clearing the traces resets the peak.  The allocation sites of a stage
+        are then those of the memory it allocated and still holds.
+        """
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.clear_traces()
+            self._snapshot = tracemalloc.take_snapshot()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[MemoryStats]:
+        if self._snapshot is None:
+            self.start()
+        stats = MemoryStats(name, rss_before=rss_bytes())
+        self.reset_peak()
+        yield stats
+
+        stats.rss_after = rss_bytes()
+        _, stats.traced_peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        stats.top_sites = [str(diff) for diff in
+                           snapshot.compare_to(self._snapshot, 'lineno')[:self.top]]
+        self._snapshot = snapshot
+        stats.census = {name: census(session) for name, session in self.sessions.items()}
+        self.stages.append(stats)
+        self.log_stage(stats)
+
+    def log_stage(self, stats: MemoryStats):
+        census_lines = [
+            f"  {session}: " + ", ".join(f"{cls} {n}" for cls, n in counts.most_common(self.top))
+            for session, counts in stats.census.items() if counts
+        ]
+        self.logger.info(
+            "Memory of %s: RSS %s → %s (%+d MiB), traced peak %s\n"
+            "  top allocation sites:\n%s\n  identity maps:\n%s",
+            stats.name, format_bytes(stats.rss_before), format_bytes(stats.rss_after),
+            stats.rss_delta // 2**20, format_bytes(stats.traced_peak),
+            "\n".join(f"    {site}" for site in stats.top_sites),
+            "\n".join(f"  {line}" for line in census_lines),
+            extra=NO_AGGREGATION,
+        )
+
+    def log_summary(self):
+        self.logger.info("Memory per translation:\n%s", "\n".join(
+            f"  {s.name:<28} RSS {s.rss_delta / 2**20:>+8.1f} MiB"
+            f" to {format_bytes(s.rss_after):>10}, traced peak {format_bytes(s.traced_peak):>10}"
+            for s in self.stages
+        ))
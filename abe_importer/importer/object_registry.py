@@ -1,6 +1,11 @@
 import logging
-from collections import Counter
-from typing import TypeVar, Hashable, Generic, List, Optional, Callable
+from collections import Counter, defaultdict
+from typing import TypeVar, Hashable, Generic, List, Optional, Callable, Dict, Type, Any, \
+    Iterable
+
+from sqlalchemy.orm import Session
+
+from .upsert import NATURAL_KEYS, IndexId, KeyFunc, NaturalKey
 
 T = TypeVar('T', bound=Hashable)
 
@@ -8,17 +13,33 @@ T = TypeVar('T', bound=Hashable)
 class ObjectRegistry(Generic[T]):
     """
     Basically an overcomplicated list to allow for debug introspection
+
+    For the introspection, the flushed objects can be looked up by type
+    (:meth:`of_type`), by a key (:meth:`find`) or by attribute values
+    (:meth:`where`).  The keys are the natural keys of :mod:`.upsert` plus
+    those declared with :meth:`declare_key`.  Indexes are built on their
+    first use and kept up to date by :meth:`flush` from then on.
     """
     objs: List[T]
     staging: List[T]
     logger: logging.Logger
     object_filters: List[Callable[[object], bool]]
+    sinks: List[Callable[[List[T]], None]]
+    deferred: List[Callable[[Session], int]]
+    checks: List[Callable[[Session], Any]]
+    keys: Dict[IndexId, NaturalKey]
 
     def __init__(self, logger_name: Optional[str] = None):
         self.object_filters = []
+        self.sinks = []
+        self.deferred = []
+        self.checks = []
         self.objs = []
         self.staging = []
         self.logger = logging.getLogger(logger_name or 'object_registry')
+        self.keys = dict(NATURAL_KEYS)
+        self._by_type: Optional[Dict[Type, List[T]]] = None
+        self._indexes: Dict[IndexId, Dict[Hashable, List[T]]] = {}
 
     def append(self, value: T):
         self.insert_hook(value)
@@ -30,21 +51,114 @@ class ObjectRegistry(Generic[T]):
         self.staging.extend(values)
 
     def flush(self):
-        """Don't ask why this exists
+        """Move the staged objects to the registry and hand them to the sinks
 
-        I thought we could try an early commit, but that turned out to be a stupid idea.
+        The sinks get the batch in the order of flushing, which makes this
+        the hand-off point to a :class:`BackgroundWriter`.
         """
         self.logger.debug(
             "Flushing %d records: %r",
             len(self.staging),
             Counter([type(o) for o in self.staging])
         )
+        for sink in self.sinks:
+            sink(self.staging)
+        self._index_objects(self.staging)
         self.objs.extend(self.staging)
         self.staging.clear()
 
     def add_filter(self, f: Callable[[object], bool]):
         self.object_filters.append(f)
 
+    def add_sink(self, sink: Callable[[List[T]], None]):
+        self.sinks.append(sink)
+
+    def defer(self, write: Callable[[Session], int]):
+        """Register a bulk write to be run once the objects have been flushed
+
+        Deferred writes bypass the ORM, e.g. for rows referring to the ids of
+        the objects.  They return the number of rows written.
+        """
+        self.deferred.append(write)
+
+    def defer_check(self, check: Callable[[Session], Any]):
+        """Register a check of the flushed objects, which only reads
+
+        Unlike the deferred writes, the checks also run in a dry run, see
+        :meth:`run_checks`.
+        """
+        self.checks.append(check)
+
+    def run_deferred(self, session: Session) -> int:
+        """Flush `session` and run the deferred writes and then the checks in it,
+        returning the rows written"""
+        session.flush()
+        num_rows = 0
+        for write in self.deferred:
+            num_rows += write(session)
+        self.logger.debug("Deferred writes added %d rows", num_rows)
+        self.run_checks(session)
+        return num_rows
+
+    def run_checks(self, session: Session):
+        """Flush `session` and run the deferred checks in it"""
+        session.flush()
+        for check in self.checks:
+            check(session)
+
+    def declare_key(self, index_id: IndexId, model: Type, key: KeyFunc):
+        """Make objects of `model` findable by `key`, in addition to the natural keys"""
+        self.keys[index_id] = NaturalKey(model, key)
+        self._indexes.pop(index_id, None)
+
+    def of_type(self, model: Type) -> List[T]:
+        """Return the flushed objects of `model`, including those of subclasses"""
+        if self._by_type is None:
+            self._by_type = defaultdict(list)
+            self._add_by_type(self.objs)
+        return [obj for cls, objs in self._by_type.items() if issubclass(cls, model)
+                for obj in objs]
+
+    def find(self, index_id: IndexId, key: Hashable) -> List[T]:
+        """Return the flushed objects with `key` in the index `index_id`"""
+        return self._index(index_id).get(key, [])
+
+    def where(self, model: Type, **values: Any) -> List[T]:
+        """Return the flushed objects of `model` whose attributes have the given `values`"""
+        return [obj for obj in self.of_type(model)
+                if all(getattr(obj, attr) == value for attr, value in values.items())]
+
+    def _index(self, index_id: IndexId) -> Dict[Hashable, List[T]]:
+        try:
+            return self._indexes[index_id]
+        except KeyError:
+            pass
+        index: Dict[Hashable, List[T]] = defaultdict(list)
+        self._indexes[index_id] = index
+        self._add_to_index(index_id, self.of_type(self.keys[index_id].model))
+        self.logger.debug("Indexed %d keys of %s", len(index), index_id)
+        return index
+
+    def _index_objects(self, objs: List[T]):
+        if self._by_type is not None:
+            self._add_by_type(objs)
+        for index_id in self._indexes:
+            model = self.keys[index_id].model
+            self._add_to_index(index_id, [o for o in objs if isinstance(o, model)])
+
+    def _add_by_type(self, objs: Iterable[T]):
+        for obj in objs:
+            self._by_type[type(obj)].append(obj)
+
+    def _add_to_index(self, index_id: IndexId, objs: Iterable[T]):
+        index, key = self._indexes[index_id], self.keys[index_id].key
+        for obj in objs:
+            try:
+                index[key(obj)].append(obj)
+            except AttributeError:
+                # e.g. a membership whose user has not been set
+                self.logger.debug("Can't compute the %s key of %r", index_id, obj)
+
     def __iter__(self):
         if self.staging:
             raise RuntimeError(f"We still have {len(self.staging)} objects staged."
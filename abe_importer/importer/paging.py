@@ -0,0 +1,134 @@
+import itertools
+import time
+from collections import Counter
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from logging import Logger
+from typing import Any, Callable, ContextManager, Iterator, List, Optional, Sequence, Tuple, \
+    TypeVar
+
+from sqlalchemy import tuple_
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import Query
+
+T = TypeVar('T')
+
+
+@dataclass
+class RetryStats:
+    pages: int = 0
+    retries: int = 0
+    # query label → number of failed attempts
+    failures: Counter = field(default_factory=Counter)
+
+    def log_summary(self, logger: Logger):
+        if not self.retries:
+            logger.info("Read %d pages without connection errors.", self.pages)
+            return
+        logger.warning("Read %d pages, retried %d times after connection errors (%s).",
+                       self.pages, self.retries,
+                       ", ".join(f"{label}: {n}" for label, n in self.failures.most_common()))
+
+
+def is_connection_error(e: DBAPIError) -> bool:
+    return e.connection_invalidated or isinstance(e, OperationalError)
+
+
+class PagedQuery:
+    """Iterates over the result of `query` in pages of `page_size` rows
+
+    The rows are ordered by `keys` (usually the primary key), and every page
+    starts after the last key of the previous one instead of using an
+    ``OFFSET``, so every query stays short.  If a page fails because the
+    connection dropped, the session is rolled back and the page is fetched
+    again after a growing delay (at most `max_retries` times per page).
+    Since pool pre-ping replaces dead connections, this resumes where it
+    stopped.
+
+    Rows of pages already read are expired by the rollback and refreshed
+    on their next use.
+    """
+    def __init__(self, query: Query, keys: Sequence, page_size: int, stats: RetryStats,
+                 logger: Logger, release: Callable[[], ContextManager] = nullcontext,
+                 max_retries: int = 5, backoff: float = 1.,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.query = query
+        self.keys = keys
+        self.page_size = page_size
+        self.stats = stats
+        self.logger = logger
+        self.release = release
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.label = ", ".join(d['name'] for d in query.column_descriptions)
+
+    def __len__(self):
+        return self.retrying(lambda: self.query.order_by(None).count())
+
+    def __iter__(self) -> Iterator:
+        last = None
+        while True:
+            page = self.retrying(lambda: self.page_after(last))
+            self.stats.pages += 1
+            yield from page
+            if len(page) < self.page_size:
+                return
+            last = self.key_of(page[-1])
+
+    def key_of(self, row) -> Tuple[Any, ...]:
+        return tuple(getattr(row, key.key) for key in self.keys)
+
+    def after(self, query: Query, last: Optional[Tuple[Any, ...]]) -> Query:
+        query = query.order_by(*self.keys)
+        if last is None:
+            return query
+        if len(self.keys) == 1:
+            return query.filter(self.keys[0] > last[0])
+        return query.filter(tuple_(*self.keys) > tuple_(*last))
+
+    def page_after(self, last: Optional[Tuple[Any, ...]]) -> List:
+        return self.after(self.query, last).limit(self.page_size).all()
+
+    def retrying(self, read: Callable[[], T]) -> T:
+        for attempt in itertools.count(1):
+            try:
+                with self.release():
+                    return read()
+            except DBAPIError as e:
+                self.failed(e, attempt)
+
+    def failed(self, e: DBAPIError, attempt: int):
+        """Reraise `e` unless a retry is due, in which case wait for it"""
+        if not is_connection_error(e) or attempt > self.max_retries:
+            raise e
+        delay = self.backoff * 2 ** (attempt - 1)
+        self.stats.retries += 1
+        self.stats.failures[self.label] += 1
+        self.logger.warning("Reading %s failed (%s), retrying in %.0fs (%d/%d)",
+                            self.label, e.orig, delay, attempt, self.max_retries)
+        self.query.session.rollback()
+        self.sleep(delay)
+
+
+class StreamedQuery(PagedQuery):
+    """Like :class:`PagedQuery`, but reading everything through one server-side cursor
+
+    `page_size` rows are fetched from the cursor at a time, so memory stays
+    constant however large the result is.  After a connection drop, a new
+    cursor continues after the key of the last row.  Rows must therefore be
+    unique by `keys`.
+    """
+    def __iter__(self) -> Iterator:
+        last = None
+        for attempt in itertools.count(1):
+            query = self.after(self.query, last) \
+                .execution_options(stream_results=True) \
+                .yield_per(self.page_size)
+            try:
+                for row in query:
+                    yield row
+                    last = self.key_of(row)
+                return
+            except DBAPIError as e:
+                self.failed(e, attempt)
@@ -0,0 +1,116 @@
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from logging import Logger
+from typing import Iterable, TypeVar, Optional, List, Iterator, TextIO, Callable
+
+from sqlalchemy.orm import Query
+
+T = TypeVar('T')
+
+
+@dataclass
+class StageStats:
+    name: str
+    rows: int = 0
+    seconds: float = 0.
+
+    @property
+    def rate(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class Progress:
+    """Throughput reporting for the translation loops
+
+    A translation wraps the iterable it loops over in :meth:`track`.  While
+    iterating, a single status line (rows, total, rows/s, ETA) is redrawn on
+    `stream` if it is a terminal, and a debug record is logged every
+    `log_interval` seconds so that the log file shows stalled stages as well.
+    :meth:`stage` accumulates the rows of all loops of one translation.
+    """
+    def __init__(self, logger: Logger, stream: TextIO = sys.stderr,
+                 redraw_interval: float = 0.2, log_interval: float = 30.,
+                 clock: Callable[[], float] = time.monotonic):
+        self.logger = logger
+        self.stream = stream
+        self.redraw_interval = redraw_interval
+        self.log_interval = log_interval
+        self.clock = clock
+        self.stages: List[StageStats] = []
+        self._current: Optional[StageStats] = None
+
+    @property
+    def _tty(self) -> bool:
+        return hasattr(self.stream, 'isatty') and self.stream.isatty()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageStats]:
+        stats = StageStats(name)
+        self._current = stats
+        start = self.clock()
+        try:
+            yield stats
+        finally:
+            stats.seconds = self.clock() - start
+            self._current = None
+            self.stages.append(stats)
+
+    def track(self, items: Iterable[T], total: Optional[int] = None, what: str = "rows") \
+            -> Iterator[T]:
+        """Iterate over `items`, reporting the progress
+
+        If `total` is not given, it is taken from ``len(items)`` or, for a
+        query, from ``items.count()``.
+        """
+        if total is None:
+            if isinstance(items, Query):
+                total = items.order_by(None).count()
+            elif hasattr(items, '__len__'):
+                total = len(items)
+
+        label = self._current.name if self._current else what
+        start = last_redraw = last_log = self.clock()
+        done = 0
+        for done, item in enumerate(items, start=1):
+            yield item
+            if self._current:
+                self._current.rows += 1
+
+            now = self.clock()
+            if self._tty and now - last_redraw >= self.redraw_interval:
+                self.stream.write("\r\x1b[K" + self.status(label, done, total, now - start, what))
+                self.stream.flush()
+                last_redraw = now
+            if now - last_log >= self.log_interval:
+                self.logger.debug("%s", self.status(label, done, total, now - start, what))
+                last_log = now
+
+        if self._tty:
+            self.stream.write("\r\x1b[K")
+            self.stream.flush()
+        self.logger.debug("%s", self.status(label, done, total, self.clock() - start, what))
+
+    @staticmethod
+    def status(label: str, done: int, total: Optional[int], elapsed: float, what: str) -> str:
+        rate = done / elapsed if elapsed > 0 else 0.
+        if total is None:
+            return f"{label}: {done} {what} ({rate:.0f} {what}/s)"
+
+        percent = 100 * done / total if total else 100.
+        eta = format_duration((total - done) / rate) if rate else "?"
+        return f"{label}: {done}/{total} {what} ({percent:.0f}%, {rate:.0f} {what}/s, ETA {eta})"
+
+    def log_summary(self):
+        self.logger.info("Throughput per translation:\n%s", "\n".join(
+            f"  {s.name:<28} {s.rows:>8} rows in {format_duration(s.seconds):>8}"
+            f" ({s.rate:.0f} rows/s)"
+            for s in self.stages
+        ))
@@ -0,0 +1,84 @@
+"""Comparing the account balances of abe with those of the imported pycroft accounts
+
+Both sides are aggregated by the database and joined as dicts, so this
+takes a few queries however many accounts there are.
+"""
+from dataclasses import dataclass
+from decimal import Decimal
+from logging import Logger
+from typing import Dict, List
+
+from pycroft.model import _all as pycroft_model
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .scope import Scope
+from .. import model as abe_model
+
+
+@dataclass
+class Mismatch:
+    account: str
+    abe_balance: Decimal
+    pycroft_balance: Decimal
+
+    @property
+    def delta(self) -> Decimal:
+        return self.pycroft_balance - self.abe_balance
+
+
+def abe_balances(session: Session, scope: Scope) -> Dict[str, Decimal]:
+    """Return the statements minus the booked fees of every account without pycroft mapping"""
+    log = abe_model.AccountStatementLog
+    paid = session.query(log.account_name, func.sum(log.amount)) \
+        .filter(log.account_name != None, *scope.of_accounts(log.account)) \
+        .group_by(log.account_name)
+    rel = abe_model.AccountFeeRelation
+    booked = session.query(rel.account_name, func.sum(abe_model.FeeInfo.amount)) \
+        .join(rel.fee) \
+        .filter(*scope.fees()) \
+        .group_by(rel.account_name)
+    mapped = {name for name, in session.query(abe_model.Account.account)
+                                       .filter(abe_model.Account.pycroft_login != None)}
+
+    balances: Dict[str, Decimal] = {}
+    for account, amount in paid:
+        balances[account] = balances.get(account, Decimal(0)) + (amount or 0)
+    for account, amount in booked:
+        balances[account] = balances.get(account, Decimal(0)) - (amount or 0)
+    return {account: balance for account, balance in balances.items() if account not in mapped}
+
+
+def pycroft_balances(session: Session, account_ids: Dict[str, int]) -> Dict[str, Decimal]:
+    """Return the balance of the finance account of every abe account in `account_ids`
+
+    pycroft books fees as positive and payments as negative amounts, so the
+    sign is flipped to match abe.
+    """
+    split = pycroft_model.Split
+    sums = dict(session.query(split.account_id, func.sum(split.amount))
+                       .filter(split.account_id.in_(list(account_ids.values())))
+                       .group_by(split.account_id))
+    return {account: -sums.get(account_id, Decimal(0))
+            for account, account_id in account_ids.items()}
+
+
+def compare_balances(abe: Dict[str, Decimal], pycroft: Dict[str, Decimal]) -> List[Mismatch]:
+    """Return the mismatches of the accounts on both sides, largest delta first"""
+    mismatches = [Mismatch(account, abe[account], pycroft[account])
+                  for account in abe.keys() & pycroft.keys()
+                  if abe[account] != pycroft[account]]
+    return sorted(mismatches, key=lambda m: (-abs(m.delta), m.account))
+
+
+def log_mismatches(mismatches: List[Mismatch], num_accounts: int, logger: Logger,
+                   examples: int = 20):
+    if not mismatches:
+        logger.info("Balances of all %d accounts match.", num_accounts)
+        return
+    logger.warning("Balances of %d of %d accounts don't match (pycroft − abe):\n%s",
+                   len(mismatches), num_accounts, "\n".join(
+                       f"  {m.account:<20} {m.abe_balance:>10} {m.pycroft_balance:>10}"
+                       f" {m.delta:>+10}"
+                       for m in mismatches[:examples]
+                   ))
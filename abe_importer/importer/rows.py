@@ -0,0 +1,192 @@
+"""Turning new ORM objects into plain table rows without flushing them"""
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import Column, Integer, Table, inspect
+from sqlalchemy.orm import interfaces
+from sqlalchemy.orm.state import InstanceState
+from sqlalchemy.schema import sort_tables
+from sqlalchemy.sql import ClauseElement
+
+Row = Dict[Column, Any]
+
+
+class IdAllocator:
+    """Hands out consecutive primary keys per table, starting at `first_id(table)`"""
+    def __init__(self, first_id: Callable[[Table], int]):
+        self.first_id = first_id
+        self.first_ids: Dict[Table, int] = {}
+        self.next_ids: Dict[Table, int] = {}
+
+    def __call__(self, table: Table) -> int:
+        if table not in self.next_ids:
+            self.first_ids[table] = self.next_ids[table] = self.first_id(table)
+        value = self.next_ids[table]
+        self.next_ids[table] += 1
+        return value
+
+
+def new_states(objs: Iterable[object]) -> List[InstanceState]:
+    """Return the states of `objs` and of every new object reachable from them
+
+    This is the closure the session would insert on flush: everything
+    reachable over relationships with a ``save-update`` cascade.  Objects
+    which already have an identity (i.e. are in the database) are left out.
+    """
+    seen = set()
+    states = []
+
+    def visit(state: InstanceState):
+        if state in seen:
+            return
+        seen.add(state)
+        if state.key is None:
+            states.append(state)
+
+    for obj in objs:
+        state = inspect(obj)
+        visit(state)
+        for _, _, child_state, _ in state.mapper.cascade_iterator('save-update', state):
+            visit(child_state)
+    return states
+
+
+def allocated_key(table: Table) -> Column:
+    """Return the primary key column of `table` if it is a single serial integer, else `None`"""
+    pk = list(table.primary_key.columns)
+    if len(pk) == 1 and isinstance(pk[0].type, Integer) and pk[0].autoincrement in (True, 'auto'):
+        return pk[0]
+    return None
+
+
+def sql_default(column: Column) -> Optional[ClauseElement]:
+    """Return the SQL expression the client inserts for `column` if it has no value"""
+    default = column.default
+    if default is not None and default.is_clause_element:
+        return default.arg
+    return None
+
+
+def filled_by_database(column: Column) -> bool:
+    """Whether a missing value of `column` is computed by the database instead of python"""
+    return column.server_default is not None or sql_default(column) is not None
+
+
+def _python_default(column: Column) -> Any:
+    default = column.default
+    # SQL expressions (e.g. `func.now()`) are left to the database, see `filled_by_database`
+    if default is None or default.is_sequence or default.is_clause_element:
+        return None
+    if default.is_scalar:
+        return default.arg
+    # callables are wrapped to accept an execution context
+    return default.arg(None)
+
+
+class RowExtractor:
+    """Computes the rows that inserting a set of new objects would produce
+
+    Primary keys of new objects are taken from an :class:`IdAllocator`, and
+    foreign keys are filled in from the relationships just like the unit of
+    work does on flush.  The objects themselves are not modified.
+    """
+    def __init__(self, allocate_id: Callable[[Table], int]):
+        self.allocate_id = allocate_id
+        self.values: Dict[InstanceState, Row] = {}
+        self.secondary_rows: Dict[Table, Dict[Tuple, Row]] = defaultdict(dict)
+        self.unsynced: List[str] = []
+
+    def add(self, objs: Iterable[object]):
+        states = new_states(objs)
+        for state in states:
+            self.values[state] = self._column_values(state)
+        for state in states:
+            self._sync_relationships(state)
+
+    def _column_values(self, state: InstanceState) -> Row:
+        mapper = state.mapper
+        row: Row = {}
+        for table in mapper.tables:
+            key_column = allocated_key(table)
+            for column in table.columns:
+                try:
+                    prop = mapper.get_property_by_column(column)
+                except Exception:  # not mapped (e.g. the discriminator of a subclass)
+                    continue
+                value = state.dict.get(prop.key)
+                if value is None and column is key_column:
+                    value = self._existing_value(row, prop) or self.allocate_id(table)
+                elif value is None:
+                    value = self._existing_value(row, prop)
+                    if value is None:
+                        value = _python_default(column)
+                row[column] = value
+        if mapper.polymorphic_on is not None and mapper.polymorphic_identity is not None:
+            row[mapper.polymorphic_on] = mapper.polymorphic_identity
+        return row
+
+    @staticmethod
+    def _existing_value(row: Row, prop) -> Any:
+        # columns of inheriting tables share the property of the base table's column
+        for column in prop.columns:
+            if row.get(column) is not None:
+                return row[column]
+        return None
+
+    def value(self, state: InstanceState, column: Column) -> Any:
+        """Return the value `column` has (or will have) for the object of `state`"""
+        if state in self.values:
+            row = self.values[state]
+            if column in row:
+                return row[column]
+            prop = state.mapper.get_property_by_column(column)
+            return self._existing_value(row, prop)
+        prop = state.mapper.get_property_by_column(column)
+        return getattr(state.obj(), prop.key)
+
+    def _set(self, state: InstanceState, column: Column, value: Any, what: str):
+        if state not in self.values:
+            if self.value(state, column) != value:
+                self.unsynced.append(what)
+            return
+        row = self.values[state]
+        prop = state.mapper.get_property_by_column(column)
+        for c in prop.columns:
+            if c in row:
+                row[c] = value
+
+    def _sync_relationships(self, state: InstanceState):
+        for rel in state.mapper.relationships:
+            value = state.dict.get(rel.key)
+            if value is None:
+                continue
+            related = [value] if not rel.uselist else list(value)
+            related_states = [inspect(o) for o in related]
+            what = f"{state.class_.__name__}.{rel.key}"
+
+            if rel.direction is interfaces.MANYTOONE:
+                for other in related_states:
+                    for source, dest in rel.synchronize_pairs:
+                        self._set(state, dest, self.value(other, source), what)
+            elif rel.direction is interfaces.ONETOMANY:
+                for other in related_states:
+                    for source, dest in rel.synchronize_pairs:
+                        self._set(other, dest, self.value(state, source), what)
+            else:
+                for other in related_states:
+                    row = {dest: self.value(state, source)
+                           for source, dest in rel.synchronize_pairs}
+                    row.update({dest: self.value(other, source)
+                                for source, dest in rel.secondary_synchronize_pairs})
+                    key = tuple(sorted((c.name, v) for c, v in row.items()))
+                    self.secondary_rows[rel.secondary][key] = row
+
+    def tables(self) -> List[Tuple[Table, List[Row]]]:
+        """Return the rows grouped by table, in an order satisfying the foreign keys"""
+        rows: Dict[Table, List[Row]] = defaultdict(list)
+        for state, values in self.values.items():
+            for table in state.mapper.tables:
+                rows[table].append({c: v for c, v in values.items() if c.table is table})
+        for table, secondary in self.secondary_rows.items():
+            rows[table].extend(secondary.values())
+        return [(table, rows[table]) for table in sort_tables(rows)]
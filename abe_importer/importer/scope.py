@@ -0,0 +1,122 @@
+import random
+from dataclasses import dataclass, replace
+from typing import FrozenSet, List, Optional, Tuple
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import Session
+
+from .. import model as abe_model
+
+# the partition of the accounts without an access (e.g. living elsewhere)
+WITHOUT_ACCESS = '@external'
+
+
+@dataclass(frozen=True)
+class Scope:
+    """The part of abe an import is restricted to
+
+    A partitioned import only translates the accesses of the selected
+    `buildings`, and the accounts, fees and statements belonging to them.
+    The accounts without an access form the partition :data:`WITHOUT_ACCESS`.
+    A sampled import (see :meth:`sample`) only translates the selected
+    accounts and the rows they reference.  Buildings, switches, networks and
+    the bank account are shared by everything and always imported, so that
+    they can be referred to.
+
+    Every method returns criteria to be passed to :meth:`Query.filter`,
+    which are empty if the import is not restricted.
+    """
+    buildings: Optional[FrozenSet[str]] = None
+    sampled_accounts: Optional[FrozenSet[str]] = None
+    # `AccountStatementLog.name` of the sampled deleted accounts
+    sampled_deleted_accounts: Optional[FrozenSet[str]] = None
+
+    @property
+    def partitioned(self) -> bool:
+        return self.buildings is not None
+
+    @property
+    def sampled(self) -> bool:
+        return self.sampled_accounts is not None
+
+    @property
+    def restricted(self) -> bool:
+        return self.partitioned or self.sampled
+
+    def accesses(self) -> Tuple:
+        criteria = []
+        if self.partitioned:
+            criteria.append(abe_model.Access.building_shortname.in_(sorted(self.buildings)))
+        if self.sampled:
+            criteria.append(abe_model.Access.id.in_(
+                select([abe_model.Account.access_id])
+                .where(abe_model.Account.account.in_(sorted(self.sampled_accounts)))
+            ))
+        return tuple(criteria)
+
+    def accounts(self) -> Tuple:
+        criteria = []
+        if self.partitioned:
+            in_buildings = abe_model.Account.access.has(
+                abe_model.Access.building_shortname.in_(sorted(self.buildings))
+            )
+            if WITHOUT_ACCESS in self.buildings:
+                in_buildings = or_(in_buildings, abe_model.Account.access_id == None)
+            criteria.append(in_buildings)
+        if self.sampled:
+            criteria.append(abe_model.Account.account.in_(sorted(self.sampled_accounts)))
+        return tuple(criteria)
+
+    def accounts_left_out(self, session: Session) -> int:
+        """Return the number of accounts without an access a partitioned import leaves out"""
+        if not self.partitioned or WITHOUT_ACCESS in self.buildings:
+            return 0
+        return session.query(abe_model.Account).filter(abe_model.Account.access_id == None).count()
+
+    def statements(self) -> Tuple:
+        """Statements of accounts in scope, and those without an account
+
+        The latter belong to deleted accounts, so that they are imported
+        with every partition (and deduplicated by the upsert), and sampled
+        by the name of the deleted account.
+        """
+        if not self.restricted:
+            return ()
+        log = abe_model.AccountStatementLog
+        unassigned = log.account_name == None
+        if self.sampled:
+            unassigned = and_(unassigned, log.name.in_(sorted(self.sampled_deleted_accounts)))
+        return or_(unassigned, log.account.has(and_(*self.accounts()))),
+
+    def fees(self) -> Tuple:
+        return self.of_accounts(abe_model.AccountFeeRelation.account)
+
+    def of_accounts(self, account_relationship) -> Tuple:
+        """Rows whose `account_relationship` refers to an account in scope"""
+        if not self.restricted:
+            return ()
+        return account_relationship.has(and_(*self.accounts())),
+
+    def sample(self, session: Session, fraction: float, seed: int) -> 'Scope':
+        """Return this scope restricted to a random `fraction` of its accounts
+
+        The choice only depends on `seed` and the account names, so that a
+        rehearsal can be repeated with the same sample.  Deleted accounts,
+        which only appear as the name of statements, are sampled as well.
+        """
+        rng = random.Random(seed)
+        accounts = [name for name, in session.query(abe_model.Account.account)
+                                             .filter(*self.accounts())]
+        log = abe_model.AccountStatementLog
+        deleted = [name for name, in session.query(log.name).distinct()
+                                            .filter(log.account_name == None, log.name != None)]
+        return replace(
+            self,
+            sampled_accounts=frozenset(_pick(rng, accounts, fraction)),
+            sampled_deleted_accounts=frozenset(_pick(rng, deleted, fraction)),
+        )
+
+
+def _pick(rng: random.Random, names: List[str], fraction: float) -> List[str]:
+    names = sorted(names)
+    return rng.sample(names, round(len(names) * fraction))
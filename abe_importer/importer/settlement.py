@@ -0,0 +1,92 @@
+"""Matching the payments of an account to the fees they settle"""
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+from itertools import groupby
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+
+@dataclass
+class Charge:
+    """A fee or a payment of an account"""
+    id: int
+    timestamp: datetime
+    amount: Decimal
+
+
+@dataclass
+class Allocation:
+    fee_id: int
+    statement_id: int
+    amount: Decimal
+
+
+@dataclass
+class Settlement:
+    allocations: List[Allocation]
+    # the amount of the fees which are not paid
+    open_amount: Decimal
+    # the amount of the payments which exceed the fees
+    credit: Decimal
+
+
+def allocate_fifo(fees: List[Charge], payments: List[Charge]) -> Settlement:
+    """Pay the fees in the order they were booked with the payments in the order they came in
+
+    Both lists have to be sorted by timestamp (and id).  A payment may
+    settle several fees, and a fee may be settled by several payments;
+    payments made before a fee are a credit which settles it once booked.
+    Refunds and reversed fees (negative amounts) are not allocated.
+    """
+    allocations = []
+    fees = [f for f in fees if f.amount > 0]
+    payments = [p for p in payments if p.amount > 0]
+    fee_index = payment_index = 0
+    fee_left = fees[0].amount if fees else Decimal(0)
+    payment_left = payments[0].amount if payments else Decimal(0)
+    while fee_index < len(fees) and payment_index < len(payments):
+        amount = min(fee_left, payment_left)
+        if amount > 0:
+            allocations.append(Allocation(fees[fee_index].id, payments[payment_index].id, amount))
+        fee_left -= amount
+        payment_left -= amount
+        if fee_left <= 0:
+            fee_index += 1
+            fee_left = fees[fee_index].amount if fee_index < len(fees) else Decimal(0)
+        if payment_left <= 0:
+            payment_index += 1
+            payment_left = payments[payment_index].amount \
+                if payment_index < len(payments) else Decimal(0)
+
+    open_amount = fee_left + sum((f.amount for f in fees[fee_index + 1:]), Decimal(0)) \
+        if fee_index < len(fees) else Decimal(0)
+    credit = payment_left + sum((p.amount for p in payments[payment_index + 1:]), Decimal(0)) \
+        if payment_index < len(payments) else Decimal(0)
+    return Settlement(allocations, open_amount, credit)
+
+
+def merge_by_account(fees: Iterable[Tuple[str, Charge]], payments: Iterable[Tuple[str, Charge]]) \
+        -> Iterator[Tuple[str, List[Charge], List[Charge]]]:
+    """Join the fees and payments of every account, both being sorted by account
+
+    This is the merge step of a sort-merge join, so it reads both streams
+    only once.
+    """
+    def by_account(rows: Iterable[Tuple[str, Charge]]) -> Iterator[Tuple[str, List[Charge]]]:
+        for account, group in groupby(rows, key=lambda row: row[0]):
+            yield account, [charge for _, charge in group]
+
+    fee_groups, payment_groups = by_account(fees), by_account(payments)
+    fee_group: Optional[Tuple[str, List[Charge]]] = next(fee_groups, None)
+    payment_group: Optional[Tuple[str, List[Charge]]] = next(payment_groups, None)
+    while fee_group or payment_group:
+        account: Any = min(g[0] for g in (fee_group, payment_group) if g)
+        account_fees: List[Charge] = []
+        account_payments: List[Charge] = []
+        if fee_group and fee_group[0] == account:
+            account_fees = fee_group[1]
+            fee_group = next(fee_groups, None)
+        if payment_group and payment_group[0] == account:
+            account_payments = payment_group[1]
+            payment_group = next(payment_groups, None)
+        yield account, account_fees, account_payments
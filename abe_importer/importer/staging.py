@@ -0,0 +1,95 @@
+"""Copying abe into a staging schema of pycroft, for translations written in SQL
+
+Translations which are plain joins don't need the ORM.  Their SQL variant
+(registered with ``reg.variant(func, SQL_ENGINE)``) copies the abe rows it
+reads into :data:`STAGING_SCHEMA` of the pycroft database with ``COPY``,
+and translates them there with ``INSERT … SELECT``.  Those statements refer
+to the ids of flushed objects, so they run as deferred writes, and the
+staging schema is dropped again in the same transaction.
+"""
+import tempfile
+from typing import Any, Dict, Iterable, List
+
+from sqlalchemy import Column, MetaData, Numeric, String, Table
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+from sqlalchemy.types import TypeDecorator, TypeEngine
+
+SQL_ENGINE = 'sql'
+STAGING_SCHEMA = 'abe_staging'
+# the copied rows are kept in memory up to this size and spill into a temporary file beyond
+COPY_BUFFER_SIZE = 64 * 2 ** 20
+STAGING_BATCH_SIZE = 10000
+
+
+def storage_type(type_: TypeEngine) -> TypeEngine:
+    """Return the type a staging column stores values of `type_` as
+
+    The declared precision of numbers and the length of (padded) strings
+    are left out, the staging tables only have to hold what has been read.
+    """
+    if isinstance(type_, TypeDecorator):
+        type_ = type_.impl
+    if isinstance(type_, Numeric):
+        return Numeric(asdecimal=type_.asdecimal)
+    if isinstance(type_, String):
+        return String()
+    return type_
+
+
+def staging_table(name: str, columns: Iterable[Column]) -> Table:
+    """Return an unlogged table of the staging schema with the names and types of `columns`"""
+    return Table(name, MetaData(),
+                 *(Column(c.name, storage_type(c.type)) for c in columns),
+                 schema=STAGING_SCHEMA, prefixes=['UNLOGGED'])
+
+
+def create_staging_table(connection: Connection, table: Table):
+    connection.execute(f"CREATE SCHEMA IF NOT EXISTS {STAGING_SCHEMA}")
+    table.drop(connection, checkfirst=True)
+    table.create(connection)
+
+
+def literal_sql(query: Select) -> str:
+    """Compile `query` with its parameters inlined, as ``COPY`` takes no parameters"""
+    return str(query.compile(dialect=postgresql.dialect(),
+                             compile_kwargs={'literal_binds': True}))
+
+
+def stage_query(abe_session: Session, pycroft_session: Session, name: str, query: Select) \
+        -> Table:
+    """Copy the rows of `query` in abe into the staging table `name` of pycroft"""
+    table = staging_table(name, query.c)
+    connection = pycroft_session.connection()
+    create_staging_table(connection, table)
+    with tempfile.SpooledTemporaryFile(max_size=COPY_BUFFER_SIZE) as buffer:
+        with abe_session.connection().connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY ({literal_sql(query)}) TO STDOUT", buffer)
+        buffer.seek(0)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table.fullname} FROM STDIN", buffer)
+    return table
+
+
+def stage_rows(session: Session, name: str, columns: List[Column],
+               rows: List[Dict[str, Any]]) -> Table:
+    """Insert `rows` computed in python into the staging table `name`"""
+    table = staging_table(name, columns)
+    create_staging_table(session.connection(), table)
+    for start in range(0, len(rows), STAGING_BATCH_SIZE):
+        session.execute(table.insert(), rows[start:start + STAGING_BATCH_SIZE])
+    return table
+
+
+def stage_select(session: Session, name: str, query: Select) -> Table:
+    """Insert the rows of `query` in pycroft into the staging table `name`"""
+    table = staging_table(name, query.c)
+    create_staging_table(session.connection(), table)
+    session.execute(table.insert().from_select(list(query.c.keys()), query))
+    return table
+
+
+def drop_staging(session: Session):
+    session.execute(f"DROP SCHEMA IF EXISTS {STAGING_SCHEMA} CASCADE")
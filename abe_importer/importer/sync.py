@@ -0,0 +1,168 @@
+"""Catching up with the changes in abe until the cutover
+
+Every cycle fingerprints the rows of each abe account (see
+:func:`account_fingerprints`), and imports the accounts whose fingerprint
+changed since the previous cycle in upsert mode, restricted to them by a
+sampled :class:`Scope`.  The first cycle has nothing to compare with and
+upserts everything, like a rerun of the importer.
+
+Accounts deleted from abe are only counted, since upserts never delete.
+"""
+import hashlib
+import time
+from dataclasses import dataclass, field
+from logging import Logger
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+from . import do_import
+from .scope import Scope
+from .. import model as abe_model
+from ..logging import NO_AGGREGATION
+from ..session import SnapshotSessions
+
+Fingerprints = Dict[str, str]
+
+
+def _fingerprinted_queries() -> List[Select]:
+    """Return the queries whose rows make up the fingerprints, the account being the first column"""
+    account, prop = abe_model.Account.__table__, abe_model.AccountProperty.__table__
+    ldap = abe_model.LdapEntry.__table__
+    mac, ip = abe_model.Mac.__table__, abe_model.Ip.__table__
+    record = abe_model.DisableRecord.__table__
+    fee_rel = abe_model.AccountFeeRelation.__table__
+    log = abe_model.AccountStatementLog.__table__
+
+    def rows(*columns) -> Select:
+        return select(columns).where(columns[0] != None).order_by(*columns)
+
+    def summary(account_column, id_column) -> Select:
+        # new fees and statements are recognized by their number and the highest id
+        return select([account_column, func.count(), func.max(id_column)]) \
+            .where(account_column != None) \
+            .group_by(account_column)
+
+    return [
+        rows(*account.c),
+        rows(*prop.c),
+        rows(*ldap.c),
+        rows(mac.c.account, mac.c.mac, mac.c.active),
+        rows(ip.c.account, ip.c.ip),
+        rows(record.c.account, *(c for c in record.c if c is not record.c.account)),
+        summary(fee_rel.c.account, fee_rel.c.fee),
+        summary(log.c.account, log.c.id),
+    ]
+
+
+def account_fingerprints(session: Session, snapshot: Optional[SnapshotSessions] = None) \
+        -> Tuple[Fingerprints, Fingerprints]:
+    """Return a hash of the rows of every account, and of the statements of deleted accounts
+
+    Fees and statements are only summarized by the database, so this reads
+    a few rows per account.  With a `snapshot`, the queries run in parallel
+    on its workers instead of one after the other in `session`.
+    """
+    log = abe_model.AccountStatementLog.__table__
+    deleted_query = select([log.c.name, func.count(), func.max(log.c.id)]) \
+        .where(log.c.account == None).where(log.c.name != None) \
+        .group_by(log.c.name)
+    queries = [*_fingerprinted_queries(), deleted_query]
+    if snapshot:
+        results = snapshot.map(lambda s, query: s.execute(query).fetchall(), queries)
+    else:
+        results = [session.execute(query).fetchall() for query in queries]
+    *account_results, deleted_rows = results
+
+    digests: Dict[str, Any] = {}
+    for rows in account_results:
+        for row in rows:
+            digest = digests.setdefault(row[0], hashlib.md5())
+            digest.update(repr(tuple(row)).encode('utf-8'))
+    deleted = {name: f"{num}:{max_id}" for name, num, max_id in deleted_rows}
+    return {account: digest.hexdigest() for account, digest in digests.items()}, deleted
+
+
+def changed_keys(previous: Fingerprints, current: Fingerprints) -> Set[str]:
+    """Return the keys which are new or have a different fingerprint"""
+    return {key for key, fingerprint in current.items() if previous.get(key) != fingerprint}
+
+
+@dataclass
+class CycleStats:
+    changed_accounts: int = 0
+    changed_deleted_accounts: int = 0
+    vanished_accounts: int = 0
+    new_objects: int = 0
+    deferred_rows: int = 0
+    seconds: float = 0.
+
+    def log(self, logger: Logger, cycle: int):
+        logger.info("Cycle %d: %d changed accounts, %d deleted accounts with new statements,"
+                    " %d vanished accounts → %d new objects, %d rows written in %.1fs",
+                    cycle, self.changed_accounts, self.changed_deleted_accounts,
+                    self.vanished_accounts, self.new_objects, self.deferred_rows, self.seconds,
+                    extra=NO_AGGREGATION)
+
+
+@dataclass
+class Synchronizer:
+    """Imports the accounts changed in abe since the previous :meth:`cycle`"""
+    abe_session: Session
+    pycroft_session: Session
+    logger: Logger
+    # number of connections reading the fingerprints from one snapshot, 0 reads them in sequence
+    readers: int = 0
+    fingerprints: Optional[Fingerprints] = None
+    deleted_fingerprints: Fingerprints = field(default_factory=dict)
+
+    def cycle(self) -> CycleStats:
+        start = time.perf_counter()
+        # start a new transaction, so that the rows changed meanwhile are visible
+        self.abe_session.rollback()
+        self.abe_session.expunge_all()
+        if self.readers:
+            # the import itself reads later, but what changes meanwhile is seen again next cycle
+            with SnapshotSessions(self.abe_session.get_bind(), self.readers) as snapshot:
+                fingerprints, deleted = account_fingerprints(self.abe_session, snapshot)
+        else:
+            fingerprints, deleted = account_fingerprints(self.abe_session)
+
+        stats = CycleStats()
+        if self.fingerprints is None:
+            scope = Scope()
+            stats.changed_accounts = len(fingerprints)
+            stats.changed_deleted_accounts = len(deleted)
+        else:
+            accounts = changed_keys(self.fingerprints, fingerprints)
+            deleted_accounts = changed_keys(self.deleted_fingerprints, deleted)
+            scope = Scope(sampled_accounts=frozenset(accounts),
+                          sampled_deleted_accounts=frozenset(deleted_accounts))
+            stats.changed_accounts = len(accounts)
+            stats.changed_deleted_accounts = len(deleted_accounts)
+            # upserts never delete, so these stay in pycroft
+            stats.vanished_accounts = len(self.fingerprints.keys() - fingerprints.keys())
+
+        if self.fingerprints is None or stats.changed_accounts or stats.changed_deleted_accounts:
+            stats.new_objects, stats.deferred_rows = self.apply(scope)
+        # only remembered once committed, so that a failed cycle is repeated
+        self.fingerprints, self.deleted_fingerprints = fingerprints, deleted
+        stats.seconds = time.perf_counter() - start
+        return stats
+
+    def apply(self, scope: Scope) -> Tuple[int, int]:
+        try:
+            # the traffic history isn't upserted, so it is left to the full import
+            objs = do_import(self.abe_session, self.pycroft_session, self.logger, upsert=True,
+                             scope=scope)
+            self.pycroft_session.add_all(objs)
+            deferred_rows = objs.run_deferred(self.pycroft_session)
+            self.pycroft_session.commit()
+        except BaseException:
+            self.pycroft_session.rollback()
+            raise
+        finally:
+            self.pycroft_session.expunge_all()
+        return len(objs), deferred_rows
@@ -42,12 +42,16 @@ class DependencyError(Exception):
 FuncType = TypeVar('FuncType', bound=Callable)
 MetaType = TypeVar('MetaType')
 
+# the engine of the registered translation functions themselves
+DEFAULT_ENGINE = 'orm'
+
 
 class TranslationRegistry(Generic[FuncType, MetaType]):
     # TODO sort by resource dependencies instead of pycroft model?
     _provides: Dict[MetaType, FuncType] = {}
     _satisfies: Dict[FuncType, set] = collections.defaultdict(lambda: set())
     _requires: Dict[FuncType, set] = collections.defaultdict(lambda: set())
+    _variants: Dict[FuncType, Dict[str, FuncType]] = collections.defaultdict(dict)
 
     def requires_function(self, *other_funcs) -> Callable[[FuncType], FuncType]:
         """Explicit dependence other functions"""
@@ -97,6 +101,31 @@ class TranslationRegistry(Generic[FuncType, MetaType]):
             return func
         return decorator
 
+    def variant(self, func: FuncType, engine: str) -> Callable[[FuncType], FuncType]:
+        """Register the decorated function as implementation of `func` on `engine`
+
+        The variant takes the place of `func` when `engine` is chosen for
+        it (see :meth:`implementation`), so it has to provide the same
+        things.  Its dependencies are those registered for `func`.
+        """
+        def decorator(variant: FuncType):
+            self._variants[func][engine] = variant
+            return variant
+        return decorator
+
+    def engines(self) -> Dict[str, Set[str]]:
+        """Return the names of the functions and the engines they can run on"""
+        return {func.__name__: {DEFAULT_ENGINE, *self._variants.get(func, {})}
+                for func in set(self._provides.values())}
+
+    def implementation(self, func: FuncType, engine: str = DEFAULT_ENGINE) -> FuncType:
+        if engine == DEFAULT_ENGINE:
+            return func
+        try:
+            return self._variants.get(func, {})[engine]
+        except KeyError:
+            raise DependencyError(f"{func.__name__} can't run on the engine {engine!r}")
+
     def _required_translations(self, func: FuncType) -> Set[FuncType]:
         translates = invert_dict(self._provides)[func]
         required = set()
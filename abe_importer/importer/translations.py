@@ -1,8 +1,10 @@
 import ipaddress
 import re
-from datetime import timezone
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from itertools import groupby
 from logging import Logger
-from typing import List, Optional, Iterable, Tuple
+from typing import Any, Dict, List, Optional, Iterable, Iterator, Tuple
 
 import ipaddr
 from pycroft.helpers import interval
@@ -10,18 +12,49 @@ from pycroft.helpers.i18n import deferred_gettext
 from pycroft.model import _all as pycroft_model
 from pycroft.model.host import MulticastFlagException
 from pycroft import lib as pycroft_lib
-from sqlalchemy import select, func
+from sqlalchemy import select, func, inspect as sqlalchemy_inspect, case, cast, exists, literal, \
+    union_all, Column, Date, Integer, String
+from sqlalchemy.orm import Session, joinedload
 
+from .address_plan import SubnetIndex, SubnetRange, validate_address_plan
 from .context import reg, IntermediateData, Context
+from .ip_history import collapse_observations, observations_after
+from .paging import StreamedQuery
+from .progress import format_duration
+from .reconciliation import abe_balances, compare_balances, log_mismatches, pycroft_balances
+from .settlement import Charge, allocate_fifo, merge_by_account
+from .staging import SQL_ENGINE, drop_staging, stage_query, stage_rows, stage_select
 from .membership import MEMBERSHIP_FEE_PATTERN, get_latest_month, MEMBERSHIP_FEE_PREFIX, FeeMonth, \
-    descriptions_to_interval_set
+    descriptions_to_interval_set, MembershipSpan, merge_spans
 from .. import model as abe_model
+from ..legacy_model import IpLogInterval, create_legacy_tables, AccountMapping, AccessMapping, \
+    SwitchMapping, StatementMapping, FeeSettlement
+from .upsert import natural_key, utc, update_changed
 from ..model import DisableEnum
 
 
+natural_key(pycroft_model.Site, lambda s: s.name)
+natural_key(pycroft_model.Building, lambda b: b.short_name)
+natural_key(pycroft_model.Address, lambda a: (a.street, a.number, a.addition, a.zip_code))
+natural_key(pycroft_model.Room, lambda r: (r.building.short_name, r.level, r.number),
+            options=(joinedload(pycroft_model.Room.building),))
+natural_key(pycroft_model.Switch, lambda s: s.host.name,
+            options=(joinedload(pycroft_model.Switch.host),))
+natural_key(pycroft_model.SwitchPort, lambda p: (p.switch.host.name, p.name),
+            options=(joinedload(pycroft_model.SwitchPort.switch)
+                     .joinedload(pycroft_model.Switch.host),))
+natural_key(pycroft_model.PatchPort,
+            lambda p: (p.room.building.short_name, p.room.level, p.room.number, p.name),
+            options=(joinedload(pycroft_model.PatchPort.room)
+                     .joinedload(pycroft_model.Room.building),))
+natural_key(pycroft_model.RoomLogEntry, lambda e: e.message,
+            criterion=(pycroft_model.RoomLogEntry.message.like(
+                "Room imported from legacy database abe.%"),))
+
+
 @reg.provides(pycroft_model.Site)
-def add_sites(_, data: IntermediateData):
-    site = pycroft_model.Site(name="Hochschulstraße")
+def add_sites(ctx: Context, data: IntermediateData):
+    site, _ = ctx.upsert(pycroft_model.Site, "Hochschulstraße", name="Hochschulstraße")
     data.hss_site = site
     return [site]
 
@@ -41,13 +74,20 @@ FEE_ACCOUNT_ID = 19
 def translate_building(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
     objs = []
 
-    hss = pycroft_model.Site(name="Hochschulstraße")
+    hss, _ = ctx.upsert(pycroft_model.Site, "Hochschulstraße", name="Hochschulstraße")
     objs.append(hss)
 
-    buildings: List[abe_model.Building] = ctx.query(abe_model.Building).all()
-    for b in buildings:
-        ctx.logger.debug(f"got building {b.short_name!r}")
-        new_building = pycroft_model.Building(
+    with ctx.reading_abe():
+        buildings: List[abe_model.Building] = ctx.query(abe_model.Building).all()
+    if ctx.scope.partitioned:
+        unknown = ctx.scope.buildings - {b.short_name for b in buildings}
+        if unknown:
+            ctx.logger.critical("Unknown buildings selected: %s", ", ".join(sorted(unknown)))
+            raise ImportException
+    for b in ctx.progress.track(buildings, what="buildings"):
+        ctx.logger.debug("got building %r", b.short_name)
+        new_building, _ = ctx.upsert(
+            pycroft_model.Building, b.short_name,
             short_name=b.short_name,
             street=b.street,
             number=b.number,
@@ -78,21 +118,23 @@ def maybe_existing_address(address: pycroft_model.Address, objs: List[pycroft_mo
 def translate_switch(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
     objs = []
 
-    switches: List[abe_model.Switch] = ctx.query(abe_model.Switch).all()
+    with ctx.reading_abe():
+        switches: List[abe_model.Switch] = ctx.query(abe_model.Switch).all()
 
-    for s in switches:
-        ctx.logger.debug(f"got switch {s.name!r}")
+    for s in ctx.progress.track(switches, what="switches"):
+        ctx.logger.debug("got switch %r", s.name)
 
         try:
             building = data.buildings[s.building]
         except KeyError:
-            ctx.logger.error(f"switch {s.name!r} references nonextistent building {s.building!r}")
+            ctx.logger.error("switch %r references nonextistent building %r", s.name, s.building)
             continue
         address = maybe_existing_address(
-            address_from_building(s.building_rel, s.level, s.room_number + "_datenraum"),
+            address_from_building(ctx, s.building_rel, s.level, s.room_number + "_datenraum"),
             objs
         )
-        room = pycroft_model.Room(
+        room, _ = ctx.upsert(
+            pycroft_model.Room, (building.short_name, s.level, s.room_number),
             building=building,
             level=s.level,
             number=s.room_number,
@@ -101,14 +143,20 @@ def translate_switch(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
         )
         objs.append(room)
 
-        host = pycroft_model.Host(
-            name=s.name,
-            room=room,
-            owner_id=ROOT_ID,
-        )
+        existing_switch = ctx.lookup(pycroft_model.Switch, s.name)
+        if existing_switch:
+            host = existing_switch.host
+            host.room = room
+        else:
+            host = pycroft_model.Host(
+                name=s.name,
+                room=room,
+                owner_id=ROOT_ID,
+            )
         objs.append(host)
 
-        switch = pycroft_model.Switch(
+        switch, _ = ctx.upsert(
+            pycroft_model.Switch, s.name,
             host=host,
             management_ip=s.mgmt_ip,
         )
@@ -118,7 +166,7 @@ def translate_switch(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
     return objs
 
 
-def try_create_switch_port(access: abe_model.Access, data, logger: Logger) \
+def try_create_switch_port(access: abe_model.Access, ctx: Context, data) \
         -> Optional[pycroft_model.SwitchPort]:
     if not access.port:
         return None
@@ -126,29 +174,35 @@ def try_create_switch_port(access: abe_model.Access, data, logger: Logger) \
     try:
         switch = data.switches[access.switch]
     except KeyError:
-        logger.critical("Could not find switch %r in intermediate data", access.switch)
+        ctx.logger.critical("Could not find switch %r in intermediate data", access.switch)
         raise
         # TODO add an `ImporterError` (here: `InconsistencyError`) for nicer reporting
 
-    return pycroft_model.SwitchPort(
+    switch_port, _ = ctx.upsert(
+        pycroft_model.SwitchPort, (access.switch, access.port),
         switch=switch,
         name=access.port,
         # TODO add default_vlans
     )
+    return switch_port
 
 
-def address_from_building(building: abe_model.Building,
+def address_from_building(ctx: Context,
+                          building: abe_model.Building,
                           level: int,
                           room_number: str) -> pycroft_model.Address:
-    return pycroft_model.Address(
+    addition = f"{level}-{room_number}"
+    address, _ = ctx.upsert(
+        pycroft_model.Address, (building.street, building.number, addition, building.zip_code),
         street=building.street,
         number=building.number,
         zip_code=building.zip_code,
-        addition=f"{level}-{room_number}"
+        addition=addition,
     )
+    return address
 
 
-def try_create_room(access: abe_model.Access, data, logger: Logger) \
+def try_create_room(access: abe_model.Access, ctx: Context, data) \
         -> Optional[pycroft_model.Room]:
     if not access.building:
         return None
@@ -156,20 +210,21 @@ def try_create_room(access: abe_model.Access, data, logger: Logger) \
     try:
         pycroft_building = data.buildings[access.building.short_name]
     except KeyError:
-        logger.error("Could not find building data for shortname %s",
-                     access.building.short_name)
+        ctx.logger.error("Could not find building data for shortname %s",
+                         access.building.short_name)
         raise
 
     # consolidate nomecnlature
     try:
         level = int(access.floor)
     except ValueError:
-        logger.warning("access with non-integer floor: %r", access)
+        ctx.logger.warning("access with non-integer floor: %r", access)
         return None
 
     room_number = f"{access.flat}{access.room}"
-    address = address_from_building(access.building, level, room_number)
-    room = pycroft_model.Room(
+    address = address_from_building(ctx, access.building, level, room_number)
+    room, _ = ctx.upsert(
+        pycroft_model.Room, (access.building.short_name, level, room_number),
         building=pycroft_building,
         inhabitable=True,
         level=level,
@@ -180,17 +235,21 @@ def try_create_room(access: abe_model.Access, data, logger: Logger) \
 
 
 def try_create_patch_port(room: pycroft_model.Room, access: abe_model.Access,
-                          data: IntermediateData,
-                          logger: Logger) -> Optional[pycroft_model.PatchPort]:
+                          ctx: Context,
+                          data: IntermediateData) -> Optional[pycroft_model.PatchPort]:
     if not access.switch:
-        logger.warning(f"Access {access.id} ({room.short_name}) has no switch! "
-                       f"You may need to create the PatchPort manually.")
+        ctx.logger.warning("Access %s (%s) has no switch! "
+                           "You may need to create the PatchPort manually.",
+                           access.id, room.short_name)
         return None
-    return pycroft_model.PatchPort(
+    name = "??"  # ({room.short_name}) cannot be appended due to 8 char limit.
+    patch_port, _ = ctx.upsert(
+        pycroft_model.PatchPort, (room.building.short_name, room.level, room.number, name),
         room=room,
         switch_room=data.switches[access.switch].host.room,
-        name=f"??"  # ({room.short_name}) cannot be appended due to 8 char limit.
+        name=name,
     )
+    return patch_port
 
 
 # We don't need to translate the external addresses, because the referenced accounts
@@ -199,30 +258,32 @@ def try_create_patch_port(room: pycroft_model.Room, access: abe_model.Access,
 @reg.provides(pycroft_model.Room)
 def translate_locations(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
     objs = translate_switch(ctx, data)
-    accesses: List[abe_model.Access] = ctx.query(abe_model.Access).all()
+    with ctx.reading_abe():
+        accesses: List[abe_model.Access] = ctx.query(abe_model.Access) \
+            .filter(*ctx.scope.accesses()).all()
 
     errors = 0
     unpatched_ports = 0
     unpatched_rooms = 0
 
-    for access in accesses:
+    for access in ctx.progress.track(accesses, what="accesses"):
         # null if access.switch_port is null -> it MAY be that we have a `switch`!
-        switch_port = try_create_switch_port(access, data, ctx.logger)
-        room = try_create_room(access, data, ctx.logger)
+        switch_port = try_create_switch_port(access, ctx, data)
+        room = try_create_room(access, ctx, data)
         objs.extend(x for x in [switch_port, room] if x)
 
         if room and not switch_port:
             if not access.switch:
-                ctx.logger.warning(f"Access {access.id} has on switch!")
-            ctx.logger.debug(f"Unpatched room {room.short_name}")
+                ctx.logger.warning("Access %s has on switch!", access.id)
+            ctx.logger.debug("Unpatched room %s", room.short_name)
             unpatched_rooms += 1
             continue
         if not room and switch_port:
-            ctx.logger.debug(f"Unpatched port {switch_port.switch.host.name}/{access.port}")
+            ctx.logger.debug("Unpatched port %s/%s", switch_port.switch.host.name, access.port)
             unpatched_ports += 1
             continue
         if not room and not switch_port:
-            ctx.logger.critical(f"Access {access.id} references neither room nor switch!")
+            ctx.logger.critical("Access %s references neither room nor switch!", access.id)
             errors += 1
             continue
 
@@ -230,24 +291,30 @@ def translate_locations(ctx: Context, data: IntermediateData) -> List[PycroftBas
         objs.extend([room, switch_port, room.address])
         data.access_rooms[access.id] = room  # necessary for adding the account
 
-        patch_port = try_create_patch_port(room, access, data, ctx.logger)
+        patch_port = try_create_patch_port(room, access, ctx, data)
         if not access.switch:
-            ctx.logger.warning(f"Access {access.id} has no switch!")
+            ctx.logger.warning("Access %s has no switch!", access.id)
             continue
 
         patch_port.switch_port = switch_port
         objs.append(patch_port)
 
-        objs.append(pycroft_model.RoomLogEntry(
-            message=f"Room imported from legacy database abe. Access-ID: {access.id}",
-            room=room,
-            author_id=ROOT_ID,
-        ))
+        message = f"Room imported from legacy database abe. Access-ID: {access.id}"
+        if not ctx.lookup(pycroft_model.RoomLogEntry, message):
+            objs.append(pycroft_model.RoomLogEntry(
+                message=message,
+                room=room,
+                author_id=ROOT_ID,
+            ))
 
-    ctx.logger.info(f"Got {unpatched_ports} unpatched ports"
-                    if unpatched_ports else "Kudos, all ports are patched!")
-    ctx.logger.info(f"Got {unpatched_rooms} unpatched rooms"
-                    if unpatched_rooms else "Kudos, all rooms are patched!")
+    if unpatched_ports:
+        ctx.logger.info("Got %d unpatched ports", unpatched_ports)
+    else:
+        ctx.logger.info("Kudos, all ports are patched!")
+    if unpatched_rooms:
+        ctx.logger.info("Got %d unpatched rooms", unpatched_rooms)
+    else:
+        ctx.logger.info("Kudos, all rooms are patched!")
 
     _maybe_abort(errors, ctx.logger)
     return objs
@@ -271,6 +338,17 @@ def uid_mapping(abe_uid: int) -> int:
     return abe_uid + 20000
 
 
+IMPORT_MESSAGE_PREFIX = "Imported from legacy database abe. Account: "
+IMPORTED_USERS = 'imported_users'
+
+natural_key(pycroft_model.UserLogEntry, lambda e: e.message, name=IMPORTED_USERS,
+            options=(joinedload(pycroft_model.UserLogEntry.user),),
+            criterion=(pycroft_model.UserLogEntry.message.like(f"{IMPORT_MESSAGE_PREFIX}%"),))
+natural_key(pycroft_model.UserLogEntry, lambda e: (e.user.login, e.message),
+            options=(joinedload(pycroft_model.UserLogEntry.user),),
+            criterion=(pycroft_model.UserLogEntry.author_id == ROOT_ID,))
+
+
 @reg.provides(pycroft_model.User)
 @reg.provides(pycroft_model.Account)
 @reg.provides(pycroft_model.UnixAccount)
@@ -279,15 +357,16 @@ def translate_accounts(ctx: Context, data: IntermediateData) -> List[PycroftBase
     objs = []
     num_errors = 0
     ctx.logger.info("There are %s accounts in total.",
-                    ctx.query(abe_model.Account).count())
+                    ctx.query(abe_model.Account).filter(*ctx.scope.accounts()).count())
     # 1. Accounts which do _not_ have a pycroft mapping
-    accounts_with_access: List[abe_model.Account] = (
+    accounts_with_access = ctx.paged(
         ctx.query(abe_model.Account)
            .filter_by(pycroft_login=None)
            .filter(abe_model.Account.access_id != None)
-           .all()
+           .filter(*ctx.scope.accounts()),
+        abe_model.Account.account,
     )
-    for acc in accounts_with_access:
+    for acc in ctx.progress.track(accounts_with_access, what="accounts"):
         try:
             room = data.access_rooms[acc.access_id]
         except KeyError as e:
@@ -308,6 +387,25 @@ def translate_accounts(ctx: Context, data: IntermediateData) -> List[PycroftBase
             ctx.logger.warning("Skipping WUMS!  Remove this warning once that's been cleared.")
             continue
 
+        import_message = f"{IMPORT_MESSAGE_PREFIX}{acc.account!r}"
+        import_entry = ctx.lookup(IMPORTED_USERS, import_message)
+        if import_entry:
+            # upsert mode: skip the renaming logic, it has been applied by the previous import
+            user = import_entry.user
+            ctx.logger.debug("Account %s has already been imported as %s", acc.account, user.login)
+            update_changed(
+                user,
+                room=room,
+                name=acc.name,
+                address=room.address,
+                birthdate=acc.date_of_birth,
+                email=maybe_fix_mail(props.mail, ctx.logger),
+            )
+            data.users[acc.account] = user
+            data.both_users[acc] = user
+            objs.append(user)
+            continue
+
         maybe_passwd_arg = {}
         unix_acc = None
         homedir_exists = False
@@ -379,7 +477,7 @@ def translate_accounts(ctx: Context, data: IntermediateData) -> List[PycroftBase
 
         objs.extend([user, finance_account, unix_acc])
         objs.append(pycroft_model.UserLogEntry(
-            message=f"Imported from legacy database abe. Account: {acc.account!r}",
+            message=import_message,
             user=user,
             author_id=ROOT_ID,
         ))
@@ -388,8 +486,13 @@ def translate_accounts(ctx: Context, data: IntermediateData) -> List[PycroftBase
 
     # 2. People who _do_ have a pycroft mapping
 
-    for acc in ctx.abe_session.query(abe_model.Account)\
-            .filter(abe_model.Account.pycroft_login != None):
+    mapped_accounts = ctx.paged(
+        ctx.query(abe_model.Account)
+           .filter(abe_model.Account.pycroft_login != None)
+           .filter(*ctx.scope.accounts()),
+        abe_model.Account.account,
+    )
+    for acc in ctx.progress.track(mapped_accounts, what="mapped accounts"):
         # TODO add to „manual intervention“ report
         pycroft_user = ctx.pycroft_session.query(pycroft_model.User) \
             .filter_by(login=acc.pycroft_login).one_or_none()
@@ -425,62 +528,282 @@ def is_pycroft_unixacc_obsolete(username: str, ctx: Context) -> Tuple[bool, pycr
     return not user.member_of(ctx.config.member_group) and not user.has_property('ldap'), user
 
 
+natural_key(pycroft_model.Interface, lambda i: str(i.mac).lower())
+
+
+def check_address_plan(ctx: Context, subnets: SubnetIndex):
+    """Report all problems with the abe IPs and MACs at once"""
+    with ctx.reading_abe():
+        macs = ctx.query(abe_model.Mac.account_name, abe_model.Mac.mac) \
+            .filter(*ctx.scope.of_accounts(abe_model.Mac.account)).all()
+        ips = ctx.query(abe_model.Ip.account_name, abe_model.Ip.ip) \
+            .filter(*ctx.scope.of_accounts(abe_model.Ip.account)).all()
+    validate_address_plan(macs, ips, subnets).log(ctx.logger)
+
+
 @reg.provides(pycroft_model.IP, pycroft_model.Interface, pycroft_model.Host)
 def translate_devices(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
+    subnets = SubnetIndex(
+        SubnetRange.of(net, s.reserved_addresses_bottom or 0, s.reserved_addresses_top or 0,
+                       subnet=s)
+        for net, s in data.subnets.items()
+    )
+    check_address_plan(ctx, subnets)
+
     objs = []
-    for (acc, user) in data.both_users.items():
-        objs.extend(_translate_account_devices(acc, user, ctx, data))
+    for (acc, user) in ctx.progress.track(data.both_users.items(), what="users"):
+        new_objects = _translate_account_devices(acc, user, ctx, subnets)
+        for ip in new_objects:
+            if isinstance(ip, pycroft_model.IP):
+                data.account_ips[acc.account] = ip  # necessary for the traffic history
+        objs.extend(new_objects)
     return objs
 
 
 def _translate_account_devices(acc: abe_model.Account, user: pycroft_model.User, ctx: Context,
-                               data: IntermediateData) -> List[PycroftBase]:
-    # TODO add Host/Interface(w/MAC)/IP:
-    # IF user has MAC
+                               subnets: SubnetIndex) -> List[PycroftBase]:
+    # problems with the addresses have already been reported by `check_address_plan`
     objs: List[PycroftBase] = []
     if len(acc.macs) > 1:
-        ctx.logger.warning("User %s has %d macs: %s. Choosing the first one.",
-                           acc.account, len(acc.macs), "/".join(acc.macs))
+        ctx.logger.debug("User %s has %d macs: %s. Choosing the first one.",
+                         acc.account, len(acc.macs), "/".join(str(m.mac) for m in acc.macs))
 
     if len(acc.ips) > 1:
-        ctx.logger.warning("User %s has %d ips: %s. Choosing the first one.",
-                           acc.account, len(acc.ips), "/".join(acc.ips))
+        ctx.logger.debug("User %s has %d ips: %s. Choosing the first one.",
+                         acc.account, len(acc.ips), "/".join(str(i.ip) for i in acc.ips))
     if acc.macs:
-        [mac] = acc.macs
+        mac = acc.macs[0]
 
         if not acc.ips:
-            objs.append(pycroft_model.UserLogEntry(
-                message=f"Unused MAC address from abe: {mac.mac}",
-                user=user,
-                author_id=ROOT_ID,
-            ))
+            message = f"Unused MAC address from abe: {mac.mac}"
+            if not ctx.lookup(pycroft_model.UserLogEntry, (user.login, message)):
+                objs.append(pycroft_model.UserLogEntry(
+                    message=message,
+                    user=user,
+                    author_id=ROOT_ID,
+                ))
+        elif ctx.lookup(pycroft_model.Interface, str(mac.mac).lower()):
+            ctx.logger.debug("Mac %s of user %s has already been imported", mac.mac, acc.account)
         else:
             ip = ipaddress.IPv4Address(acc.ips[0].ip)
-            host = pycroft_model.Host(owner=user, room=user.room)
+            subnet = subnets.find(int(ip))
+            if not subnet:
+                ctx.logger.debug("Skipping ip %s of user %s which is in no subnet",
+                                 ip, acc.account)
+                return objs
             try:
-                interface = pycroft_model.Interface(host=host, mac=mac.mac)
+                interface = pycroft_model.Interface(mac=mac.mac)
             except MulticastFlagException:
                 ctx.logger.error("Mac %s of user %s has multicast bit set!",
                                  mac.mac, acc.account)
-            else:
-                # TODO find subnet
-                # ip = pycroft_model.IP()
-                matching_subnets = [s for net, s in data.subnets.items()
-                                    if ip in net]
-                if not matching_subnets:
-                    ctx.logger.warning("User %s has ip %s which is in no subnet!",
-                                       acc.account, ip)
-                if len(matching_subnets) > 1:
-                    ctx.logger.error("IP %s in more than one subnet: %r", ip, matching_subnets)
-                ip = pycroft_model.IP(
-                    address=ipaddr.IPv4Address(str(ip)),
-                    interface=interface,
-                    subnet=matching_subnets[0],
-                )
-                objs.append(ip)
+                return objs
+            # only attached to the user now, since the backref would cascade them into the session
+            interface.host = pycroft_model.Host(owner=user, room=user.room)
+            ip = pycroft_model.IP(
+                address=ipaddr.IPv4Address(str(ip)),
+                interface=interface,
+                subnet=subnet.subnet,
+            )
+            objs.append(ip)
     return objs
 
 
+TRAFFIC_BATCH_SIZE = 10000
+
+
+@reg.provides(pycroft_model.TrafficVolume)
+def translate_traffic(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
+    """Schedule the import of the last `ctx.traffic_days` days of traffic
+
+    Traffic volumes refer to the ids of the IPs, and there are far too many
+    of them for the ORM, so they are inserted by a deferred write once the
+    other objects have been flushed.
+    """
+    if not ctx.traffic_days:
+        ctx.logger.info("Skipping the traffic history.")
+        return []
+
+    since = ctx.now.date() - timedelta(days=ctx.traffic_days)
+    ips = dict(data.account_ips)
+    data.deferred_writes.append(lambda session: write_traffic_volumes(ctx, session, since, ips))
+    ctx.logger.info("Traffic since %s of %d IPs is imported after flushing", since, len(ips))
+    return []
+
+
+def aggregate_traffic(rows: Iterable[Tuple]) -> Iterator[Tuple]:
+    """Sum up `(account, date, bytes_in, bytes_out, pkg_in, pkg_out)` rows sorted by account and date"""
+    for (account, day), group in groupby(rows, key=lambda row: (row[0], row[1])):
+        sums = [0, 0, 0, 0]
+        for row in group:
+            for i, value in enumerate(row[2:]):
+                sums[i] += value or 0
+        yield (account, day, *sums)
+
+
+def traffic_rows(ctx: Context, since: date) -> Iterator[Tuple]:
+    """Stream the `traffic_log` since `since` as rows for :func:`aggregate_traffic`"""
+    log = abe_model.TrafficLog
+    rows = StreamedQuery(
+        ctx.query(log.account_name, log.date, log.bytes_in, log.bytes_out, log.pkg_in, log.pkg_out,
+                  log.id)
+           .filter(log.date >= since)
+           .filter(*ctx.scope.of_accounts(log.account)),
+        # an account has several rows per day, the id makes them unique for resuming
+        (log.account_name, log.date, log.id),
+        page_size=TRAFFIC_BATCH_SIZE, stats=ctx.retry_stats, logger=ctx.logger,
+    )
+    return (row[:-1] for row in rows)
+
+
+def write_traffic_volumes(ctx: Context, session: Session, since: date,
+                          ips: Dict[str, pycroft_model.IP]) -> int:
+    """Stream the `traffic_log` since `since` into `session`, returning the rows written"""
+    rows = traffic_rows(ctx, since)
+    # the ids are known now
+    ip_ids = {account: (ip.id, ip.interface.host.owner.id) for account, ip in ips.items()}
+    table = pycroft_model.TrafficVolume.__table__
+
+    batch = []
+    num_rows = 0
+    skipped = 0
+    for account, day, bytes_in, bytes_out, pkg_in, pkg_out in ctx.progress.track(
+            aggregate_traffic(rows), what="traffic days"):
+        try:
+            ip_id, user_id = ip_ids[account]
+        except KeyError:
+            skipped += 1
+            continue
+        timestamp = datetime.combine(day, time(), tzinfo=timezone.utc)
+        batch.append(dict(type='Ingress', amount=bytes_in, packets=pkg_in, timestamp=timestamp,
+                          ip_id=ip_id, user_id=user_id))
+        batch.append(dict(type='Egress', amount=bytes_out, packets=pkg_out, timestamp=timestamp,
+                          ip_id=ip_id, user_id=user_id))
+        if len(batch) >= TRAFFIC_BATCH_SIZE:
+            session.execute(table.insert(), batch)
+            num_rows += len(batch)
+            batch.clear()
+    if batch:
+        session.execute(table.insert(), batch)
+        num_rows += len(batch)
+
+    if skipped:
+        ctx.logger.info("Skipped %d days of traffic of accounts without an imported IP", skipped)
+    ctx.logger.info("Wrote %d traffic volumes", num_rows)
+    return num_rows
+
+
+IP_LOG_BATCH_SIZE = 10000
+
+
+@reg.provides(IpLogInterval)
+def translate_ip_log(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
+    """Schedule the import of the `ip_log` as validity intervals
+
+    Like the traffic, this is a deferred write, because the intervals refer
+    to the ids of the users.
+    """
+    users = dict(data.users)
+    data.deferred_writes.append(lambda session: write_ip_log_intervals(ctx, session, users))
+    return []
+
+
+def write_ip_log_intervals(ctx: Context, session: Session,
+                           users: Dict[str, pycroft_model.User]) -> int:
+    log = abe_model.IpLog
+    rows = StreamedQuery(
+        ctx.query(log.ip_addr, log.account_name, log.timestamp, log.id)
+           # the intervals belong to an account, observations without one are left out
+           .filter(log.account_name != None)
+           .filter(*ctx.scope.of_accounts(log.account)),
+        (log.ip_addr, log.timestamp, log.id),
+        page_size=IP_LOG_BATCH_SIZE, stats=ctx.retry_stats, logger=ctx.logger,
+    )
+    user_ids = {account: user.id for account, user in users.items()}
+    create_legacy_tables(session.connection())
+    table = IpLogInterval.__table__
+    # a rerun or sync only adds what has been observed since the last interval of an account
+    imported_until = dict(
+        session.query(IpLogInterval.account, func.max(IpLogInterval.ends_at))
+               .group_by(IpLogInterval.account)
+    ) if ctx.existing is not None else {}
+    observations = observations_after(
+        ((ip, account, timestamp) for ip, account, timestamp, _ in rows), imported_until
+    )
+
+    batch = []
+    num_rows = 0
+    num_observations = 0
+    for span in collapse_observations(ctx.progress.track(observations, what="ip observations")):
+        num_observations += span.observations
+        batch.append(dict(ip=span.ip, account=span.account, user_id=user_ids.get(span.account),
+                          begins_at=span.begins_at, ends_at=span.ends_at,
+                          observations=span.observations))
+        if len(batch) >= IP_LOG_BATCH_SIZE:
+            session.execute(table.insert(), batch)
+            num_rows += len(batch)
+            batch.clear()
+    if batch:
+        session.execute(table.insert(), batch)
+        num_rows += len(batch)
+
+    ctx.logger.info("Collapsed %d ip_log observations into %d intervals",
+                    num_observations, num_rows)
+    return num_rows
+
+
+LEGACY_ID_BATCH_SIZE = 10000
+
+
+@reg.provides(AccountMapping, AccessMapping, SwitchMapping, StatementMapping)
+def translate_legacy_ids(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
+    """Schedule writing which pycroft object every abe account, access, switch and statement
+    has been imported as, so that later tools needn't match log messages
+
+    The mappings refer to the ids of the objects, so they are deferred writes.
+    """
+    mappings = [
+        (AccountMapping, dict(data.users)),
+        (AccessMapping, dict(data.access_rooms)),
+        (SwitchMapping, dict(data.switches)),
+        (StatementMapping, dict(data.statement_activities)),
+    ]
+    data.deferred_writes.append(lambda session: write_legacy_ids(ctx, session, mappings))
+    return []
+
+
+def write_legacy_ids(ctx: Context, session: Session,
+                     mappings: List[Tuple[type, Dict[Any, PycroftBase]]]) -> int:
+    """Insert the mappings which are new and replace those which changed"""
+    create_legacy_tables(session.connection())
+    num_rows = 0
+    for model, objects in mappings:
+        table = model.__table__
+        legacy_column, target_column = table.columns
+        existing = dict(session.execute(select([legacy_column, target_column])))
+        # objects which haven't been flushed (e.g. filtered out) have no identity
+        rows = {legacy_id: identity[0] for legacy_id, obj in objects.items()
+                if (identity := sqlalchemy_inspect(obj).identity)}
+        changed = [legacy_id for legacy_id, target_id in rows.items()
+                   if legacy_id in existing and existing[legacy_id] != target_id]
+        for start in range(0, len(changed), LEGACY_ID_BATCH_SIZE):
+            session.execute(table.delete().where(
+                legacy_column.in_(changed[start:start + LEGACY_ID_BATCH_SIZE])
+            ))
+        new = [{legacy_column.key: legacy_id, target_column.key: target_id}
+               for legacy_id, target_id in rows.items()
+               if existing.get(legacy_id) != target_id]
+        for start in range(0, len(new), LEGACY_ID_BATCH_SIZE):
+            session.execute(table.insert(), new[start:start + LEGACY_ID_BATCH_SIZE])
+        ctx.logger.debug("Mapped %d legacy ids in %s (%d new, %d changed)",
+                         len(rows), table.name, len(new) - len(changed), len(changed))
+        num_rows += len(new)
+    return num_rows
+
+
+natural_key(pycroft_model.Subnet, lambda s: str(s.address))
+natural_key(pycroft_model.VLAN, lambda v: (v.name, v.vid))
+
+
 @reg.provides(pycroft_model.Subnet, pycroft_model.VLAN)
 def translate_networks(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
     objs: List[PycroftBase] = []
@@ -494,13 +817,15 @@ def translate_networks(ctx: Context, data: IntermediateData) -> List[PycroftBase
         # …141.30.234.224/25 -> only used ip: 141.30.234.243
     ]:
 
-        subnet = pycroft_model.Subnet(
+        vlan, _ = ctx.upsert(pycroft_model.VLAN, (name, vid), name=name, vid=vid)
+        subnet, _ = ctx.upsert(
+            pycroft_model.Subnet, string_addr,
             address=ipaddr.IPv4Network(string_addr),
             gateway=gateway,
             reserved_addresses_bottom=reserved_bottom,
             reserved_addresses_top=0,
             description=name,
-            vlan=pycroft_model.VLAN(name=name, vid=vid),
+            vlan=vlan,
         )
         ctx.logger.info("Creating subnet '%s' (%s)", subnet.description, subnet.address)
         objs.append(subnet)
@@ -510,37 +835,100 @@ def translate_networks(ctx: Context, data: IntermediateData) -> List[PycroftBase
 
 
 RE_BEITRAG = r"Mitgliedsbeitrag 20\d\d-\d\d"
+HSS_IBAN = "DE40850503003120241937"
+
+natural_key(pycroft_model.BankAccount, lambda b: b.iban)
+# a member may pay the same fee twice on a day, so the time and payer belong to the key as well
+natural_key(pycroft_model.BankAccountActivity,
+            lambda a: (a.reference, utc(a.imported_at), a.amount, a.other_name))
+natural_key(pycroft_model.Account, lambda a: (a.name, a.type))
+
+
+def statement_key(log: abe_model.AccountStatementLog) -> Tuple:
+    """Return the natural key of the activity a statement is imported as"""
+    return log.purpose, utc(log.timestamp), log.amount, log.payer
+
+
+def mapped_activities(ctx: Context) -> Dict[int, pycroft_model.BankAccountActivity]:
+    """Return the activities the statements have been imported as by a previous import
+
+    Only imports since the legacy id mappings have written them, see
+    :func:`translate_legacy_ids`.
+    """
+    connection = ctx.pycroft_session.connection()
+    if ctx.existing is None \
+            or not connection.dialect.has_table(connection, StatementMapping.__tablename__):
+        return {}
+    return dict(
+        ctx.pycroft_session.query(StatementMapping.statement_id, pycroft_model.BankAccountActivity)
+           .join(pycroft_model.BankAccountActivity,
+                 pycroft_model.BankAccountActivity.id == StatementMapping.bank_account_activity_id)
+    )
 
 
 @reg.provides(pycroft_model.BankAccount, pycroft_model.BankAccountActivity)
 def translate_bank_statements(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
     objs = []
     num_errors = 0
-    hss_account = pycroft_model.Account(
-        name="Hochschulstraße",
-        type="BANK_ASSET",
-        legacy=False,
-    )
-    bank_account = pycroft_model.BankAccount(
-        name="HSS-Konto",
-        bank="Ostsächsische Sparkasse Dresden",
-        account_number="3120241937",
-        routing_number="85050300",
-        iban="DE40850503003120241937",
-        bic="OSDDDE81XXX",
-        fints_endpoint="https://banking-sn5.s-fints-pt-sn.de/fints30",
-        account=hss_account,
-    )
+    bank_account = ctx.lookup(pycroft_model.BankAccount, HSS_IBAN)
+    if bank_account:
+        hss_account = bank_account.account
+    else:
+        hss_account = pycroft_model.Account(
+            name="Hochschulstraße",
+            type="BANK_ASSET",
+            legacy=False,
+        )
+        bank_account = pycroft_model.BankAccount(
+            name="HSS-Konto",
+            bank="Ostsächsische Sparkasse Dresden",
+            account_number="3120241937",
+            routing_number="85050300",
+            iban=HSS_IBAN,
+            bic="OSDDDE81XXX",
+            fints_endpoint="https://banking-sn5.s-fints-pt-sn.de/fints30",
+            account=hss_account,
+        )
     objs.append(bank_account)
 
-    dead_memberships_account = pycroft_model.Account(
-        name="Mitgliedsbeiträge gelöschter Abe-Accounts",
+    dead_memberships_name = "Mitgliedsbeiträge gelöschter Abe-Accounts"
+    dead_memberships_account, _ = ctx.upsert(
+        pycroft_model.Account, (dead_memberships_name, "REVENUE"),
+        name=dead_memberships_name,
         type="REVENUE",
     )
     objs.append(dead_memberships_account)
 
-    for log in ctx.abe_session.query(abe_model.AccountStatementLog).all():
+    logs = ctx.paged(
+        ctx.query(abe_model.AccountStatementLog).filter(*ctx.scope.statements()),
+        abe_model.AccountStatementLog.id,
+    )
+    mapped = mapped_activities(ctx)
+    # natural key → id of the first statement with it
+    seen_keys: Dict[Tuple, int] = {}
+    # ids of the existing activities claimed by a statement
+    claimed = {activity.id for activity in mapped.values()}
+    for log in ctx.progress.track(logs, what="statements"):
         assert isinstance(log, abe_model.AccountStatementLog)
+        key = statement_key(log)
+        if key in seen_keys:
+            ctx.logger.warning("Statement %d has the same purpose, time, amount and payer as"
+                               " statement %d, an upsert can only tell them apart by the legacy"
+                               " id mapping", log.id, seen_keys[key])
+        else:
+            seen_keys[key] = log.id
+        existing = mapped.get(log.id)
+        if existing is None:
+            existing = ctx.lookup(pycroft_model.BankAccountActivity, key)
+            if existing is not None and existing.id in claimed:
+                ctx.logger.warning("Statement %d matches the activity %d imported for another"
+                                   " statement, leaving it out", log.id, existing.id)
+                continue
+        if existing:
+            # the transaction has been imported together with the activity
+            claimed.add(existing.id)
+            data.statement_activities[log.id] = existing
+            continue
         activity = pycroft_model.BankAccountActivity(
             bank_account=bank_account,
             amount=log.amount,
@@ -557,6 +945,7 @@ def translate_bank_statements(ctx: Context, data: IntermediateData) -> List[Pycr
             # split = relationship(Split, foreign_keys=(transaction_id, account_id),
         )
         objs.append(activity)
+        data.statement_activities[log.id] = activity
         if log.account:
             user = data.users.get(log.account_name)
             user_account = user.account
@@ -579,8 +968,10 @@ def translate_bank_statements(ctx: Context, data: IntermediateData) -> List[Pycr
         if log.name:
             account = data.deleted_finance_accounts.get(log.name)
             if not account:
-                account = pycroft_model.Account(
-                    name=f"Account of deleted HSS user {log.name}",
+                account_name = f"Account of deleted HSS user {log.name}"
+                account, _ = ctx.upsert(
+                    pycroft_model.Account, (account_name, "USER_ASSET"),
+                    name=account_name,
                     type="USER_ASSET",
                 )
                 data.deleted_finance_accounts[log.name] = account
@@ -628,6 +1019,13 @@ def create_user_transaction(log, user_account, hss_account, activity):
 ALLOWANCE_ACCOUNT_ID = 356
 CORRECTION_ACCOUNT_ID = 156
 
+# the split against the user's account identifies an imported fee
+natural_key(pycroft_model.Split,
+            lambda s: (s.transaction.description, s.transaction.valid_on, s.account.name, s.amount),
+            options=(joinedload(pycroft_model.Split.transaction),
+                     joinedload(pycroft_model.Split.account)),
+            criterion=(pycroft_model.Split.transaction.has(author_id=ROOT_ID),))
+
 
 @reg.requires_function(translate_bank_statements)
 @reg.provides(pycroft_model.Transaction, pycroft_model.Split, pycroft_model.BankAccountActivity)
@@ -638,7 +1036,11 @@ def translate_fees(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
     membership_account = ctx.pycroft_session.query(pycroft_model.Config).one().membership_fee_account
     allowance_account = ctx.pycroft_session.query(pycroft_model.Account).get(ALLOWANCE_ACCOUNT_ID)
 
-    for fee_rel in ctx.abe_session.query(abe_model.AccountFeeRelation).all():
+    fee_rels = ctx.paged(
+        ctx.query(abe_model.AccountFeeRelation).filter(*ctx.scope.fees()),
+        abe_model.AccountFeeRelation.fee_id, abe_model.AccountFeeRelation.account_name,
+    )
+    for fee_rel in ctx.progress.track(fee_rels, what="fees"):
         assert isinstance(fee_rel, abe_model.AccountFeeRelation)
         try:
             pycroft_user = data.users[fee_rel.account_name]
@@ -647,17 +1049,22 @@ def translate_fees(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
             continue
 
         is_membership_fee = fee_rel.fee.description.startswith("Mitgliedsbeitrag")
-
         if is_membership_fee:
             fee_timestamp = fee_rel.fee.timestamp
+            if fee_rel.account_name not in data.membership_months:
+                data.membership_months[fee_rel.account_name] = []
+            data.membership_months[fee_rel.account_name].append(fee_timestamp)
+
+        if ctx.lookup(pycroft_model.Split, (fee_rel.fee.description, fee_rel.fee.timestamp.date(),
+                                            pycroft_user.account.name, fee_rel.fee.amount)):
+            continue
+
+        if is_membership_fee:
             transaction = create_membership_fee_transaction(
                 fee_rel, fee_rel.fee.amount,
                 pycroft_user.account, membership_account
             )
             objs.append(transaction)
-            if fee_rel.account_name not in data.membership_months:
-                data.membership_months[fee_rel.account_name] = []
-            data.membership_months[fee_rel.account_name].append(fee_timestamp)
             continue
 
         is_allowance = fee_rel.fee.description.startswith("Aufwandsentsch")
@@ -683,12 +1090,186 @@ def translate_fees(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
         )
         objs.append(transaction)
 
-    # TODO warn on balance mismatch (abe-proclaimed vs actual)
+    # the pycroft balances are only known once the splits have been flushed
+    users = dict(data.users)
+    data.deferred_checks.append(lambda session: reconcile_balances(ctx, session, users))
 
     _maybe_abort(num_errors, ctx.logger)
     return objs
 
 
+def reconcile_balances(ctx: Context, session: Session, users: Dict[str, pycroft_model.User]) -> int:
+    """Warn about accounts whose abe balance differs from the imported one"""
+    with ctx.progress.stage("reconcile_balances") as stage:
+        abe = abe_balances(ctx.abe_session, ctx.scope)
+        pycroft = pycroft_balances(session, {account: users[account].account.id
+                                             for account in abe if account in users})
+        log_mismatches(compare_balances(abe, pycroft), len(pycroft), ctx.logger)
+        stage.rows = len(pycroft)
+    ctx.logger.info("Reconciled the balances in %s", format_duration(stage.seconds))
+    return 0
+
+
+@reg.variant(translate_fees, SQL_ENGINE)
+def translate_fees_in_sql(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
+    """Schedule the transactions of :func:`translate_fees` as ``INSERT … SELECT``
+
+    The fees are copied into the staging schema instead of passing the ORM.
+    `data.membership_months` is not collected.
+    """
+    membership_account = ctx.pycroft_session.query(pycroft_model.Config).one().membership_fee_account
+    users = dict(data.users)
+    data.deferred_writes.append(
+        lambda session: write_fees_in_sql(ctx, session, users, membership_account.id)
+    )
+    # the fees only exist once written, so unlike the check of `translate_fees`,
+    # this doesn't run in a dry run
+    data.deferred_writes.append(lambda session: reconcile_balances(ctx, session, users))
+    return []
+
+
+def write_fees_in_sql(ctx: Context, session: Session, users: Dict[str, pycroft_model.User],
+                      membership_account_id: int) -> int:
+    rel, fee = abe_model.AccountFeeRelation, abe_model.FeeInfo
+    transaction, split = pycroft_model.Transaction.__table__, pycroft_model.Split.__table__
+    with ctx.progress.stage("write_fees_in_sql") as stage:
+        fees = stage_query(ctx.abe_session, session, 'fees', (
+            ctx.query(rel.account_name.label('account'), fee.description.label('description'),
+                      fee.amount.label('amount'), fee.timestamp.label('timestamp'))
+               .join(rel.fee)
+               .filter(*ctx.scope.fees())
+               .statement
+        ))
+        accounts = stage_rows(session, 'user_accounts',
+                              [Column('account', String), Column('account_id', Integer)],
+                              [{'account': account, 'account_id': user.account.id}
+                               for account, user in users.items()])
+
+        # like the ORM variant, allowances go against their own account and everything else
+        # against the membership fee account
+        other_account = case([(fees.c.description.startswith("Aufwandsentsch"),
+                               literal(ALLOWANCE_ACCOUNT_ID))],
+                             else_=literal(membership_account_id))
+        new_fees = select([
+            func.nextval(func.pg_get_serial_sequence(transaction.fullname, transaction.c.id.name),
+                         type_=Integer).label('transaction_id'),
+            accounts.c.account_id.label('user_account_id'),
+            other_account.label('other_account_id'),
+            fees.c.description, fees.c.amount, fees.c.timestamp,
+        ]).select_from(fees.join(accounts, accounts.c.account == fees.c.account))
+        if ctx.existing is not None:
+            # the split against the user's account identifies an imported fee
+            new_fees = new_fees.where(~exists(
+                select([split.c.id])
+                .select_from(split.join(transaction, split.c.transaction_id == transaction.c.id))
+                .where(transaction.c.author_id == ROOT_ID)
+                .where(transaction.c.description == fees.c.description)
+                .where(transaction.c.valid_on == cast(fees.c.timestamp, Date))
+                .where(split.c.account_id == accounts.c.account_id)
+                .where(split.c.amount == fees.c.amount)
+            ))
+        new = stage_select(session, 'fee_transactions', new_fees)
+
+        num_transactions = session.execute(transaction.insert().from_select(
+            [transaction.c.id, transaction.c.author_id, transaction.c.description,
+             transaction.c.posted_at, transaction.c.valid_on],
+            select([new.c.transaction_id, literal(ROOT_ID), new.c.description,
+                    new.c.timestamp, cast(new.c.timestamp, Date)]),
+        )).rowcount
+        num_splits = session.execute(split.insert().from_select(
+            [split.c.transaction_id, split.c.account_id, split.c.amount],
+            union_all(select([new.c.transaction_id, new.c.user_account_id, new.c.amount]),
+                      select([new.c.transaction_id, new.c.other_account_id, -new.c.amount])),
+        )).rowcount
+        drop_staging(session)
+        stage.rows = num_transactions + num_splits
+
+    ctx.logger.info("Inserted %d fee transactions with %d splits in SQL (%s)",
+                    num_transactions, num_splits, format_duration(stage.seconds))
+    return stage.rows
+
+
+SETTLEMENT_BATCH_SIZE = 10000
+
+
+@reg.provides(FeeSettlement)
+def translate_fee_settlements(ctx: Context, data: IntermediateData) -> List[PycroftBase]:
+    """Schedule recording which statement pays which fee, see :func:`allocate_fifo`
+
+    The settlements refer to the ids of the users, so this is a deferred write.
+    """
+    users = dict(data.users)
+    data.deferred_writes.append(lambda session: write_fee_settlements(ctx, session, users))
+    return []
+
+
+def _charges(rows: Iterable[Tuple[str, Optional[datetime], int, Decimal]]) \
+        -> List[Tuple[str, Charge]]:
+    """Sort `(account, timestamp, id, amount)` rows for :func:`merge_by_account`"""
+    # sorted here, since the database might collate the account names differently
+    charges = [(account, Charge(id_, timestamp or datetime.min, amount))
+               for account, timestamp, id_, amount in rows]
+    charges.sort(key=lambda row: (row[0], row[1].timestamp, row[1].id))
+    return charges
+
+
+def write_fee_settlements(ctx: Context, session: Session,
+                          users: Dict[str, pycroft_model.User]) -> int:
+    rel, fee, log = abe_model.AccountFeeRelation, abe_model.FeeInfo, abe_model.AccountStatementLog
+    fees = StreamedQuery(
+        ctx.query(rel.account_name, fee.timestamp, fee.id, fee.amount)
+           .join(rel.fee)
+           .filter(*ctx.scope.fees()),
+        (fee.id, rel.account_name),
+        page_size=SETTLEMENT_BATCH_SIZE, stats=ctx.retry_stats, logger=ctx.logger,
+    )
+    payments = StreamedQuery(
+        ctx.query(log.account_name, log.timestamp, log.id, log.amount)
+           .filter(log.account_name != None, *ctx.scope.of_accounts(log.account)),
+        (log.id,),
+        page_size=SETTLEMENT_BATCH_SIZE, stats=ctx.retry_stats, logger=ctx.logger,
+    )
+    with ctx.progress.stage("write_fee_settlements") as stage:
+        fee_charges, payment_charges = _charges(fees), _charges(payments)
+        create_legacy_tables(session.connection())
+        table = FeeSettlement.__table__
+
+        rows = []
+        accounts = []
+        open_amount, num_open = Decimal(0), 0
+        credit, num_credit = Decimal(0), 0
+        for account, account_fees, account_payments in merge_by_account(fee_charges,
+                                                                         payment_charges):
+            settlement = allocate_fifo(account_fees, account_payments)
+            accounts.append(account)
+            user_id = users[account].id if account in users else None
+            rows.extend(dict(account=account, user_id=user_id, fee_id=a.fee_id,
+                             statement_id=a.statement_id, amount=a.amount)
+                        for a in settlement.allocations)
+            if settlement.open_amount:
+                open_amount += settlement.open_amount
+                num_open += 1
+            if settlement.credit:
+                credit += settlement.credit
+                num_credit += 1
+
+        if ctx.existing is not None:
+            # the allocation is recomputed from all fees and payments of an account
+            for start in range(0, len(accounts), SETTLEMENT_BATCH_SIZE):
+                session.execute(table.delete().where(
+                    table.c.account.in_(accounts[start:start + SETTLEMENT_BATCH_SIZE])
+                ))
+        for start in range(0, len(rows), SETTLEMENT_BATCH_SIZE):
+            session.execute(table.insert(), rows[start:start + SETTLEMENT_BATCH_SIZE])
+        stage.rows = len(rows)
+
+    ctx.logger.info("Matched %d fees and %d payments of %d accounts in %d settlements (%s):"
+                    " %s€ open in %d accounts, %s€ credit in %d accounts",
+                    len(fee_charges), len(payment_charges), len(accounts), len(rows),
+                    format_duration(stage.seconds), open_amount, num_open, credit, num_credit)
+    return len(rows)
+
+
 def create_membership_fee_transaction(fee_rel: abe_model.AccountFeeRelation,
                                       amount: float, user_account: pycroft_model.Account,
                                       membership_account: pycroft_model.Account):
@@ -711,9 +1292,11 @@ GROUP_ID_ABUSE = 7
 GROUP_ID_PAYMENT_IN_DEFAULT = 5
 
 
-def disable_record_to_membership(record: abe_model.DisableRecord,
-                                 pycroft_user: pycroft_model.User) \
-        -> pycroft_model.Membership:
+def disable_record_group_id(record: abe_model.DisableRecord) -> int:
+    """Return the id of the blocking group of a disable record
+
+    :raises ValueError: if the category is unknown
+    """
     assert record.category.as_enum != DisableEnum.Moved
 
     group_id: int
@@ -733,22 +1316,39 @@ def disable_record_to_membership(record: abe_model.DisableRecord,
         group_id = GROUP_ID_GENERAL_BLOCKED
     else:
         raise ValueError(f"Unknown disable category {record.category}")
-
-    if record.timestamp_end is not None and record.timestamp_start > record.timestamp_end:
-        raise ValueError(
-            f"Invalid interval for record {record.id}: "
-            f"[{record.timestamp_start}, {record.timestamp_end})"
-        )
-    return pycroft_model.Membership(
-        group_id=group_id,
-        user=pycroft_user,
-        begins_at=record.timestamp_start,
-        ends_at=record.timestamp_end,
-    )
+    return group_id
 
 
 GROUP_ID_FEE_FREE = 14
 GROUP_ID_ORG = 1
+MEMBERSHIPS_BY_GROUP = 'memberships_by_group'
+
+natural_key(pycroft_model.Membership, lambda m: (m.user.login, m.group_id, utc(m.begins_at)),
+            options=(joinedload(pycroft_model.Membership.user),))
+natural_key(pycroft_model.Membership, lambda m: (m.user.login, m.group_id),
+            options=(joinedload(pycroft_model.Membership.user),), name=MEMBERSHIPS_BY_GROUP)
+
+
+def upsert_membership(ctx: Context, user: pycroft_model.User, group_id: int,
+                      begins_at=None, ends_at=None) -> Optional[pycroft_model.Membership]:
+    """Return a new membership, or `None` if an existing one has been updated instead
+
+    Memberships without `begins_at` are only created if the user has no
+    membership in that group at all.
+    """
+    if begins_at is None:
+        if ctx.lookup(MEMBERSHIPS_BY_GROUP, (user.login, group_id)):
+            return None
+        return pycroft_model.Membership(group_id=group_id, user=user, ends_at=ends_at)
+
+    membership, created = ctx.upsert(
+        pycroft_model.Membership, (user.login, group_id, utc(begins_at)),
+        group_id=group_id,
+        user=user,
+        begins_at=begins_at,
+        ends_at=ends_at,
+    )
+    return membership if created else None
 
 
 @reg.provides(pycroft_model.Membership, pycroft_model.Group)
@@ -764,8 +1364,9 @@ def translate_memberships(ctx: Context, data: IntermediateData) -> List[PycroftB
 
 
     objs: List[PycroftBase] = []
-    for acc, user in data.both_users.items():
-        has_any_member_membership = False
+    inverted: List[Tuple[str, MembershipSpan]] = []
+    for acc, user in ctx.progress.track(data.both_users.items(), what="users"):
+        spans: List[MembershipSpan] = []
         descriptions = [desc for fee_rel in acc.booked_fees
                         if (desc := fee_rel.fee.description).startswith(MEMBERSHIP_FEE_PREFIX)]
         interval_set: Iterable[interval.Interval] \
@@ -774,18 +1375,20 @@ def translate_memberships(ctx: Context, data: IntermediateData) -> List[PycroftB
         moved_out_since = None
         for record in acc.disable_records:
             assert isinstance(record, abe_model.DisableRecord)
-            objs.append(
-                pycroft_model.UserLogEntry(
-                    author_id=ROOT_ID,
-                    user=user,
-                    message=(
-                        deferred_gettext("Disabled in abe: '{info}' ('{category}')")
-                        .format(info=record.info, category=record.category.description)
-                        .to_json()
-                    ),
-                    created_at=record.timestamp_start,
-                )
+            message = (
+                deferred_gettext("Disabled in abe: '{info}' ('{category}')")
+                .format(info=record.info, category=record.category.description)
+                .to_json()
             )
+            if not ctx.lookup(pycroft_model.UserLogEntry, (user.login, message)):
+                objs.append(
+                    pycroft_model.UserLogEntry(
+                        author_id=ROOT_ID,
+                        user=user,
+                        message=message,
+                        created_at=record.timestamp_start,
+                    )
+                )
 
             if record.category.as_enum == DisableEnum.Moved:
                 if record.timestamp_end:
@@ -797,30 +1400,19 @@ def translate_memberships(ctx: Context, data: IntermediateData) -> List[PycroftB
                 continue
 
             try:
-                objs.append(disable_record_to_membership(record, user))
+                group_id = disable_record_group_id(record)
             except ValueError as e:
-                # yes, that actually happens…
-                ctx.logger.warning("Invalid interval: %s", str(e))
-
-        if acc.property.fee_free:
-            # add a fee_free membership
-            objs.append(pycroft_model.Membership(
-                group_id=GROUP_ID_FEE_FREE,
-                user=user,
-            ))
-
-        if acc.property.active:
-            ctx.logger.warning("New ORG: %s", user.login)
-            objs.append(pycroft_model.Membership(
-                group_id=GROUP_ID_ORG,
-                user=user
-            ))
+                ctx.logger.warning("Skipping disable record: %s", str(e))
+            else:
+                spans.append(MembershipSpan(group_id, record.timestamp_start,
+                                            record.timestamp_end, origin=f"record {record.id}"))
 
         should_be_terminated = any([
             len(user.hosts) == 0,
             moved_out_since is not None,
         ])
 
+        member_group_id = ctx.config.member_group.id
         for i in interval_set:
             if i.end:
                 ends_at = i.end
@@ -835,31 +1427,40 @@ def translate_memberships(ctx: Context, data: IntermediateData) -> List[PycroftB
                 ctx.logger.warning("Useless `Member` membership for %s during [%r, %r)",
                                    user.login, i.begin, ends_at)
                 ends_at = i.begin
+            spans.append(MembershipSpan(member_group_id, i.begin, ends_at, origin="fees"))
+
+        if not any(span.group_id == member_group_id for span in spans) and user.hosts:
+            ctx.logger.warning("User %s does not have any Mitglied memberships, adding open default",
+                               user.login)
+            spans.append(MembershipSpan(member_group_id, user.registered_at))
+
+        merged, user_inverted = merge_spans(spans)
+        inverted.extend((user.login, span) for span in user_inverted)
+        for span in merged:
             try:
-                objs.append(
-                    pycroft_model.Membership(
-                        group=ctx.config.member_group,
-                        begins_at=i.begin,
-                        ends_at=ends_at,
-                        user=user,
-                    )
-                )
-                has_any_member_membership = True
+                objs.extend(filter(None, [upsert_membership(
+                    ctx, user, span.group_id, span.begins_at, span.ends_at
+                )]))
             except (TypeError, AssertionError):
-                ctx.logger.critical("Cannot construct `Member` membership for %s during [%r, %r)",
-                                    user.login, i.begin, ends_at)
+                ctx.logger.critical("Cannot construct membership in group %d for %s during [%r, %r)",
+                                    span.group_id, user.login, span.begins_at, span.ends_at)
                 raise
 
-        if not has_any_member_membership and user.hosts:
-            ctx.logger.warning("User %s does not have any Mitglied memberships, adding open default",
-                               user.login)
-            objs.append(
-                pycroft_model.Membership(
-                    group=ctx.config.member_group,
-                    begins_at=user.registered_at,
-                    user=user,
-                )
-            )
+        if acc.property.fee_free:
+            # add a fee_free membership
+            objs.extend(filter(None, [upsert_membership(ctx, user, GROUP_ID_FEE_FREE)]))
+
+        if acc.property.active:
+            ctx.logger.warning("New ORG: %s", user.login)
+            objs.extend(filter(None, [upsert_membership(ctx, user, GROUP_ID_ORG)]))
+
+    if inverted:
+        # yes, that actually happens…
+        ctx.logger.warning("Skipped %d disable records ending before they begin:\n%s",
+                           len(inverted), "\n".join(
+                               f"  {login} ({span.origin}): [{span.begins_at}, {span.ends_at})"
+                               for login, span in inverted[:20]
+                           ))
     return objs
 
 
@@ -0,0 +1,95 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from logging import Logger
+from typing import Callable, Any, Hashable, Dict, Tuple, Optional, Type, Union
+
+from sqlalchemy.orm import Session
+
+KeyFunc = Callable[[Any], Hashable]
+
+
+# An index is identified by its model, or by a name if a model has more than one
+IndexId = Union[Type, str]
+
+
+@dataclass
+class NaturalKey:
+    model: Type
+    key: KeyFunc
+    options: Tuple = ()
+    criterion: Tuple = ()
+
+
+NATURAL_KEYS: Dict[IndexId, NaturalKey] = {}
+
+
+def natural_key(model: Type, key: KeyFunc, options: Tuple = (), criterion: Tuple = (),
+                name: Optional[str] = None):
+    """Declare how rows of `model` already present in pycroft are identified
+
+    :param key: Computes the natural key of an existing row.  Translations
+        have to pass the same key to :meth:`Context.upsert`.
+    :param options: Loader options, e.g. to eagerly load what `key` needs
+    :param criterion: Restricts the rows to be indexed
+    :param name: Name of the index if it is not the default one of `model`
+    """
+    NATURAL_KEYS[name or model] = NaturalKey(model, key, options, criterion)
+
+
+def update_changed(obj: Any, **values: Any):
+    """Assign only those `values` which differ from the current ones"""
+    for attr, value in values.items():
+        if getattr(obj, attr) != value:
+            setattr(obj, attr, value)
+
+
+def utc(dt: Optional[datetime]) -> Optional[datetime]:
+    """Normalize a datetime for use in a natural key.  Naive ones are taken as UTC."""
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+class ExistingRows:
+    """Hash indexes over the rows already present in pycroft
+
+    The index of a model is loaded with a single query the first time it is
+    needed.  New objects are remembered as well, so that a second translation
+    asking for the same key gets the same object.
+    """
+    def __init__(self, session: Session, logger: Logger):
+        self.session = session
+        self.logger = logger
+        self._indexes: Dict[IndexId, Dict[Hashable, Any]] = {}
+
+    def index(self, index_id: IndexId) -> Dict[Hashable, Any]:
+        try:
+            return self._indexes[index_id]
+        except KeyError:
+            pass
+
+        nk = NATURAL_KEYS[index_id]
+        model = nk.model
+        index: Dict[Hashable, Any] = {}
+        num_duplicates = 0
+        for row in self.session.query(model).options(*nk.options).filter(*nk.criterion):
+            key = nk.key(row)
+            if key in index:
+                num_duplicates += 1
+                continue
+            index[key] = row
+        if num_duplicates:
+            self.logger.warning("%d existing %s rows have a duplicate natural key,"
+                                " only the first one of each is updated.",
+                                num_duplicates, model.__name__)
+        self.logger.debug("Indexed %d existing %s rows", len(index), model.__name__)
+        self._indexes[index_id] = index
+        return index
+
+    def get(self, index_id: IndexId, key: Hashable) -> Optional[Any]:
+        return self.index(index_id).get(key)
+
+    def remember(self, index_id: IndexId, key: Hashable, obj: Any):
+        self.index(index_id)[key] = obj
@@ -0,0 +1,173 @@
+"""Verifying a committed import with row counts and order-independent checksums
+
+Before the commit, every table the imported objects live in gets its
+number of rows and the sum of a hash of each row.  After the commit, the
+database computes the same with one aggregate query per table over the ids
+of those objects, so nothing has to be reloaded through the ORM.
+
+Only columns whose text representation is the same in python and in
+PostgreSQL are hashed (see :func:`checksum_columns`).  Association tables
+and the rows of deferred writes are not covered.
+"""
+import hashlib
+from dataclasses import dataclass
+from datetime import date
+from decimal import Decimal
+from logging import Logger
+from typing import Any, Dict, Iterable, List, Tuple
+
+from sqlalchemy import BigInteger, Boolean, Column, Date, Integer, Numeric, String, Table, \
+    Text, cast, func, inspect, literal, or_, select
+from sqlalchemy.dialects.postgresql import BIT
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.state import InstanceState
+from sqlalchemy.types import TypeDecorator
+
+from .artifact import bind
+from .rows import allocated_key
+
+NULL = r'\N'
+SEPARATOR = '|'
+# hex digits of the md5 sum making up the hash of a row, 60 bits keep the sum exact
+HASH_DIGITS = 15
+
+
+@dataclass(frozen=True)
+class TableChecksum:
+    rows: int
+    checksum: int
+
+
+@dataclass
+class ExpectedTable:
+    """What a table should contain after the commit"""
+    table: Table
+    ids: List[int]
+    columns: List[Column]
+    expected: TableChecksum
+
+
+def checksum_columns(table: Table) -> List[Column]:
+    """Return the columns whose values can be compared as text
+
+    Timestamps (time zones), floats and custom types don't have a python
+    representation matching the one of PostgreSQL, so they are left out.
+    """
+    return [c for c in table.columns
+            if not isinstance(c.type, TypeDecorator)
+            and isinstance(c.type, (Integer, String, Boolean, Date, Numeric))]
+
+
+def value_text(column: Column, value: Any) -> str:
+    """Format `value` like PostgreSQL's cast of `column` to text"""
+    value = bind(column, value)
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal) and getattr(column.type, 'scale', None) is not None:
+        return str(value.quantize(Decimal(1).scaleb(-column.type.scale)))
+    return str(value)
+
+
+def row_hash(texts: Iterable[str]) -> int:
+    digest = hashlib.md5(SEPARATOR.join(texts).encode('utf-8')).hexdigest()
+    return int(digest[:HASH_DIGITS], 16)
+
+
+def id_ranges(ids: Iterable[int]) -> List[Tuple[int, int]]:
+    """Return the runs of consecutive `ids` as inclusive ranges"""
+    ranges: List[Tuple[int, int]] = []
+    for id_ in sorted(set(ids)):
+        if ranges and ranges[-1][1] == id_ - 1:
+            ranges[-1] = (ranges[-1][0], id_)
+        else:
+            ranges.append((id_, id_))
+    return ranges
+
+
+def _state_values(state: InstanceState, table: Table) -> Dict[Column, Any]:
+    values = {}
+    for column in table.columns:
+        try:
+            prop = state.mapper.get_property_by_column(column)
+        except Exception:  # not mapped (e.g. the discriminator of a subclass)
+            continue
+        if prop.key in state.dict:
+            values[column] = state.dict[prop.key]
+    return values
+
+
+def flushed_states(objs: Iterable[object]) -> List[InstanceState]:
+    """Return the states of `objs` and of every object they cascade to on save"""
+    seen = set()
+    for obj in objs:
+        state = inspect(obj)
+        seen.add(state)
+        for _, _, child_state, _ in state.mapper.cascade_iterator('save-update', state):
+            seen.add(child_state)
+    return [state for state in seen if state.key is not None]
+
+
+def expected_checksums(objs: Iterable[object]) -> List[ExpectedTable]:
+    """Compute the checksums of the tables the flushed `objs` have been written to
+
+    This has to happen before the commit, which expires the loaded values.
+    Columns which are not loaded for every row (e.g. server-side defaults)
+    are left out.
+    """
+    rows: Dict[Table, List[Dict[Column, Any]]] = {}
+    for state in flushed_states(objs):
+        for table in state.mapper.tables:
+            if allocated_key(table) is not None:
+                rows.setdefault(table, []).append(_state_values(state, table))
+
+    expected = []
+    for table, values in rows.items():
+        key = allocated_key(table)
+        columns = [c for c in checksum_columns(table) if all(c in row for row in values)]
+        checksum = sum(row_hash(value_text(c, row[c]) for c in columns) for row in values)
+        expected.append(ExpectedTable(table, [row[key] for row in values], columns,
+                                      TableChecksum(len(values), checksum)))
+    return expected
+
+
+def _hash_expression(columns: List[Column]):
+    texts = [func.coalesce(cast(c, Text), NULL) for c in columns]
+    digest = func.substr(func.md5(func.concat_ws(SEPARATOR, *texts)), 1, HASH_DIGITS)
+    return cast(cast(literal('x').op('||')(digest), BIT(4 * HASH_DIGITS)), BigInteger)
+
+
+def actual_checksum(session: Session, expected: ExpectedTable) -> TableChecksum:
+    """Aggregate the rows of the expected ids of the table in the database"""
+    key = allocated_key(expected.table)
+    in_ranges = or_(*(key.between(lo, hi) if lo < hi else key == lo
+                      for lo, hi in id_ranges(expected.ids)))
+    rows, checksum = session.execute(
+        select([func.count(), func.coalesce(func.sum(_hash_expression(expected.columns)), 0)])
+        .select_from(expected.table)
+        .where(in_ranges)
+    ).first()
+    return TableChecksum(rows, int(checksum))
+
+
+def verify_import(session: Session, expected: List[ExpectedTable], logger: Logger) -> bool:
+    """Compare the database with the `expected` checksums and log the result"""
+    mismatches = []
+    for table in expected:
+        actual = actual_checksum(session, table)
+        if actual != table.expected:
+            mismatches.append((table, actual))
+    num_rows = sum(t.expected.rows for t in expected)
+    if not mismatches:
+        logger.info("Verified %d rows in %d tables.", num_rows, len(expected))
+        return True
+    logger.error("%d of %d tables don't contain what has been imported:\n%s",
+                 len(mismatches), len(expected), "\n".join(
+                     f"  {t.table.fullname}: {actual.rows} of {t.expected.rows} rows,"
+                     f" checksum {'matches' if actual.checksum == t.expected.checksum else 'differs'}"
+                     for t, actual in mismatches
+                 ))
+    return False
@@ -0,0 +1,71 @@
+import logging
+import queue
+import threading
+from typing import List, Optional
+
+from sqlalchemy.orm import Session
+
+_STOP = None
+
+
+class WriterError(RuntimeError):
+    pass
+
+
+class BackgroundWriter:
+    """Flushes batches of new objects into the pycroft session in a separate thread
+
+    Batches are handed over through a bounded queue, so :meth:`submit` blocks
+    if the writer falls behind (`maxsize` batches).  Since they arrive in
+    the order of :meth:`TranslationRegistry.sorted_functions`, flushing them
+    one after another satisfies all foreign keys.
+
+    A session must not be used from two threads at once: :attr:`lock` is held
+    during every flush, and the importer holds it whenever it uses the
+    pycroft session itself (see :meth:`Context.reading_abe`).  After a
+    failed flush the session is unusable, which :meth:`check` reports.
+    Nothing is committed; that is still up to the caller.
+    """
+    def __init__(self, session: Session, logger: logging.Logger, maxsize: int = 2):
+        self.session = session
+        self.logger = logger
+        self.lock = threading.RLock()
+        self.queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.error: Optional[BaseException] = None
+        self.num_written = 0
+        self._thread = threading.Thread(target=self._run, name="pycroft-writer", daemon=True)
+        self._thread.start()
+
+    def check(self):
+        """Raise a :class:`WriterError` if a flush has failed"""
+        if self.error:
+            raise WriterError("The background writer failed") from self.error
+
+    def submit(self, batch: List[object]):
+        self.check()
+        self.queue.put(list(batch))
+
+    def close(self):
+        """Wait until every submitted batch has been flushed"""
+        self.queue.put(_STOP)
+        self._thread.join()
+        self.check()
+        self.logger.info("Background writer flushed %d objects.", self.num_written)
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is _STOP:
+                return
+            if self.error:
+                continue  # keep draining so that `submit` does not block forever
+            try:
+                with self.lock:
+                    self.session.add_all(batch)
+                    self.session.flush()
+            except BaseException as e:
+                self.logger.critical("Flushing %d objects failed: %s", len(batch), e)
+                self.error = e
+            else:
+                self.num_written += len(batch)
+                self.logger.debug("Flushed %d objects", len(batch))
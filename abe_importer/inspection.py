@@ -0,0 +1,96 @@
+"""Interactive inspection of the objects an import would create
+
+Runs the import like ``abe_importer --dry-run`` and then either shows the
+objects of the given accounts or opens a python console with the
+:class:`ObjectRegistry` as ``objs``.  Nothing is written to pycroft.
+"""
+import code
+from typing import Tuple
+
+import click
+import colorama
+from sqlalchemy.orm import Session, joinedload
+
+from pycroft.model import _all as pycroft_model
+from . import model as abe_model
+from .cli import read_uri, check_connections
+from .importer import do_import, MEMBERSHIPS_BY_LOGIN
+from .importer.object_registry import ObjectRegistry
+from .importer.scope import Scope
+from .logging import setup_logger
+from .session import create_session
+
+
+class Inspector:
+    """What the console offers besides the registry itself"""
+    def __init__(self, objs: ObjectRegistry, abe_session: Session):
+        self.objs = objs
+        self.abe_session = abe_session
+
+    def show(self, login: str):
+        """Print the abe account `login` next to the pycroft objects made of it"""
+        acc = self.abe_session.query(abe_model.Account) \
+            .options(joinedload(abe_model.Account.booked_fees)) \
+            .get(login)
+        if acc is None:
+            click.echo(f"abe has no account {login!r}")
+            return
+        click.echo(f"abe:     {acc!r}, {len(acc.booked_fees)} booked fees")
+        if acc.pycroft_login:
+            click.echo(f"pycroft: mapped to the existing user {acc.pycroft_login!r}")
+        # logins clashing with existing pycroft users get a suffix
+        users = self.objs.find(pycroft_model.User, login) \
+            or self.objs.find(pycroft_model.User, f"{login}-hss")
+        if not users:
+            click.echo("pycroft: no user has been created")
+            return
+        for user in users:
+            click.echo(f"pycroft: {user!r} in {user.room!r}")
+            for membership in self.objs.find(MEMBERSHIPS_BY_LOGIN, user.login):
+                click.echo(f"  {membership!r}")
+
+
+@click.command()
+@click.option('--abe-uri-file', default=".abe_uri")
+@click.option('--pycroft-uri-file', default=".pycroft_uri")
+@click.option('--building', 'buildings', metavar='SHORTNAME', multiple=True,
+              help="Only import the accounts of this building (repeatable).")
+@click.option('--sample', metavar='FRACTION', type=click.FloatRange(0, 1, min_open=True),
+              help="Only import a random fraction of the accounts.")
+@click.option('--seed', default=0, show_default=True, help="Seed choosing the --sample.")
+@click.argument('accounts', nargs=-1)
+def main(abe_uri_file: str, pycroft_uri_file: str, buildings: Tuple[str], sample: float,
+         seed: int, accounts: Tuple[str]):
+    """Show what the import makes of ACCOUNTS, or open a console without any"""
+    colorama.init()
+    abe_session = create_session(read_uri(uri_file=abe_uri_file))
+    pycroft_session = create_session(read_uri(uri_file=pycroft_uri_file))
+    logger = setup_logger('abe-importer', verbose=False)
+    check_connections(abe_session, pycroft_session, logger=logger)
+
+    scope = Scope(frozenset(buildings)) if buildings else Scope()
+    if sample:
+        scope = scope.sample(abe_session, sample, seed)
+    with pycroft_session.no_autoflush:
+        objs = do_import(abe_session, pycroft_session, logger, upsert=bool(buildings),
+                         scope=scope)
+    inspector = Inspector(objs, abe_session)
+
+    try:
+        if accounts:
+            for login in accounts:
+                inspector.show(login)
+            return
+        code.interact(banner=f"{len(objs)} objects in `objs`:"
+                             " objs.find(pycroft_model.User, login), objs.where(model, **attrs),"
+                             " show(login)", local={
+            'objs': objs, 'show': inspector.show, 'abe_session': abe_session,
+            'pycroft_session': pycroft_session, 'abe_model': abe_model,
+            'pycroft_model': pycroft_model,
+        })
+    finally:
+        pycroft_session.rollback()
+
+
+if __name__ == '__main__':
+    main()
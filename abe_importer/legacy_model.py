@@ -0,0 +1,70 @@
+"""Tables in the pycroft database keeping abe data pycroft has no model for"""
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Numeric
+from sqlalchemy.ext.declarative import declarative_base
+
+from pycroft.model import _all as pycroft_model
+
+from .model import INET
+
+LegacyBase = declarative_base()
+
+
+class IpLogInterval(LegacyBase):
+    """An abe account used an IP from `begins_at` until `ends_at` (both observed)"""
+    __tablename__ = 'abe_ip_log_interval'
+    id = Column(Integer, primary_key=True)
+    ip = Column(INET, nullable=False, index=True)
+    account = Column(String, nullable=False)
+    user_id = Column(Integer, ForeignKey(pycroft_model.User.id, ondelete='SET NULL'), index=True)
+    begins_at = Column(DateTime(timezone=True), nullable=False)
+    ends_at = Column(DateTime(timezone=True), nullable=False)
+    observations = Column(Integer, nullable=False)
+
+
+class FeeSettlement(LegacyBase):
+    """Part of an abe fee paid by an abe statement, see :mod:`.importer.settlement`"""
+    __tablename__ = 'abe_fee_settlement'
+    id = Column(Integer, primary_key=True)
+    account = Column(String, nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey(pycroft_model.User.id, ondelete='SET NULL'), index=True)
+    fee_id = Column(Integer, nullable=False, index=True)
+    statement_id = Column(Integer, nullable=False, index=True)
+    amount = Column(Numeric(14, 2), nullable=False)
+
+
+class AccountMapping(LegacyBase):
+    """The user an abe account has been imported as"""
+    __tablename__ = 'abe_account_mapping'
+    account = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey(pycroft_model.User.id, ondelete='CASCADE'),
+                     nullable=False, index=True)
+
+
+class AccessMapping(LegacyBase):
+    """The room an abe access has been imported as"""
+    __tablename__ = 'abe_access_mapping'
+    access_id = Column(Integer, primary_key=True, autoincrement=False)
+    room_id = Column(Integer, ForeignKey(pycroft_model.Room.id, ondelete='CASCADE'),
+                     nullable=False, index=True)
+
+
+class SwitchMapping(LegacyBase):
+    """The switch an abe switch has been imported as"""
+    __tablename__ = 'abe_switch_mapping'
+    switch = Column(String, primary_key=True)
+    switch_id = Column(Integer, ForeignKey(pycroft_model.Switch.host_id, ondelete='CASCADE'),
+                       nullable=False, index=True)
+
+
+class StatementMapping(LegacyBase):
+    """The bank account activity an abe statement log has been imported as"""
+    __tablename__ = 'abe_statement_mapping'
+    statement_id = Column(Integer, primary_key=True, autoincrement=False)
+    bank_account_activity_id = Column(
+        Integer, ForeignKey(pycroft_model.BankAccountActivity.id, ondelete='CASCADE'),
+        nullable=False, index=True,
+    )
+
+
+def create_legacy_tables(connection):
+    LegacyBase.metadata.create_all(connection, checkfirst=True)
@@ -1,5 +1,11 @@
+import atexit
+import json
 import logging
+import queue
 import sys
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Dict, Tuple
 
 import colorama
 
@@ -20,12 +26,117 @@ class ColoredFormatter(logging.Formatter):
         return f"{style}{msg}{colorama.Style.RESET_ALL}"
 
 
-def setup_logger(logger_name, verbose):
+class JsonFormatter(logging.Formatter):
+    """Formats every record as a single JSON line
+
+    Besides the rendered message, the unformatted template is kept so that
+    the log file can be grouped by message afterwards.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'func': record.funcName,
+            'template': str(getattr(record, 'template', record.msg)),
+            'message': record.getMessage(),
+        }
+        return json.dumps(entry, default=str)
+
+
+# Pass as `extra` for records which should never be collapsed, e.g. stage headers
+NO_AGGREGATION = {'aggregate': False}
+
+
+class RepetitionFilter(logging.Filter):
+    """Only let the first `samples` records of each message template pass
+
+    Records of level ERROR and above always pass, as do records logged with
+    ``extra=NO_AGGREGATION``.  The suppressed records are
+    counted and can be summarized with :meth:`summary`.
+    """
+    def __init__(self, samples: int = 3):
+        super().__init__()
+        self.samples = samples
+        self.counts: Counter = Counter()
+
+    @staticmethod
+    def key(record: logging.LogRecord) -> Tuple[int, str]:
+        return record.levelno, str(getattr(record, 'template', record.msg))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR or not getattr(record, 'aggregate', True):
+            return True
+        key = self.key(record)
+        self.counts[key] += 1
+        return self.counts[key] <= self.samples
+
+    def summary(self, logger_name: str):
+        """Yield one record per template that has been suppressed at least once"""
+        for (levelno, template), count in self.counts.most_common():
+            if count <= self.samples:
+                continue
+            yield logging.LogRecord(
+                name=logger_name, level=levelno, pathname=__file__, lineno=0,
+                msg="(%d more like %r suppressed)",
+                args=(count - self.samples, template), exc_info=None,
+                func='summary',
+            )
+
+
+class TemplatePreservingQueueHandler(QueueHandler):
+    """A `QueueHandler` which remembers the message template of a record
+
+    The message is still rendered in the emitting thread (the arguments may
+    be ORM objects which must not be touched from the listener thread),
+    but the template survives as `record.template` for aggregation.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.template = record.msg
+        return super().prepare(record)
+
+
+_listeners: Dict[str, Tuple[QueueListener, logging.Handler, RepetitionFilter]] = {}
+
+
+def setup_logger(logger_name, verbose, log_file: Optional[str] = None, samples: int = 3):
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging.DEBUG if verbose else logging.INFO)
     log_format = "[%(levelname).4s] %(name)s:%(funcName)s:%(message)s"
     h = logging.StreamHandler(sys.stdout)
     h.setFormatter(ColoredFormatter(log_format))
     h.setLevel(logging.DEBUG)
-    logger.addHandler(h)
+    repetitions = RepetitionFilter(samples)
+    h.addFilter(repetitions)
+    handlers = [h]
+
+    if log_file:
+        fh = logging.FileHandler(log_file, encoding='utf-8')
+        fh.setFormatter(JsonFormatter())
+        fh.setLevel(logging.DEBUG)
+        handlers.append(fh)
+
+    q: queue.Queue = queue.Queue(-1)
+    listener = QueueListener(q, *handlers, respect_handler_level=True)
+    logger.addHandler(TemplatePreservingQueueHandler(q))
+    listener.start()
+    _listeners[logger_name] = (listener, h, repetitions)
+    atexit.register(shutdown_logger, logger_name)
     return logger
+
+
+def shutdown_logger(logger_name):
+    """Drain the queue of the given logger and print the repetition summary
+
+    This is registered via `atexit`, but may be called earlier.
+    """
+    try:
+        listener, console_handler, repetitions = _listeners.pop(logger_name)
+    except KeyError:
+        return
+    listener.stop()
+    for record in repetitions.summary(logger_name):
+        # `emit` instead of `handle`: the summary must bypass the repetition filter
+        console_handler.emit(record)
+    for handler in listener.handlers:
+        handler.close()
@@ -4,7 +4,8 @@ from enum import Enum, auto
 from typing import List, Type
 
 import ipaddr
-from sqlalchemy import Column, Integer, String as sqlaString, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String as sqlaString, Boolean, ForeignKey, func, \
+    BigInteger
 from sqlalchemy.dialects import postgresql as pgtype
 from sqlalchemy.ext.declarative import as_declarative, DeclarativeMeta
 from sqlalchemy.orm import relationship, backref, foreign, remote
@@ -21,11 +22,24 @@ class Base:
 
 
 class String(TypeDecorator):
+    """A string type stripping the padding of the legacy `CHAR` columns
+
+    By default, the trimming is done by the server: selected columns are
+    wrapped in ``rtrim(…)`` and typed as plain strings, so that
+    :meth:`process_result_value` is not called for them at all.  It is only
+    used if :attr:`trim_in_sql` is disabled (it is read at compile time).
+    """
     @property
     def python_type(self):
         return str
 
     impl = sqlaString
+    trim_in_sql = True
+
+    def column_expression(self, colexpr):
+        if not self.trim_in_sql:
+            return colexpr
+        return func.rtrim(colexpr, type_=sqlaString(self.impl.length))
 
     def process_literal_param(self, value, dialect):
         return value
@@ -40,6 +54,12 @@ class String(TypeDecorator):
         return String(self.impl.length)
 
 
+# PostgreSQL types falling back to strings on SQLite, see `abe_importer.testing`
+INET = pgtype.INET().with_variant(sqlaString(), 'sqlite')
+CIDR = pgtype.CIDR().with_variant(sqlaString(), 'sqlite')
+MACADDR = pgtype.MACADDR().with_variant(sqlaString(), 'sqlite')
+
+
 def id_pkey():
     return Column(Integer, primary_key=True)
 
@@ -129,7 +149,7 @@ class Switch(Base):
 
 class Ip(Base):
     __tablename__ = 'ip'
-    ip = Column(pgtype.INET, primary_key=True)
+    ip = Column(INET, primary_key=True)
     account_name = account_fkey()
     account = relationship(Account, backref=backref("ips"))
 
@@ -139,7 +159,7 @@ class Mac(Base):
     id = id_pkey()
     account_name = Column('account', String, ForeignKey(Account.account))
     account = relationship(Account, backref=backref("macs"))
-    mac = Column(pgtype.MACADDR)
+    mac = Column(MACADDR)
     active = Column(Boolean, default=True)
 
     
@@ -147,8 +167,8 @@ class Subnet(Base):
     __tablename__ = 'subnet'
     id = id_pkey()
     description = Column(String)
-    subnet = Column(pgtype.CIDR)
-    gateway = Column(pgtype.INET)
+    subnet = Column(CIDR)
+    gateway = Column(INET)
     vlan_name = Column(String)
     vlan_id = Column(Integer)
 
@@ -257,7 +277,7 @@ class IpLog(Base):
     id = id_pkey()
     account_name = account_fkey()
     account = relationship(Account, backref=backref('ip_logs'))
-    ip_addr = Column('ip', pgtype.INET, ForeignKey(Ip.ip))
+    ip_addr = Column('ip', INET, ForeignKey(Ip.ip))
     ip = relationship(Ip, backref=backref('ip_logs'))
     timestamp = Column(DateTime)
     
@@ -291,17 +311,17 @@ class TrafficLog(Base):
     account_name = account_fkey()
     account = relationship(Account, backref=backref('traffic_logs'))
     date = Column(Date)
-    bytes_in = Column(pgtype.BIGINT)
-    bytes_out = Column(pgtype.BIGINT)
-    pkg_in = Column(pgtype.BIGINT)
-    pkg_out = Column(pgtype.BIGINT)
+    bytes_in = Column(BigInteger)
+    bytes_out = Column(BigInteger)
+    pkg_in = Column(BigInteger)
+    pkg_out = Column(BigInteger)
     
 
 class TrafficQuota(Base):
     __tablename__ = 'traffic_quota'
     id = id_pkey()
-    daily_credit = Column(pgtype.BIGINT)
-    max_credit = Column(pgtype.BIGINT)
+    daily_credit = Column(BigInteger)
+    max_credit = Column(BigInteger)
     description = Column(String)
 
 
@@ -33,14 +33,12 @@ def main():
     #     ctx.logger.info(desc)
     ctx.logger.info("Latest month: %s", get_latest_month(descs))
 
-    all_accounts: List[abe_model.Account] = abe_session.query(abe_model.Account)\
+    pak_accounts: List[abe_model.Account] = abe_session.query(abe_model.Account) \
+        .filter(abe_model.Account.account.like("pak%")) \
         .options(joinedload(abe_model.Account.booked_fees)).all()
 
-    ctx.logger.info("Fees of usesrs starting with pa:")
-    for a in all_accounts:
-        if not a.account.startswith("pak"):
-            continue
-
+    ctx.logger.info("Fees of usesrs starting with pak:")
+    for a in pak_accounts:
         ctx.logger.info("Account %s has %d fees.", a, len(a.booked_fees))
         for f in a.booked_fees:
             ctx.logger.debug(f)
@@ -0,0 +1,113 @@
+"""An in-memory abe database for tests and benchmarks
+
+The abe schema is created in SQLite (see the type variants in
+:mod:`abe_importer.model`), and :class:`AbeFactory` adds rows with
+sensible defaults, so that only what matters to a test has to be given.
+"""
+import itertools
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from . import model as abe_model
+
+
+def create_sqlite_session(url: str = 'sqlite://') -> Session:
+    """Return a session on a fresh SQLite database containing the abe schema"""
+    engine = create_engine(url)
+    abe_model.Base.metadata.create_all(engine)
+    return Session(bind=engine)
+
+
+class AbeFactory:
+    """Creates abe rows in `session`
+
+    Every method adds the new row to the session and returns it.  Ids and
+    names are unique within a factory.
+    """
+    def __init__(self, session: Session):
+        self.session = session
+        self._ids = itertools.count(1)
+
+    def _add(self, obj):
+        self.session.add(obj)
+        return obj
+
+    def building(self, short_name: Optional[str] = None, **kw) -> abe_model.Building:
+        n = next(self._ids)
+        kw.setdefault('street', "Wundtstraße")
+        kw.setdefault('number', str(n))
+        kw.setdefault('zip_code', "01217")
+        return self._add(abe_model.Building(short_name=short_name or f"WU{n}", **kw))
+
+    def switch(self, building: abe_model.Building, **kw) -> abe_model.Switch:
+        n = next(self._ids)
+        kw.setdefault('name', f"{building.short_name}-{n}")
+        kw.setdefault('level', 0)
+        kw.setdefault('room_number', "001")
+        kw.setdefault('mgmt_ip_str', f"10.0.{n // 256}.{n % 256}")
+        return self._add(abe_model.Switch(building=building.short_name, **kw))
+
+    def access(self, building: abe_model.Building, switch: Optional[abe_model.Switch] = None,
+               **kw) -> abe_model.Access:
+        n = next(self._ids)
+        kw.setdefault('floor', "1")
+        kw.setdefault('flat', str(n))
+        kw.setdefault('room', "a")
+        kw.setdefault('port', f"A{n}" if switch else None)
+        return self._add(abe_model.Access(id=n, building_shortname=building.short_name,
+                                          switch=switch.name if switch else None, **kw))
+
+    def account(self, access: Optional[abe_model.Access] = None, **kw) -> abe_model.Account:
+        n = next(self._ids)
+        login = kw.pop('account', f"user{n}")
+        kw.setdefault('name', f"User {n}")
+        kw.setdefault('entry_date', date(2019, 10, 1))
+        kw.setdefault('system_account', False)
+        acc = self._add(abe_model.Account(account=login, access_id=access.id if access else None,
+                                          **kw))
+        self._add(abe_model.AccountProperty(account_name=login, active=False, fee_free=False,
+                                            mail=f"{login}@example.org"))
+        self._add(abe_model.LdapEntry(uid=login, _uidnumber=10000 + n, gidnumber=100,
+                                      userpassword="{CRYPT}x", homedirectory=f"/home/{login}"))
+        return acc
+
+    def mac(self, account: abe_model.Account, mac: Optional[str] = None) -> abe_model.Mac:
+        n = next(self._ids)
+        return self._add(abe_model.Mac(id=n, account_name=account.account,
+                                       mac=mac or f"00:de:ad:be:{n // 256:02x}:{n % 256:02x}"))
+
+    def ip(self, account: abe_model.Account, ip: Optional[str] = None) -> abe_model.Ip:
+        n = next(self._ids)
+        return self._add(abe_model.Ip(account_name=account.account,
+                                      ip=ip or f"141.30.{n // 256}.{n % 256}"))
+
+    def fee(self, account: abe_model.Account, description: str = "Mitgliedsbeitrag 2020-01",
+            amount: Decimal = Decimal("5.00"),
+            timestamp: datetime = datetime(2020, 1, 1)) -> abe_model.AccountFeeRelation:
+        n = next(self._ids)
+        fee = self._add(abe_model.FeeInfo(id=n, description=description, amount=amount,
+                                          timestamp=timestamp))
+        return self._add(abe_model.AccountFeeRelation(fee_id=fee.id, fee=fee,
+                                                      account_name=account.account))
+
+    def statement(self, account: Optional[abe_model.Account] = None, amount=Decimal("5.00"),
+                  **kw) -> abe_model.AccountStatementLog:
+        n = next(self._ids)
+        kw.setdefault('timestamp', datetime(2020, 1, 15))
+        kw.setdefault('purpose', f"Mitgliedsbeitrag {n}")
+        kw.setdefault('payer', "Max Mustermann")
+        return self._add(abe_model.AccountStatementLog(
+            id=n, amount=amount, account_name=account.account if account else None, **kw
+        ))
+
+    def traffic(self, account: abe_model.Account, day: date, bytes_in: int = 1000,
+                bytes_out: int = 100, **kw) -> abe_model.TrafficLog:
+        kw.setdefault('pkg_in', bytes_in // 100)
+        kw.setdefault('pkg_out', bytes_out // 100)
+        return self._add(abe_model.TrafficLog(id=next(self._ids), account_name=account.account,
+                                              date=day, bytes_in=bytes_in, bytes_out=bytes_out,
+                                              **kw))
@@ -0,0 +1,150 @@
+"""Microbenchmarks of the helpers the translations call for every row
+
+Every benchmark times a function on synthetic inputs resembling abe and
+divides the time by that of a fixed pure-python workload (see
+:func:`reference_workload`), so that the numbers stored in
+:data:`BASELINE_FILE` carry over between machines.  A benchmark fails if it
+takes more than :data:`THRESHOLD` times its baseline, and is skipped if it
+has none yet.
+
+They are part of every ``pytest`` run, so they are kept short, and the
+threshold is generous.  Store new numbers after an intended change with
+``BENCHMARK_UPDATE=1 pytest benchmarks.py``.
+"""
+import json
+import logging
+import os
+import random
+import timeit
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterator, Tuple
+
+import pytest
+
+# every module of the importer needs pycroft
+pytest.importorskip('pycroft')
+
+from abe_importer.importer.context import reg
+from abe_importer.importer.membership import FeeMonth, descriptions_to_interval_set, \
+    get_latest_month
+from abe_importer.importer.translations import addr_equal, maybe_fix_mail, sanitize_username
+from abe_importer.model import DisableEnum
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+THRESHOLD = float(os.environ.get('BENCHMARK_THRESHOLD', 3))
+UPDATE = bool(os.environ.get('BENCHMARK_UPDATE'))
+# the best of this many runs counts, to keep out the noise of other processes
+REPEAT = 5
+# every run calls the function as often as it takes to last at least this long
+MIN_RUN_SECONDS = 0.01
+# a benchmark above the threshold is measured again this often before it fails
+ATTEMPTS = 3
+
+
+def reference_workload():
+    sorted(str(i * 7919 % 1000) for i in range(1000))
+
+
+def best_time(func: Callable[[], object]) -> float:
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < MIN_RUN_SECONDS:
+        number *= 2
+    return min(timer.repeat(number=number, repeat=REPEAT)) / number
+
+
+@pytest.fixture(scope='module')
+def baseline() -> Iterator[Tuple[Dict[str, float], Dict[str, float]]]:
+    try:
+        with open(BASELINE_FILE) as f:
+            stored = json.load(f)
+    except FileNotFoundError:
+        stored = {}
+    measured: Dict[str, float] = {}
+    yield stored, measured
+    if UPDATE and measured:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump({**stored, **measured}, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+@pytest.fixture
+def bench(baseline, request):
+    """Compare the time of a call of `func` relative to the reference with the baseline"""
+    stored, measured = baseline
+
+    def measure(func: Callable[[], object]) -> float:
+        # measured right before, so that both see the same clock speed and load
+        reference = best_time(reference_workload)
+        return best_time(func) / reference
+
+    def run(func: Callable[[], object]):
+        name = request.node.name[len('test_'):]
+        relative = measure(func)
+        if not UPDATE and name in stored:
+            for _ in range(ATTEMPTS - 1):
+                if relative <= stored[name] * THRESHOLD:
+                    break
+                relative = min(relative, measure(func))
+        measured[name] = float(f"{relative:.4g}")
+        if UPDATE:
+            return
+        if name not in stored:
+            pytest.skip(f"no baseline for {name}, store one with BENCHMARK_UPDATE=1")
+        assert relative <= stored[name] * THRESHOLD, \
+            f"{name} takes {relative / stored[name]:.2f} times its baseline"
+    return run
+
+
+@pytest.fixture(scope='module')
+def rand() -> random.Random:
+    return random.Random(0)
+
+
+def test_sanitize_username(bench, rand):
+    names = [rand.choice(["max_mustermann", "Erika.Musterfrau", "1337hacker", "user-.", "hss"])
+             + str(rand.randrange(100)) * rand.randrange(2) for _ in range(1000)]
+    bench(lambda: [sanitize_username(n) for n in names])
+
+
+def test_maybe_fix_mail(bench, rand):
+    logger = logging.getLogger('benchmarks.mail')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    mails = [f"user{i}{'.' if rand.random() < 0.05 else ''}@example.org" for i in range(1000)]
+    bench(lambda: [maybe_fix_mail(m, logger) for m in mails])
+
+
+def test_fee_month_from_desc(bench, rand):
+    descriptions = [f"Mitgliedsbeitrag {rand.randrange(2008, 2021)}-{rand.randrange(1, 13):02d}"
+                    for _ in range(1000)]
+    bench(lambda: [FeeMonth.from_desc(d) for d in descriptions])
+
+
+def test_descriptions_to_interval_set(bench):
+    # an account paying for five years, with a gap of a year in between
+    descriptions = [f"Mitgliedsbeitrag {year}-{month:02d}"
+                    for year in (2012, 2013, 2015, 2016, 2017) for month in range(1, 13)]
+    latest_month = get_latest_month(descriptions)
+    bench(lambda: descriptions_to_interval_set(descriptions, latest_month))
+
+
+def test_disable_enum_from_description(bench, rand):
+    # the legacy CHAR columns are padded
+    descriptions = [rand.choice(["Custom Category", "No Membership Fee", "No Traffic remaining",
+                                 "DSGVO nicht zustellbar", "DSGVO Widerspruch", "Ausgezogen"])
+                    .ljust(30) for _ in range(1000)]
+    bench(lambda: [DisableEnum.from_description(d) for d in descriptions])
+
+
+def test_addr_equal(bench, rand):
+    def address(addition: str):
+        return SimpleNamespace(street="Hochschulstraße", number="46", addition=addition,
+                               zip_code="01069", city="Dresden", state="Sachsen", country="Germany")
+    addresses = [address(f"{rand.randrange(1, 17)}-{rand.randrange(1, 30)}") for _ in range(100)]
+    pairs = [(a, addresses[0]) for a in addresses] * 10
+    bench(lambda: [addr_equal(a1, a2) for a1, a2 in pairs])
+
+
+def test_sorted_functions(bench):
+    bench(reg.sorted_functions)
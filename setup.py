@@ -108,7 +108,9 @@ setup(
     # py_modules=['mypackage'],
 
     entry_points={
-        'console_scripts': ['abe_importer=abe_importer.cli:main', 'abe_test=abe_importer.playground:main'],
+        'console_scripts': ['abe_importer=abe_importer.cli:main', 'abe_test=abe_importer.playground:main',
+                            'abe_bench=abe_importer.bench:main',
+                            'abe_inspect=abe_importer.inspection:main'],
     },
     install_requires=REQUIRED,
     extras_require=EXTRAS,
@@ -1,7 +1,41 @@
+import logging
+import threading
+import time
 from unittest import mock
 
-from abe_importer.importer.translations import sanitize_username, maybe_fix_mail
+import pytest
+from sqlalchemy import create_engine, Column, DateTime, ForeignKey, Integer, String, Table, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session, relationship
+
+from abe_importer import model as abe_model
+from abe_importer.importer.address_plan import SubnetIndex, SubnetRange, ip_to_int, \
+    mac_to_int, validate_address_plan
+from abe_importer.importer.artifact import column_groups, copy_text
+from abe_importer.importer.constraints import ConstraintChecker
+from abe_importer.importer.context import Context, IntermediateData, reg
+from abe_importer.importer.ip_history import collapse_observations, observations_after
+from abe_importer.importer.memory import MemoryProfiler
+from abe_importer.importer.object_registry import ObjectRegistry
+from abe_importer.importer.paging import PagedQuery, RetryStats, StreamedQuery
+from abe_importer.importer.progress import Progress
+from abe_importer.importer.reconciliation import abe_balances, compare_balances
+from abe_importer.importer.rows import IdAllocator, RowExtractor
+from abe_importer.importer.scope import Scope, WITHOUT_ACCESS
+from abe_importer.importer.settlement import Charge, allocate_fifo, merge_by_account
+from abe_importer.importer.staging import SQL_ENGINE, storage_type
+from abe_importer.importer.sync import account_fingerprints, changed_keys
+from abe_importer.importer.tools import DEFAULT_ENGINE, DependencyError
+from abe_importer.importer.upsert import update_changed, utc
+from abe_importer.importer.verify import expected_checksums, id_ranges, row_hash, value_text
+from abe_importer.importer.writer import BackgroundWriter, WriterError
+from abe_importer.importer.translations import sanitize_username, maybe_fix_mail, \
+    translate_building, aggregate_traffic, traffic_rows, translate_fees, translate_fees_in_sql, \
+    translate_fee_settlements, translate_bank_statements, statement_key
+from abe_importer.logging import RepetitionFilter
 from abe_importer.model import DisableEnum
+from abe_importer.testing import AbeFactory, create_sqlite_session
 
 
 def test_sanitize_username():
@@ -19,3 +53,587 @@ def test_mail_fix():
 
 def test_category_enum():
     assert DisableEnum.from_description("Ausgezogen") == DisableEnum.Moved
+
+
+def test_repetition_filter():
+    f = RepetitionFilter(samples=2)
+
+    def record(level, msg, *args):
+        return logging.LogRecord('test', level, __file__, 0, msg, args, None)
+
+    assert [f.filter(record(logging.INFO, "Renaming %s", i)) for i in range(4)] \
+        == [True, True, False, False]
+    assert f.filter(record(logging.INFO, "Other %s", 0))
+    assert all(f.filter(record(logging.ERROR, "Broken %s", i)) for i in range(4))
+    r = record(logging.INFO, "Renaming %s", 5)
+    r.aggregate = False
+    assert f.filter(r)
+
+    [summary] = f.summary('test')
+    assert summary.getMessage() == "(2 more like 'Renaming %s' suppressed)"
+
+
+def test_progress_tracking():
+    ticks = iter(range(100))
+    progress = Progress(mock.MagicMock(), stream=mock.MagicMock(), clock=lambda: next(ticks))
+    with progress.stage("translate_foo") as stage:
+        assert list(progress.track("abc")) == ["a", "b", "c"]
+        assert list(progress.track(iter("de"))) == ["d", "e"]
+
+    assert stage.rows == 5
+    assert progress.stages == [stage]
+    assert Progress.status("foo", 50, 200, 10., "rows") \
+        == "foo: 50/200 rows (25%, 5 rows/s, ETA 0:30)"
+
+
+def test_background_writer_flushes_in_order():
+    session = mock.MagicMock()
+    writer = BackgroundWriter(session, mock.MagicMock(), maxsize=1)
+    for batch in ([1, 2], [3], [4, 5]):
+        writer.submit(batch)
+    writer.close()
+
+    assert session.add_all.call_args_list == [mock.call([1, 2]), mock.call([3]), mock.call([4, 5])]
+    assert session.flush.call_count == 3
+    assert writer.num_written == 5
+
+
+def test_background_writer_reraises():
+    session = mock.MagicMock()
+    session.flush.side_effect = ValueError("constraint violated")
+    writer = BackgroundWriter(session, mock.MagicMock())
+    writer.submit([1])
+    with pytest.raises(WriterError):
+        writer.close()
+
+
+def test_reading_abe_releases_the_lock_only_if_held(ctx):
+    def held_elsewhere() -> bool:
+        acquired = []
+
+        def try_acquire():
+            acquired.append(ctx.pycroft_lock.acquire(blocking=False))
+            if acquired[0]:
+                ctx.pycroft_lock.release()
+        thread = threading.Thread(target=try_acquire)
+        thread.start()
+        thread.join()
+        return not acquired[0]
+
+    with ctx.reading_abe():  # outside of `do_import`
+        pass
+    with ctx.holding_pycroft():
+        assert held_elsewhere()
+        with ctx.reading_abe():
+            assert not held_elsewhere()
+        assert held_elsewhere()
+
+
+def test_failed_writer_stops_the_translation(ctx):
+    session = mock.MagicMock()
+    session.flush.side_effect = ValueError("constraint violated")
+    ctx.writer = BackgroundWriter(session, mock.MagicMock())
+    ctx.pycroft_lock = ctx.writer.lock
+    ctx.writer.submit([1])
+    with pytest.raises(WriterError), ctx.holding_pycroft():
+        while True:
+            with ctx.reading_abe():
+                time.sleep(0.01)
+    with pytest.raises(WriterError):
+        ctx.writer.close()
+
+
+def test_update_changed_only_assigns_differences():
+    obj = mock.MagicMock(spec=['name', 'number'])
+    obj.name, obj.number = "Wundtstraße", "5"
+    update_changed(obj, name="Wundtstraße", number="7")
+    assert obj.number == "7"
+    assert obj.name == "Wundtstraße"
+
+
+def test_utc_normalizes_naive_and_aware():
+    from datetime import datetime, timedelta, timezone
+    naive = datetime(2020, 1, 1, 12)
+    aware = datetime(2020, 1, 1, 13, tzinfo=timezone(timedelta(hours=1)))
+    assert utc(naive) == utc(aware)
+    assert utc(aware).tzinfo == timezone.utc
+    assert utc(None) is None
+
+
+def test_copy_text_escaping():
+    from datetime import date
+    assert copy_text(None) == r'\N'
+    assert copy_text(True) == 't'
+    assert copy_text("a\tb\\c\n") == r'a\tb\\c\n'
+    assert copy_text(date(2020, 1, 2)) == '2020-01-02'
+
+
+def test_row_extractor_fills_in_keys_and_leaves_defaults():
+    Base = declarative_base()
+    item_tags = Table('item_tags', Base.metadata,
+                      Column('item_id', ForeignKey('item.id'), primary_key=True),
+                      Column('tag_id', ForeignKey('tag.id'), primary_key=True))
+
+    class Owner(Base):
+        __tablename__ = 'owner'
+        id = Column(Integer, primary_key=True)
+
+    class Tag(Base):
+        __tablename__ = 'tag'
+        id = Column(Integer, primary_key=True)
+
+    class Item(Base):
+        __tablename__ = 'item'
+        id = Column(Integer, primary_key=True)
+        type = Column(String, nullable=False)
+        owner_id = Column(ForeignKey(Owner.id), nullable=False)
+        owner = relationship(Owner, backref='items')
+        tags = relationship(Tag, secondary=item_tags)
+        created_at = Column(DateTime, default=func.now())
+        state = Column(String, server_default='new')
+        __mapper_args__ = {'polymorphic_on': type, 'polymorphic_identity': 'item'}
+
+    class Book(Item):
+        __tablename__ = 'book'
+        id = Column(ForeignKey(Item.id), primary_key=True)
+        title = Column(String)
+        __mapper_args__ = {'polymorphic_identity': 'book'}
+
+    owner = Owner()
+    tag = Tag()
+    Book(title="Faust", owner=owner, tags=[tag])
+    Item(owner=owner, state="used")
+    extractor = RowExtractor(IdAllocator(lambda table: 10))
+    # the items are reached through the backref
+    extractor.add([owner])
+    rows = {table.name: table_rows for table, table_rows in extractor.tables()}
+
+    item = Item.__table__.c
+    assert sorted((r[item.id], r[item.type], r[item.owner_id]) for r in rows['item']) \
+        == [(10, 'book', 10), (11, 'item', 10)]
+    book_id = next(r[item.id] for r in rows['item'] if r[item.type] == 'book')
+    assert rows['book'][0][Book.__table__.c.id] == book_id
+    assert rows['item_tags'] == [{item_tags.c.item_id: book_id, item_tags.c.tag_id: 10}]
+    # SQL expressions and server defaults are left to the database, also in the artifact
+    assert all(r[item.created_at] is None for r in rows['item'])
+    groups = column_groups(Item.__table__, rows['item'])
+    assert sorted((len(g), item.state in columns, item.created_at in columns)
+                  for columns, g in groups) == [(1, False, False), (1, True, False)]
+
+
+def test_unpartitioned_scope_does_not_filter():
+    assert not Scope().partitioned
+    assert Scope().accounts() == Scope().fees() == Scope().statements() == ()
+    assert len(Scope(frozenset({"WU5"})).accounts()) == 1
+    assert len(Scope(frozenset({"WU5"}), sampled_accounts=frozenset({"a"})).accounts()) == 2
+
+
+@pytest.fixture
+def abe_session():
+    session = create_sqlite_session()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def ctx(abe_session):
+    pycroft_session = Session(bind=create_engine('sqlite://'))
+    return Context(abe_session, pycroft_session, mock.MagicMock(),
+                   progress=Progress(mock.MagicMock(), stream=mock.MagicMock()))
+
+
+def test_partitions_cover_every_account(abe_session):
+    f = AbeFactory(abe_session)
+    buildings = [f.building(), f.building()]
+    for building in buildings:
+        for _ in range(3):
+            f.account(f.access(building))
+    f.account()
+    abe_session.commit()
+
+    partitions = [Scope(frozenset({b.short_name})) for b in buildings]
+    assert partitions[0].accounts_left_out(abe_session) == 1
+    partitions.append(Scope(frozenset({WITHOUT_ACCESS})))
+    assert partitions[-1].accounts_left_out(abe_session) == 0
+    accounts = [a.account for scope in partitions
+                for a in abe_session.query(abe_model.Account).filter(*scope.accounts())]
+    assert sorted(accounts) == sorted(a.account for a in abe_session.query(abe_model.Account))
+
+
+def test_sampled_scope_follows_accounts(abe_session):
+    f = AbeFactory(abe_session)
+    building = f.building()
+    for _ in range(10):
+        f.fee(f.account(f.access(building)))
+    abe_session.commit()
+
+    scope = Scope().sample(abe_session, 0.3, seed=1)
+    assert len(scope.sampled_accounts) == 3
+    assert scope == Scope().sample(abe_session, 0.3, seed=1)
+    fees = abe_session.query(abe_model.AccountFeeRelation).filter(*scope.fees()).all()
+    assert {fee.account_name for fee in fees} == scope.sampled_accounts
+
+
+def test_translate_building(ctx, abe_session):
+    AbeFactory(abe_session).building(short_name="WU5", street="Wundtstraße  ")
+    abe_session.commit()
+
+    data = IntermediateData()
+    objs = translate_building(ctx, data)
+    assert len(objs) == 2
+    assert data.buildings["WU5"].street == "Wundtstraße"
+
+
+def test_statements_with_the_same_key_claim_an_existing_activity_once(ctx, abe_session):
+    from datetime import datetime
+    f = AbeFactory(abe_session)
+    first, second = [f.statement(purpose="Mitgliedsbeitrag 2020-01",
+                                 timestamp=datetime(2020, 1, 15, 12)) for _ in range(2)]
+    abe_session.commit()
+    activity = mock.MagicMock(id=1)
+    ctx.existing = mock.MagicMock()
+    ctx.existing.get.side_effect = lambda index_id, key: \
+        activity if key == statement_key(first) else None
+
+    data = IntermediateData()
+    translate_bank_statements(ctx, data)
+    assert data.statement_activities == {first.id: activity}
+    assert ctx.logger.warning.call_count == 2
+
+
+def test_paged_query_resumes_after_connection_error(abe_session):
+    f = AbeFactory(abe_session)
+    accounts = sorted(f.account().account for _ in range(7))
+    abe_session.commit()
+
+    stats = RetryStats()
+    paged = PagedQuery(abe_session.query(abe_model.Account), (abe_model.Account.account,),
+                       page_size=3, stats=stats, logger=mock.MagicMock(), sleep=lambda _: None)
+    page_after = paged.page_after
+    failures = iter([OperationalError("select …", {}, Exception("tunnel down"))])
+
+    def flaky_page_after(last):
+        if last is not None:
+            error = next(failures, None)
+            if error:
+                raise error
+        return page_after(last)
+
+    paged.page_after = flaky_page_after
+    assert [a.account for a in paged] == accounts
+    assert len(paged) == 7
+    assert (stats.pages, stats.retries) == (3, 1)
+
+
+def test_address_plan_validation():
+    import ipaddress
+    subnets = SubnetIndex([
+        SubnetRange.of(ipaddress.IPv4Network("141.30.217.0/24"), 14, 0),
+        SubnetRange.of(ipaddress.IPv4Network("141.30.215.128/25"), 11, 0),
+    ])
+    macs = [("a", "00:de:ad:be:ef:01"), ("b", "00:de:ad:be:ef:01"), ("c", "01:00:5e:00:00:01"),
+            ("c", "00:de:ad:be:ef:02")]
+    ips = [("a", "141.30.217.100"), ("b", "141.30.217.5"), ("c", "141.30.216.100"),
+           ("c", "141.30.215.200")]
+    report = validate_address_plan(macs, ips, subnets)
+
+    assert report.duplicate_macs == {mac_to_int("00:de:ad:be:ef:01"): ["a", "b"]}
+    assert report.multicast_macs == [("c", mac_to_int("01:00:5e:00:00:01"))]
+    assert report.reserved_ips == [("b", ip_to_int("141.30.217.5"))]
+    assert report.unrouted_ips == [("c", ip_to_int("141.30.216.100"))]
+    assert set(report.multiple_macs) == set(report.multiple_ips) == {"c"}
+    assert not report.duplicate_ips and not report.overlapping_subnets
+    assert subnets.find(ip_to_int("141.30.215.200")).network == ip_to_int("141.30.215.128")
+
+
+def test_subnet_index_finds_addresses_in_overlapping_subnets():
+    import ipaddress
+    outer = SubnetRange.of(ipaddress.IPv4Network("10.0.0.0/16"), 0, 0)
+    inner = SubnetRange.of(ipaddress.IPv4Network("10.0.1.0/24"), 0, 0)
+    subnets = SubnetIndex([inner, outer])
+    assert subnets.overlapping == [(outer, inner)]
+    assert subnets.find(ip_to_int("10.0.1.5")) is inner
+    # after the end of the inner subnet, which is the one bisecting finds
+    assert subnets.find(ip_to_int("10.0.2.5")) is outer
+    assert subnets.find(ip_to_int("10.1.0.1")) is None
+
+
+def test_streamed_traffic_is_aggregated_per_day(abe_session):
+    from datetime import date
+    f = AbeFactory(abe_session)
+    a, b = f.account(), f.account()
+    for acc in (b, a):
+        for day in (2, 1):
+            f.traffic(acc, date(2020, 1, day), bytes_in=day * 1000)
+    abe_session.commit()
+
+    log = abe_model.TrafficLog
+    rows = StreamedQuery(
+        abe_session.query(log.account_name, log.date, log.bytes_in, log.bytes_out,
+                          log.pkg_in, log.pkg_out),
+        (log.account_name, log.date), page_size=2, stats=RetryStats(), logger=mock.MagicMock(),
+    )
+    assert [(acc, day.day, b_in) for acc, day, b_in, *_ in aggregate_traffic(rows)] \
+        == [(a.account, 1, 1000), (a.account, 2, 2000), (b.account, 1, 1000), (b.account, 2, 2000)]
+    assert list(aggregate_traffic([("a", 1, 1, 2, 3, None), ("a", 1, 1, 2, 3, 4)])) \
+        == [("a", 1, 2, 4, 6, 4)]
+
+
+def test_traffic_stream_resumes_within_a_day(ctx, abe_session):
+    from datetime import date
+    f = AbeFactory(abe_session)
+    account = f.account()
+    for bytes_in in (1, 2, 4):
+        f.traffic(account, date(2020, 1, 1), bytes_in=bytes_in)
+    abe_session.commit()
+
+    class DroppedAfterOneRow:
+        def __init__(self, query):
+            self.query = query
+
+        def execution_options(self, **kwargs):
+            return self
+
+        def yield_per(self, count):
+            return self
+
+        def __iter__(self):
+            yield next(iter(self.query))
+            raise OperationalError("select …", {}, Exception("tunnel down"))
+
+    after = StreamedQuery.after
+    attempts = []
+
+    def dropping_after(self, query, last):
+        attempts.append(last)
+        self.sleep = lambda _: None
+        query = after(self, query, last)
+        return DroppedAfterOneRow(query) if len(attempts) == 1 else query
+
+    with mock.patch.object(StreamedQuery, 'after', dropping_after):
+        days = list(aggregate_traffic(traffic_rows(ctx, date(2020, 1, 1))))
+    assert len(attempts) == 2
+    assert [(acc, b_in) for acc, _, b_in, *_ in days] == [(account.account, 7)]
+
+
+def test_collapse_ip_observations():
+    rows = [("10.0.0.1", "a", 1), ("10.0.0.1", "a", 2), ("10.0.0.1", "b", 3),
+            ("10.0.0.1", "a", 4), ("10.0.0.2", "a", 5), ("10.0.0.2", "a", 6)]
+    assert [(i.ip, i.account, i.begins_at, i.ends_at, i.observations)
+            for i in collapse_observations(rows)] == [
+        ("10.0.0.1", "a", 1, 2, 2),
+        ("10.0.0.1", "b", 3, 3, 1),
+        ("10.0.0.1", "a", 4, 4, 1),
+        ("10.0.0.2", "a", 5, 6, 2),
+    ]
+
+
+def test_only_observations_after_the_imported_intervals_are_added():
+    from datetime import datetime, timedelta, timezone
+    t = datetime(2020, 1, 1)
+    rows = [("10.0.0.1", "a", t), ("10.0.0.1", "b", t + timedelta(hours=1)),
+            ("10.0.0.1", "a", t + timedelta(hours=2)), ("10.0.0.2", "c", t)]
+    # the imported ends are timezone aware, the abe timestamps are naive UTC
+    imported_until = {"a": (t + timedelta(hours=1)).replace(tzinfo=timezone.utc),
+                      "c": t.replace(tzinfo=timezone.utc)}
+    assert list(observations_after(rows, imported_until)) == [
+        ("10.0.0.1", "b", t + timedelta(hours=1)),
+        ("10.0.0.1", "a", t + timedelta(hours=2)),
+    ]
+
+
+def test_abe_balances_are_statements_minus_fees(abe_session):
+    from decimal import Decimal
+    f = AbeFactory(abe_session)
+    paid, owing, mapped = f.account(), f.account(), f.account(pycroft_login="someone")
+    for acc in (paid, owing, mapped):
+        f.fee(acc, amount=Decimal("5.00"))
+    f.statement(paid, amount=Decimal("5.00"))
+    f.statement(name="deleted")
+    abe_session.commit()
+
+    balances = abe_balances(abe_session, Scope())
+    assert balances == {paid.account: 0, owing.account: -5}
+
+    [mismatch] = compare_balances(balances, {paid.account: Decimal(0), owing.account: Decimal(-3)})
+    assert (mismatch.account, mismatch.delta) == (owing.account, 2)
+
+
+def test_memory_profiler_counts_session_objects(abe_session):
+    f = AbeFactory(abe_session)
+    f.account(), f.account()
+    profiler = MemoryProfiler(logging.getLogger('test'), {'abe': abe_session}, top=3)
+    try:
+        with profiler.stage("allocate"):
+            garbage = [bytearray(1024) for _ in range(1000)]
+    finally:
+        profiler.stop()
+
+    [stats] = profiler.stages
+    assert stats.traced_peak >= len(garbage) * 1024
+    assert len(stats.top_sites) == 3
+    assert stats.census['abe']['Account'] == 2
+
+
+@pytest.mark.parametrize('reset_peak', [True, False], ids=["python 3.9+", "python 3.8"])
+def test_memory_profiler_peak_is_per_stage(reset_peak, monkeypatch):
+    import tracemalloc
+    if not reset_peak:
+        monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+    elif not hasattr(tracemalloc, 'reset_peak'):
+        pytest.skip("tracemalloc.reset_peak is new in python 3.9")
+    profiler = MemoryProfiler(logging.getLogger('test'), {}, top=3)
+    try:
+        with profiler.stage("large"):
+            garbage = [bytearray(1024) for _ in range(4000)]
+            del garbage
+        with profiler.stage("small"):
+            garbage = [bytearray(1024) for _ in range(100)]
+    finally:
+        profiler.stop()
+
+    large, small = profiler.stages
+    assert large.traced_peak >= 4000 * 1024
+    assert len(garbage) * 1024 <= small.traced_peak < 1000 * 1024
+    assert small.top_sites
+
+
+def test_deferred_checks_run_after_the_writes_or_alone():
+    objs = ObjectRegistry()
+    calls = []
+    objs.defer_check(lambda session: calls.append("check"))
+    objs.defer(lambda session: calls.append("write") or 2)
+    assert objs.run_deferred(mock.MagicMock()) == 2
+    assert calls == ["write", "check"]
+    objs.run_checks(mock.MagicMock())
+    assert calls == ["write", "check", "check"]
+
+
+def test_object_registry_indexes_follow_flushes():
+    class Person:
+        def __init__(self, login, room=None):
+            self.login, self.room = login, room
+
+    class Tenant(Person):
+        pass
+
+    objs = ObjectRegistry()
+    objs.declare_key('by_login', Person, lambda p: p.login)
+    objs.extend([Person("a", room=1), Tenant("b", room=1), "not a person"])
+    objs.flush()
+    assert [p.login for p in objs.find('by_login', "b")] == ["b"]
+    assert [p.login for p in objs.where(Person, room=1)] == ["a", "b"]
+
+    objs.append(Tenant("a"))
+    assert len(objs.find('by_login', "a")) == 1, "staged objects are not indexed yet"
+    objs.flush()
+    assert len(objs.find('by_login', "a")) == 2
+    assert len(objs.of_type(Tenant)) == 2
+
+
+def test_id_ranges():
+    assert id_ranges([7, 1, 2, 3, 5, 8, 2]) == [(1, 3), (5, 5), (7, 8)]
+
+
+def test_expected_checksums_are_order_independent(abe_session):
+    from decimal import Decimal
+    f = AbeFactory(abe_session)
+    acc = f.account()
+    fees = [f.fee(acc, amount=Decimal(amount)).fee for amount in ("5", "2.50")]
+    abe_session.flush()  # a commit would expire the values
+
+    [table] = expected_checksums(fees)
+    assert [c.name for c in table.columns] == ['id', 'amount']
+    assert value_text(table.columns[1], True) == "true"
+    assert table.expected.rows == 2
+    assert table.expected == expected_checksums(reversed(fees))[0].expected
+    assert table.expected.checksum == sum(row_hash([str(fee.id), str(fee.amount)])
+                                          for fee in fees)
+
+
+def test_account_fingerprints_notice_changes(abe_session):
+    f = AbeFactory(abe_session)
+    unchanged, changed = f.account(), f.account()
+    f.statement(name="deleted")
+    abe_session.commit()
+    before, deleted_before = account_fingerprints(abe_session)
+    assert account_fingerprints(abe_session) == (before, deleted_before)
+
+    f.mac(changed)
+    f.fee(changed)
+    f.statement(name="deleted")
+    abe_session.commit()
+    after, deleted_after = account_fingerprints(abe_session)
+    assert changed_keys(before, after) == {changed.account}
+    assert changed_keys(deleted_before, deleted_after) == {"deleted"}
+
+
+def test_constraint_checker_finds_violations(abe_session):
+    AbeFactory(abe_session).account(account="taken")
+    abe_session.commit()
+    new = [
+        abe_model.Account(account="taken"),
+        abe_model.Account(account="free"),
+        abe_model.Account(account="free"),
+        abe_model.Account(),
+        abe_model.Mac(account_name="ghost", mac="00:de:ad:be:ef:00"),
+        abe_model.Mac(account_name="free", mac="00:de:ad:be:ef:01"),
+    ]
+
+    violations = {(v.table, v.kind): v for v in ConstraintChecker(abe_session).check(new)}
+    assert violations.keys() == {('imp_account', 'unique'), ('imp_account', 'not null'),
+                                 ('mac', 'foreign key')}
+    assert sorted(violations['imp_account', 'unique'].examples) == [("free",), ("taken",)]
+    assert violations['mac', 'foreign key'].examples == [("ghost",)]
+
+
+def test_constraint_checker_leaves_sql_defaults_to_the_database():
+    Base = declarative_base()
+
+    class Event(Base):
+        __tablename__ = 'event'
+        id = Column(Integer, primary_key=True)
+        name = Column(String, nullable=False)
+        created_at = Column(DateTime, nullable=False, default=func.now())
+
+    session = Session(create_engine('sqlite://'))
+    Base.metadata.create_all(session.bind)
+    violations = ConstraintChecker(session).check([Event(name="import"), Event()])
+    assert [(v.kind, v.constraint, v.count) for v in violations] \
+        == [('not null', 'name', 1)]
+
+
+def test_fifo_allocation_of_payments_to_fees():
+    from datetime import datetime
+    from decimal import Decimal
+    fees = [Charge(1, datetime(2020, 1, 1), Decimal(5)), Charge(2, datetime(2020, 2, 1), Decimal(5)),
+            Charge(3, datetime(2020, 3, 1), Decimal(5))]
+    payments = [Charge(10, datetime(2019, 12, 1), Decimal(3)),  # paid in advance
+                Charge(11, datetime(2020, 1, 5), Decimal(-1)),  # refund
+                Charge(12, datetime(2020, 2, 5), Decimal(4))]
+
+    settlement = allocate_fifo(fees, payments)
+    assert [(a.fee_id, a.statement_id, a.amount) for a in settlement.allocations] == [
+        (1, 10, 3), (1, 12, 2), (2, 12, 2),
+    ]
+    assert (settlement.open_amount, settlement.credit) == (8, 0)
+    assert allocate_fifo(fees[:1], payments[2:]).credit == 0
+    assert allocate_fifo([], payments).credit == 7
+
+
+def test_merge_by_account():
+    fees = [("a", 1), ("a", 2), ("c", 3)]
+    payments = [("b", 4), ("c", 5)]
+    assert list(merge_by_account(fees, payments)) == [
+        ("a", [1, 2], []), ("b", [], [4]), ("c", [3], [5]),
+    ]
+
+
+def test_translations_run_on_the_chosen_engine():
+    assert reg.engines()['translate_fees'] == {DEFAULT_ENGINE, SQL_ENGINE}
+    assert reg.implementation(translate_fees) is translate_fees
+    assert reg.implementation(translate_fees, SQL_ENGINE) is translate_fees_in_sql
+    with pytest.raises(DependencyError):
+        reg.implementation(translate_fee_settlements, SQL_ENGINE)
+    # the staging columns don't keep the precision declared by abe
+    assert storage_type(abe_model.FeeInfo.amount.type).precision is None